@@ -0,0 +1,304 @@
+"""Benchmark DDNS check-in throughput against a local fake Graph server.
+
+Starts benchmarks/fake_graph.py and the application, each in its own
+process, with a generated config.yml of simulated routers spread over a
+number of tenants.  Each router then checks in repeatedly, reporting a new
+IP address at the given rate, and the benchmark reports the latency
+percentiles, requests per second and Microsoft Graph calls per update.
+With --list-m365 it also times the /list-m365 page, 5 times unless a
+number of requests is given.
+
+Run from the repository root:
+
+    python benchmarks/ddns_load.py --routers 100 --check-ins 20 --change-rate 0.2 --latency 0.05
+
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import contextlib
+import datetime as dt
+import ipaddress
+import os
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+import httpx
+import yaml
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.x509.oid import NameOID
+
+if TYPE_CHECKING:
+    from collections.abc import Iterator
+
+REPOSITORY: Path = Path(__file__).resolve().parent.parent
+USERNAME: str = "bench"
+PASSWORD: str = "bench"  # noqa: S105
+
+
+def free_port() -> int:
+    """Return a TCP port that is free on the loopback interface."""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def write_certificate(directory: Path) -> tuple[Path, Path]:
+    """Write a self-signed certificate for 127.0.0.1, returning the certificate and key paths."""
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "127.0.0.1")])
+    now = dt.datetime.now(dt.UTC)
+    certificate = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - dt.timedelta(minutes=5))
+        .not_valid_after(now + dt.timedelta(days=1))
+        .add_extension(x509.SubjectAlternativeName([x509.IPAddress(ipaddress.ip_address("127.0.0.1"))]), critical=False)
+        .add_extension(x509.BasicConstraints(ca=True, path_length=None), critical=True)
+        .sign(key, hashes.SHA256())
+    )
+    cert_path: Path = directory / "cert.pem"
+    key_path: Path = directory / "key.pem"
+    cert_path.write_bytes(certificate.public_bytes(serialization.Encoding.PEM))
+    key_path.write_bytes(
+        key.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.PKCS8,
+            serialization.NoEncryption(),
+        ),
+    )
+    return cert_path, key_path
+
+
+def write_config(path: Path, routers: int, tenants: int) -> None:
+    """Write a config.yml with one Location per simulated router."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    locations: list[dict[str, object]] = [
+        {
+            "client_id": f"client-{index % tenants}",
+            "client_secret": f"secret-{index % tenants}",
+            "display_name": f"router-{index:05d}",
+            "ip_address": f"10.0.{index >> 8 & 255}.{index & 255}",
+            "is_trusted": True,
+            "location_id": f"00000000-0000-0000-0000-{index:012d}",
+            "tenant_id": f"tenant-{index % tenants}",
+        }
+        for index in range(routers)
+    ]
+    with path.open("w") as file_object:
+        yaml.safe_dump(locations, file_object)
+
+
+@contextlib.contextmanager
+def process(arguments: list[str], cwd: Path, env: dict[str, str]) -> Iterator[subprocess.Popen]:
+    """Run a process for the duration of the block."""
+    child = subprocess.Popen(arguments, cwd=cwd, env=env)  # noqa: S603
+    try:
+        yield child
+    finally:
+        child.terminate()
+        child.wait(timeout=10)
+
+
+async def wait_until_ready(url: str, startup_time: float = 30) -> None:
+    """Poll url until it answers."""
+    deadline: float = time.monotonic() + startup_time
+    async with httpx.AsyncClient() as client:
+        while True:
+            with contextlib.suppress(httpx.HTTPError):
+                await client.get(url)
+                return
+            if time.monotonic() > deadline:
+                msg = f"{url} did not start"
+                raise TimeoutError(msg)
+            await asyncio.sleep(0.2)
+
+
+async def run_router(
+    client: httpx.AsyncClient,
+    index: int,
+    *,
+    check_ins: int,
+    change_rate: float,
+    interval: float,
+    latencies: list[float],
+    outcomes: Counter,
+) -> None:
+    """Check in check_ins times as router index, sometimes with a new IP address."""
+    ip_address: str = f"10.0.{index >> 8 & 255}.{index & 255}"
+    for check_in in range(check_ins):
+        if random.random() < change_rate:  # noqa: S311
+            ip_address = f"10.{1 + check_in % 250}.{index >> 8 & 255}.{index & 255}"
+        start: float = time.perf_counter()
+        response = await client.get("/", params={"hostname": f"router-{index:05d}", "myip": ip_address})
+        latencies.append(time.perf_counter() - start)
+        outcomes[response.text.split(" ", 1)[0] if response.status_code == 200 else str(response.status_code)] += 1  # noqa: PLR2004
+        if interval:
+            await asyncio.sleep(interval)
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    """Return the value at fraction of the sorted values."""
+    ordered: list[float] = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def report(title: str, latencies: list[float], elapsed: float) -> None:
+    """Print the latency percentiles and throughput of a run."""
+    print(f"{title}: {len(latencies)} requests in {elapsed:.2f}s, {len(latencies) / elapsed:.1f} requests/s")
+    print(
+        f"  latency ms  p50 {percentile(latencies, 0.50) * 1000:.1f}"
+        f"  p95 {percentile(latencies, 0.95) * 1000:.1f}"
+        f"  p99 {percentile(latencies, 0.99) * 1000:.1f}"
+        f"  mean {statistics.fmean(latencies) * 1000:.1f}",
+    )
+
+
+async def benchmark(args: argparse.Namespace, app_url: str, graph_url: str) -> None:
+    """Drive the simulated routers, then /list-m365, and print the results."""
+    auth = httpx.BasicAuth(USERNAME, PASSWORD)
+    limits = httpx.Limits(max_connections=args.routers, max_keepalive_connections=args.routers)
+    async with (
+        httpx.AsyncClient(base_url=app_url, auth=auth, limits=limits, timeout=120) as client,
+        httpx.AsyncClient(base_url=graph_url) as graph,
+    ):
+        await graph.post("/_reset")
+        latencies: list[float] = []
+        outcomes: Counter = Counter()
+        start: float = time.perf_counter()
+        await asyncio.gather(
+            *(
+                run_router(
+                    client,
+                    index,
+                    check_ins=args.check_ins,
+                    change_rate=args.change_rate,
+                    interval=args.interval,
+                    latencies=latencies,
+                    outcomes=outcomes,
+                )
+                for index in range(args.routers)
+            ),
+        )
+        report("DDNS check-ins", latencies, time.perf_counter() - start)
+        print("  responses  " + "  ".join(f"{outcome} {count}" for outcome, count in sorted(outcomes.items())))
+
+        calls: dict[str, int] = (await graph.get("/_stats")).json()
+        graph_calls: int = sum(count for operation, count in calls.items() if operation != "token")
+        print("  graph calls  " + "  ".join(f"{operation} {count}" for operation, count in sorted(calls.items())))
+        print(f"  graph calls per update {graph_calls / max(outcomes['good'], 1):.2f}")
+
+        if args.list_m365:
+            latencies = []
+            start = time.perf_counter()
+            for _ in range(args.list_m365):
+                request_start: float = time.perf_counter()
+                response = await client.get("/list-m365")
+                response.raise_for_status()
+                latencies.append(time.perf_counter() - request_start)
+            report("/list-m365", latencies, time.perf_counter() - start)
+
+
+def main() -> None:
+    """Parse the command line, start the servers and run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--routers", type=int, default=50, help="number of simulated routers")
+    parser.add_argument("--tenants", type=int, default=5, help="number of tenants the routers are spread over")
+    parser.add_argument("--check-ins", type=int, default=20, help="check-ins per router")
+    parser.add_argument("--change-rate", type=float, default=0.2, help="fraction of check-ins with a new IP")
+    parser.add_argument("--interval", type=float, default=0.0, help="seconds each router waits between check-ins")
+    parser.add_argument(
+        "--list-m365",
+        type=int,
+        nargs="?",
+        const=5,
+        default=0,
+        help="number of /list-m365 requests after the check-ins, 5 if no number is given",
+    )
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds added to every Graph request")
+    parser.add_argument("--jitter", type=float, default=0.0, help="up to this many random seconds added on top")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="fraction of Graph requests throttled")
+    parser.add_argument("--retry-after", type=int, default=1, help="Retry-After seconds sent with a 429")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="fraction of Graph requests failed")
+    parser.add_argument("--app-env", action="append", default=[], metavar="NAME=VALUE", help="extra app setting")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp:
+        directory = Path(temp)
+        cert_path, key_path = write_certificate(directory)
+        write_config(directory / "config" / "config.yml", args.routers, args.tenants)
+        (directory / "templates").symlink_to(REPOSITORY / "templates")
+        graph_port, token_port, app_port = free_port(), free_port(), free_port()
+
+        fake_arguments: list[str] = [
+            sys.executable,
+            str(REPOSITORY / "benchmarks" / "fake_graph.py"),
+            "--config",
+            str(directory / "config" / "config.yml"),
+            "--port",
+            str(graph_port),
+            "--tls-port",
+            str(token_port),
+            "--cert",
+            str(cert_path),
+            "--key",
+            str(key_path),
+            "--latency",
+            str(args.latency),
+            "--jitter",
+            str(args.jitter),
+            "--throttle-rate",
+            str(args.throttle_rate),
+            "--retry-after",
+            str(args.retry_after),
+            "--failure-rate",
+            str(args.failure_rate),
+        ]
+        app_env: dict[str, str] = {
+            **os.environ,
+            "DDNS_USERNAME": USERNAME,
+            "DDNS_PASSWORD": PASSWORD,
+            "ADMIN_USERNAME": USERNAME,
+            "ADMIN_PASSWORD": PASSWORD,
+            "GRAPH_HOST": f"http://127.0.0.1:{graph_port}",
+            "AZURE_AUTHORITY_HOST": f"https://127.0.0.1:{token_port}",
+            "SSL_CERT_FILE": str(cert_path),
+            "RECONCILE_INTERVAL": "0",
+            **dict(setting.split("=", 1) for setting in args.app_env),
+        }
+        app_arguments: list[str] = [
+            sys.executable,
+            "-m",
+            "uvicorn",
+            "main:app",
+            "--app-dir",
+            str(REPOSITORY / "src"),
+            "--port",
+            str(app_port),
+            "--log-level",
+            "warning",
+        ]
+
+        with process(fake_arguments, directory, dict(os.environ)), process(app_arguments, directory, app_env):
+            asyncio.run(wait_until_ready(f"http://127.0.0.1:{graph_port}/_stats"))
+            asyncio.run(wait_until_ready(f"http://127.0.0.1:{app_port}/admin"))
+            asyncio.run(benchmark(args, f"http://127.0.0.1:{app_port}", f"http://127.0.0.1:{graph_port}"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,246 @@
+"""Local stand-in for the Microsoft Graph Named Location and token endpoints.
+
+Serves the parts of Graph this application uses, seeded with the Named
+Locations from a config.yml:
+
+    POST  /{tenant}/oauth2/v2.0/token
+    GET   /v1.0/identity/conditionalAccess/namedLocations
+    GET   /v1.0/identity/conditionalAccess/namedLocations/{id}
+    PATCH /v1.0/identity/conditionalAccess/namedLocations/{id}
+    POST  /v1.0/$batch
+
+Every Graph request can be delayed, throttled with a 429 and Retry-After,
+or failed with a 503, each at a configurable rate.  GET /_stats returns
+the number of calls per operation and POST /_reset clears them.
+
+The azure-identity token client only talks to https authorities, so the
+server also listens with TLS on a second port when given a certificate.
+Point the application at it with:
+
+    GRAPH_HOST=http://127.0.0.1:8765
+    AZURE_AUTHORITY_HOST=https://127.0.0.1:8766
+    SSL_CERT_FILE=cert.pem
+
+Run from the repository root:
+
+    python benchmarks/fake_graph.py --config config/config.yml --cert cert.pem --key key.pem
+
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import random
+import urllib.parse
+from collections import Counter
+from dataclasses import dataclass, field
+from pathlib import Path
+
+import uvicorn
+import yaml
+from fastapi import FastAPI, Request, Response
+from fastapi.responses import JSONResponse
+
+NAMED_LOCATIONS_PATH: str = "/identity/conditionalAccess/namedLocations"
+
+
+@dataclass
+class FakeGraphSettings:
+    """Latency and fault injection applied to Graph requests."""
+
+    latency: float = 0.05
+    jitter: float = 0.0
+    throttle_rate: float = 0.0
+    retry_after: int = 1
+    failure_rate: float = 0.0
+
+
+@dataclass
+class FakeGraphState:
+    """Named Locations per tenant and the calls made so far."""
+
+    settings: FakeGraphSettings
+    tenants: dict[str, dict[str, dict]] = field(default_factory=dict)
+    calls: Counter = field(default_factory=Counter)
+
+    @classmethod
+    def from_config(cls, path: Path, settings: FakeGraphSettings) -> FakeGraphState:
+        """Seed the Named Locations from a config.yml."""
+        state = cls(settings)
+        with path.open() as file_object:
+            for entry in yaml.safe_load(file_object) or []:
+                state.tenants.setdefault(str(entry["tenant_id"]), {})[str(entry["location_id"])] = {
+                    "@odata.type": "#microsoft.graph.ipNamedLocation",
+                    "id": str(entry["location_id"]),
+                    "displayName": entry["display_name"],
+                    "isTrusted": bool(entry["is_trusted"]),
+                    "ipRanges": [
+                        {"@odata.type": "#microsoft.graph.iPv4CidrRange", "cidrAddress": f"{entry['ip_address']}/32"},
+                    ],
+                }
+        return state
+
+    def fault(self) -> tuple[int, dict[str, str]] | None:
+        """Return the status and headers of an injected fault, or None."""
+        roll: float = random.random()  # noqa: S311
+        if roll < self.settings.throttle_rate:
+            self.calls["throttled"] += 1
+            return 429, {"Retry-After": str(self.settings.retry_after)}
+        if roll < self.settings.throttle_rate + self.settings.failure_rate:
+            self.calls["failed"] += 1
+            return 503, {}
+        return None
+
+    async def delay(self) -> None:
+        """Wait for the configured latency."""
+        latency: float = self.settings.latency + random.uniform(0, self.settings.jitter)  # noqa: S311
+        if latency > 0:
+            await asyncio.sleep(latency)
+
+    def handle(
+        self,
+        tenant_id: str,
+        method: str,
+        url: str,
+        *,
+        body: dict | None,
+        base_url: str,
+    ) -> tuple[int, dict[str, str], object]:
+        """Apply one Graph request to the state, returning status, headers and body."""
+        fault = self.fault()
+        if fault is not None:
+            return fault[0], fault[1], {"error": {"code": "injected", "message": "Injected fault"}}
+
+        locations: dict[str, dict] = self.tenants.get(tenant_id, {})
+        path, _, query_string = url.partition("?")
+        query: dict[str, str] = dict(urllib.parse.parse_qsl(query_string))
+        if not path.startswith(NAMED_LOCATIONS_PATH):
+            return 404, {}, {"error": {"code": "NotFound", "message": path}}
+        location_id: str = path[len(NAMED_LOCATIONS_PATH) :].strip("/")
+
+        if not location_id:
+            self.calls["list"] += 1
+            top: int = int(query.get("$top", 100))
+            skip: int = int(query.get("$skiptoken", 0))
+            page: dict[str, object] = {"value": list(locations.values())[skip : skip + top]}
+            if skip + top < len(locations):
+                next_query: str = urllib.parse.urlencode({**query, "$skiptoken": skip + top})
+                page["@odata.nextLink"] = f"{base_url}{NAMED_LOCATIONS_PATH}?{next_query}"
+            return 200, {}, page
+
+        location: dict | None = locations.get(location_id)
+        if location is None:
+            self.calls["not_found"] += 1
+            return 404, {}, {"error": {"code": "ResourceNotFound", "message": location_id}}
+        if method == "PATCH":
+            self.calls["patch"] += 1
+            location["ipRanges"] = (body or {}).get("ipRanges", location["ipRanges"])
+            return 204, {}, None
+        self.calls["get"] += 1
+        return 200, {}, location
+
+
+def create_app(state: FakeGraphState) -> FastAPI:
+    """Return the fake Graph application serving state."""
+    app = FastAPI()
+
+    def tenant_of(request: Request) -> str:
+        return request.headers.get("Authorization", "").removeprefix("Bearer fake-")
+
+    @app.post("/{tenant_id}/oauth2/v2.0/token")
+    async def token(tenant_id: str) -> Response:
+        state.calls["token"] += 1
+        return JSONResponse({"token_type": "Bearer", "expires_in": 3599, "access_token": "fake-" + tenant_id})
+
+    @app.get("/_stats")
+    async def stats() -> Response:
+        return JSONResponse(dict(state.calls))
+
+    @app.post("/_reset")
+    async def reset() -> Response:
+        state.calls.clear()
+        return Response(status_code=204)
+
+    @app.post("/v1.0/$batch")
+    async def batch(request: Request) -> Response:
+        state.calls["batch"] += 1
+        await state.delay()
+        tenant_id: str = tenant_of(request)
+        responses: list[dict] = []
+        for item in (await request.json())["requests"]:
+            status_code, headers, body = state.handle(
+                tenant_id,
+                item["method"],
+                item["url"],
+                body=item.get("body"),
+                base_url=str(request.base_url) + "v1.0",
+            )
+            responses.append({"id": item["id"], "status": status_code, "headers": headers, "body": body})
+        return JSONResponse({"responses": responses})
+
+    @app.api_route("/v1.0/{path:path}", methods=["GET", "PATCH"])
+    async def graph(request: Request, path: str) -> Response:
+        await state.delay()
+        body: dict | None = await request.json() if request.method == "PATCH" else None
+        # Graph ignores the double slash kiota sends after the version, so the fake does too.
+        url: str = "/" + path.lstrip("/") + ("?" + request.url.query if request.url.query else "")
+        status_code, headers, content = state.handle(
+            tenant_of(request),
+            request.method,
+            url,
+            body=body,
+            base_url=str(request.base_url) + "v1.0",
+        )
+        if content is None:
+            return Response(status_code=status_code, headers=headers)
+        return JSONResponse(content, status_code=status_code, headers=headers)
+
+    return app
+
+
+async def serve(app: FastAPI, host: str, port: int, *, tls_port: int, cert: Path | None, key: Path | None) -> None:
+    """Serve app over http, and over https on tls_port when given a certificate."""
+    servers: list[uvicorn.Server] = [uvicorn.Server(uvicorn.Config(app, host=host, port=port, log_level="warning"))]
+    if cert is not None and key is not None:
+        config = uvicorn.Config(
+            app,
+            host=host,
+            port=tls_port,
+            ssl_certfile=str(cert),
+            ssl_keyfile=str(key),
+            log_level="warning",
+        )
+        servers.append(uvicorn.Server(config))
+    await asyncio.gather(*(server.serve() for server in servers))
+
+
+def main() -> None:
+    """Parse the command line and run the fake Graph server."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--config", type=Path, required=True, help="config.yml to seed the Named Locations from")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765, help="http port for the Graph endpoints")
+    parser.add_argument("--tls-port", type=int, default=8766, help="https port for the token endpoint")
+    parser.add_argument("--cert", type=Path, help="TLS certificate, enables the https port")
+    parser.add_argument("--key", type=Path, help="TLS private key")
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds added to every Graph request")
+    parser.add_argument("--jitter", type=float, default=0.0, help="up to this many random seconds added on top")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="fraction of requests answered with 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="Retry-After seconds sent with a 429")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="fraction of requests answered with 503")
+    args = parser.parse_args()
+
+    settings = FakeGraphSettings(
+        latency=args.latency,
+        jitter=args.jitter,
+        throttle_rate=args.throttle_rate,
+        retry_after=args.retry_after,
+        failure_rate=args.failure_rate,
+    )
+    app: FastAPI = create_app(FakeGraphState.from_config(args.config, settings))
+    asyncio.run(serve(app, args.host, args.port, tls_port=args.tls_port, cert=args.cert, key=args.key))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+"""Benchmark the Graph SDK against the raw JSON transport for the DDNS path.
+
+Starts benchmarks/fake_graph.py and, in this process, sends the Named
+Location GET and PATCH used by DDNS check-ins through each transport, with
+GRAPH_TRANSPORT set to "sdk" and then "httpx".  For each transport and
+operation it reports the latency percentiles, requests per second and the
+CPU time this process spent per request, which is the client overhead the
+raw JSON transport saves.
+
+Run from the repository root:
+
+    python benchmarks/graph_transport.py --requests 2000 --concurrency 20
+
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+import yaml
+from ddns_load import REPOSITORY, free_port, percentile, process, wait_until_ready, write_certificate, write_config
+
+if TYPE_CHECKING:
+    from collections.abc import Awaitable, Callable
+
+    from location import Location
+
+
+async def measure(
+    title: str,
+    operation: Callable[[int], Awaitable[object]],
+    *,
+    requests: int,
+    concurrency: int,
+) -> None:
+    """Run operation requests times, concurrency at a time, and print the results."""
+    latencies: list[float] = []
+    counter = iter(range(requests))
+
+    async def worker() -> None:
+        for index in counter:
+            start: float = time.perf_counter()
+            if not await operation(index):
+                msg = f"{title} request {index} failed"
+                raise RuntimeError(msg)
+            latencies.append(time.perf_counter() - start)
+
+    cpu_start: float = time.process_time()
+    start: float = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed: float = time.perf_counter() - start
+    cpu: float = time.process_time() - cpu_start
+    print(
+        f"  {title:<6} {requests / elapsed:8.1f} requests/s"
+        f"  p50 {percentile(latencies, 0.50) * 1000:6.1f} ms"
+        f"  p95 {percentile(latencies, 0.95) * 1000:6.1f} ms"
+        f"  p99 {percentile(latencies, 0.99) * 1000:6.1f} ms"
+        f"  cpu {cpu / requests * 1000:6.2f} ms/request",
+    )
+
+
+async def benchmark(args: argparse.Namespace, locations: list[Location]) -> None:
+    """Time the GET and PATCH of each transport."""
+    from graph import get_current_location_ip, graph_pool, json_transport, set_named_location_ip  # noqa: PLC0415
+
+    try:
+        for transport in ("sdk", "httpx"):
+            json_transport.enabled = transport == "httpx"
+            # Fetch the tokens and open the connections before timing.
+            await asyncio.gather(*(get_current_location_ip(location) for location in locations[: args.concurrency]))
+
+            print(f"GRAPH_TRANSPORT={transport}")
+            await measure(
+                "GET",
+                lambda index: get_current_location_ip(locations[index % len(locations)]),
+                requests=args.requests,
+                concurrency=args.concurrency,
+            )
+            await measure(
+                "PATCH",
+                lambda index: set_named_location_ip(
+                    locations[index % len(locations)],
+                    f"10.{1 + index % 250}.0.{index % 256}",
+                ),
+                requests=args.requests,
+                concurrency=args.concurrency,
+            )
+    finally:
+        await graph_pool.close()
+        await json_transport.close()
+
+
+def main() -> None:
+    """Parse the command line, start the fake Graph server and run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=1000, help="requests per transport and operation")
+    parser.add_argument("--concurrency", type=int, default=20, help="requests in flight at once")
+    parser.add_argument("--routers", type=int, default=100, help="number of Named Locations")
+    parser.add_argument("--tenants", type=int, default=5, help="number of tenants the Named Locations are spread over")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every Graph request")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp:
+        directory = Path(temp)
+        cert_path, key_path = write_certificate(directory)
+        config_path: Path = directory / "config" / "config.yml"
+        write_config(config_path, args.routers, args.tenants)
+        graph_port, token_port = free_port(), free_port()
+
+        fake_arguments: list[str] = [
+            sys.executable,
+            str(REPOSITORY / "benchmarks" / "fake_graph.py"),
+            "--config",
+            str(config_path),
+            "--port",
+            str(graph_port),
+            "--tls-port",
+            str(token_port),
+            "--cert",
+            str(cert_path),
+            "--key",
+            str(key_path),
+            "--latency",
+            str(args.latency),
+        ]
+
+        # The application reads these when graph.py is imported.
+        os.environ.update(
+            {
+                "GRAPH_HOST": f"http://127.0.0.1:{graph_port}",
+                "AZURE_AUTHORITY_HOST": f"https://127.0.0.1:{token_port}",
+                "SSL_CERT_FILE": str(cert_path),
+                "GRAPH_RATE_LIMIT": "0",
+                "IP_CACHE_TTL": "0",
+            },
+        )
+        sys.path.insert(0, str(REPOSITORY / "src"))
+        from location import Location  # noqa: PLC0415
+
+        with config_path.open() as file_object:
+            locations: list[Location] = [Location.from_dict(location) for location in yaml.safe_load(file_object)]
+
+        with process(fake_arguments, directory, dict(os.environ)):
+            asyncio.run(wait_until_ready(f"http://127.0.0.1:{graph_port}/_stats"))
+            asyncio.run(benchmark(args, locations))
+
+
+if __name__ == "__main__":
+    main()
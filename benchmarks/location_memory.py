@@ -0,0 +1,88 @@
+"""Benchmark the memory used per Location.
+
+Measures the memory allocated for a fleet of 10,000 and 100,000 Locations,
+held in a LocationRegistry, and compares the slotted Location with a plain
+class that keeps its attributes in a per instance __dict__.
+
+Run from the repository root:
+
+    python benchmarks/location_memory.py
+
+"""
+
+from __future__ import annotations
+
+import sys
+import tracemalloc
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+from location import Location, LocationRegistry
+
+if TYPE_CHECKING:
+    from collections.abc import Callable
+
+FLEET_SIZES: list[int] = [10_000, 100_000]
+
+
+class DictLocation:
+    """Location with a per instance __dict__, as used before __slots__."""
+
+    def __init__(self, **attributes: object) -> None:
+        """Store every attribute in the instance __dict__."""
+        self.__dict__.update(attributes)
+
+
+def location_attributes(index: int) -> dict[str, object]:
+    """Return distinct attributes for the Location at index."""
+    return {
+        "client_id": f"client-{index % 50}",
+        "client_secret": f"secret-{index % 50}",
+        "display_name": f"site-{index:06d}",
+        "ip_address": f"10.{index >> 16 & 255}.{index >> 8 & 255}.{index & 255}",
+        "is_trusted": True,
+        "location_id": f"00000000-0000-0000-0000-{index:012d}",
+        "tenant_id": f"tenant-{index % 50}",
+    }
+
+
+def measure(build: Callable[[list[dict[str, object]]], object], count: int) -> int:
+    """Return the bytes still allocated after build(count) returns."""
+    attributes: list[dict[str, object]] = [location_attributes(index) for index in range(count)]
+    tracemalloc.start()
+    kept = build(attributes)
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del kept
+    return current
+
+
+def build_slotted(attributes: list[dict[str, object]]) -> LocationRegistry:
+    """Build a LocationRegistry of slotted Locations."""
+    return LocationRegistry(Location(**data) for data in attributes)
+
+
+def build_slotted_list(attributes: list[dict[str, object]]) -> list[Location]:
+    """Build a plain list of slotted Locations."""
+    return [Location(**data) for data in attributes]
+
+
+def build_dict_list(attributes: list[dict[str, object]]) -> list[DictLocation]:
+    """Build a plain list of __dict__ based Locations."""
+    return [DictLocation(**data) for data in attributes]
+
+
+def main() -> None:
+    """Print the memory used per Location for each fleet size."""
+    print(f"{'locations':>10} {'dict list':>12} {'slots list':>12} {'registry':>12}  (bytes per location)")
+    for count in FLEET_SIZES:
+        dict_list: int = measure(build_dict_list, count)
+        slotted_list: int = measure(build_slotted_list, count)
+        registry: int = measure(build_slotted, count)
+        print(f"{count:>10} {dict_list / count:>12.1f} {slotted_list / count:>12.1f} {registry / count:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,195 @@
+"""Benchmark how quickly the application starts.
+
+Measures, over a number of runs:
+
+* the time to import main.py, and the modules that take longest to import,
+  from python -X importtime
+* the time to import the Graph SDK on its own, which the application only
+  does after it starts listening
+* the time from starting uvicorn to the first /admin page served
+* the time from starting uvicorn to the first DDNS check-in answered by
+  Microsoft, served by benchmarks/fake_graph.py
+
+Run from the repository root:
+
+    python benchmarks/startup.py --runs 5
+
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import httpx
+from ddns_load import (
+    PASSWORD,
+    REPOSITORY,
+    USERNAME,
+    free_port,
+    process,
+    wait_until_ready,
+    write_certificate,
+    write_config,
+)
+
+SRC: Path = REPOSITORY / "src"
+
+
+def import_time(statement: str, cwd: Path, env: dict[str, str]) -> tuple[float, list[tuple[int, str]]]:
+    """Run statement in a fresh interpreter, returning its wall time and the slowest imports.
+
+    Returns:
+        Tuple of seconds taken and (microseconds, module) of the top level
+        imports, slowest first.
+
+    """
+    code: str = f"import time\nstart = time.perf_counter()\n{statement}\nprint(time.perf_counter() - start)"
+    result = subprocess.run(  # noqa: S603
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=cwd,
+        env={**env, "PYTHONPATH": str(SRC)},
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    modules: list[tuple[int, str]] = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.removeprefix("import time:").split("|")
+        # Only the top level imports, their children are included in the cumulative time.
+        if cumulative.strip().isdigit() and not name[1:].startswith(" "):
+            modules.append((int(cumulative), name.strip()))
+    return float(result.stdout.strip().splitlines()[-1]), sorted(modules, reverse=True)
+
+
+async def time_to_first_requests(
+    arguments: list[str],
+    cwd: Path,
+    env: dict[str, str],
+    app_url: str,
+) -> tuple[float, float]:
+    """Start the application, returning the seconds until /admin and a DDNS check-in were served."""
+    auth = httpx.BasicAuth(USERNAME, PASSWORD)
+    start: float = time.perf_counter()
+    with process(arguments, cwd, env):
+        async with httpx.AsyncClient(base_url=app_url, auth=auth, timeout=60) as client:
+            while True:
+                try:
+                    response = await client.get("/admin")
+                except httpx.HTTPError:
+                    await asyncio.sleep(0.01)
+                    continue
+                response.raise_for_status()
+                break
+            admin: float = time.perf_counter() - start
+
+            response = await client.get("/", params={"hostname": "router-00000", "myip": "10.0.0.0"})
+            if not response.text.startswith("nochg"):
+                msg = f"Unexpected DDNS response: {response.status_code} {response.text}"
+                raise RuntimeError(msg)
+            check_in: float = time.perf_counter() - start
+    return admin, check_in
+
+
+def summary(values: list[float]) -> str:
+    """Return the median, minimum and maximum of values in milliseconds."""
+    return (
+        f"median {statistics.median(values) * 1000:.0f} ms"
+        f"  min {min(values) * 1000:.0f} ms  max {max(values) * 1000:.0f} ms"
+    )
+
+
+def main() -> None:
+    """Parse the command line, then time the imports and the startups."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5, help="number of times each measurement is taken")
+    parser.add_argument("--routers", type=int, default=50, help="number of Locations in the generated config")
+    parser.add_argument("--top", type=int, default=10, help="number of slowest imports listed")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp:
+        directory = Path(temp)
+        cert_path, key_path = write_certificate(directory)
+        write_config(directory / "config" / "config.yml", args.routers, 1)
+        (directory / "templates").symlink_to(REPOSITORY / "templates")
+        graph_port, token_port, app_port = free_port(), free_port(), free_port()
+
+        app_env: dict[str, str] = {
+            **os.environ,
+            "DDNS_USERNAME": USERNAME,
+            "DDNS_PASSWORD": PASSWORD,
+            "ADMIN_USERNAME": USERNAME,
+            "ADMIN_PASSWORD": PASSWORD,
+            "GRAPH_HOST": f"http://127.0.0.1:{graph_port}",
+            "AZURE_AUTHORITY_HOST": f"https://127.0.0.1:{token_port}",
+            "SSL_CERT_FILE": str(cert_path),
+            "RECONCILE_INTERVAL": "0",
+        }
+
+        main_times: list[float] = []
+        sdk_times: list[float] = []
+        slowest: list[tuple[int, str]] = []
+        for _ in range(args.runs):
+            seconds, slowest = import_time("import main", directory, app_env)
+            main_times.append(seconds)
+            sdk_times.append(import_time("import msgraph", directory, app_env)[0])
+        print(f"import main     {summary(main_times)}")
+        print(f"import msgraph  {summary(sdk_times)}")
+        print("  slowest imports of main")
+        for microseconds, name in slowest[: args.top]:
+            print(f"    {microseconds / 1000:8.1f} ms  {name}")
+
+        fake_arguments: list[str] = [
+            sys.executable,
+            str(REPOSITORY / "benchmarks" / "fake_graph.py"),
+            "--config",
+            str(directory / "config" / "config.yml"),
+            "--port",
+            str(graph_port),
+            "--tls-port",
+            str(token_port),
+            "--cert",
+            str(cert_path),
+            "--key",
+            str(key_path),
+            "--latency",
+            "0",
+        ]
+        app_arguments: list[str] = [
+            sys.executable,
+            "-m",
+            "uvicorn",
+            "main:app",
+            "--app-dir",
+            str(SRC),
+            "--port",
+            str(app_port),
+            "--log-level",
+            "warning",
+        ]
+
+        admin_times: list[float] = []
+        check_in_times: list[float] = []
+        with process(fake_arguments, directory, dict(os.environ)):
+            asyncio.run(wait_until_ready(f"http://127.0.0.1:{graph_port}/_stats"))
+            for _ in range(args.runs):
+                admin, check_in = asyncio.run(
+                    time_to_first_requests(app_arguments, directory, app_env, f"http://127.0.0.1:{app_port}"),
+                )
+                admin_times.append(admin)
+                check_in_times.append(check_in)
+        print(f"first /admin    {summary(admin_times)}")
+        print(f"first check-in  {summary(check_in_times)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -5,18 +5,67 @@ parse it into a Location object, and add to a list of Location
 The other function will convert a list of Location into YAML format,
 and write out a replacement config file.
 
+The configuration is kept in memory by a process wide ConfigStore, backed
+by a pluggable Storage (config.yaml by default, or a SQLite database when
+STORAGE_BACKEND is "sqlite").  The store only loads the storage again when
+it changes (or on request, for example from a SIGHUP handler).  Changes made
+through the store are written back by a ConfigWriter task, which coalesces
+bursts of changes into one write done off the event loop.  IP address
+changes from DDNS check-ins are instead appended to an IpJournal, which the
+JournalCompactor periodically folds into the storage.  When several worker
+processes share the storage and the journal, each store also reloads when
+the journal grows, so every worker sees the others' changes.
+
 Typical usage example:
 
     [Locations] = read_config()
     write_config([Locations])
+    [Locations] = config_store.get_locations()
+    config_store.update(location_id, ip_address=ip_address)
+    await config_store.record_ip(location_id, ip_address, source="ddns")
+    export_config()
 
 """
 
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import logging
+import os
+import time
 from pathlib import Path
+from typing import TYPE_CHECKING
+
+from ip_cache import ip_cache
+from journal import IpJournal, JournalEntry
+from location import Location, LocationRegistry
+from metrics import config_duration, metrics
+from storage import SqliteStorage, Storage, YamlStorage, export_yaml
+from workers import SHARED, FileLock
+
+if TYPE_CHECKING:
+    from collections.abc import Hashable
+
+CONFIG_PATH: Path = Path("config/config.yml")
+
+# Storage backend for the Locations, "yaml" or "sqlite".
+STORAGE_BACKEND: str = os.getenv("STORAGE_BACKEND", "yaml").lower()
+
+# Database used by the "sqlite" storage backend.
+SQLITE_PATH: Path = Path(os.getenv("SQLITE_PATH", "config/locations.db"))
 
-import yaml
+# Journal of IP address changes from DDNS check-ins.
+JOURNAL_PATH: Path = Path(os.getenv("JOURNAL_PATH", "config/journal.log"))
 
-from location import Location
+# Seconds between folding the journal into the storage, 0 writes IP changes straight to the storage.
+JOURNAL_COMPACT_INTERVAL: float = float(os.getenv("JOURNAL_COMPACT_INTERVAL", "300"))
+
+# Number of journal entries that triggers folding the journal in early.
+JOURNAL_COMPACT_ENTRIES: int = int(os.getenv("JOURNAL_COMPACT_ENTRIES", "1000"))
+
+# Seconds to wait after a change before writing, so a burst of changes becomes one write.
+CONFIG_WRITE_DELAY: float = 0.5
 
 
 def read_config() -> list[Location]:
@@ -26,42 +75,494 @@ def read_config() -> list[Location]:
         Returns a list of Location Objects, one for each in config.yaml.
 
     """
-    try:
-        with Path("config/config.yml").open() as file_object:
-            data: any = yaml.load(file_object, Loader=yaml.SafeLoader)
-        return __parse_config(data)
-    except FileNotFoundError:
-        return []
+    return YamlStorage(CONFIG_PATH).load()
 
 
 def write_config(data: list[Location]) -> None:
     """Given a list of Locations, create and write a new config.yaml.
 
+    The file is written to a temporary file in the same directory, synced
+    to disk and renamed over config.yaml, so readers never see a partially
+    written file.
+
     Args:
         data: A list containing all location objects to be stored in config.yaml
 
     """
-    locations = []
-    for loc in data:
-        test = vars(loc)
-        locations.append(test)
-
-    with Path("config/config.yml").open("w") as file_object:
-        yaml.dump(locations, file_object)
-
-
-def __parse_config(config_data: any) -> Location:
-    loc = []
-
-    for data in config_data:
-        location = Location(
-            client_id=data["client_id"],
-            client_secret=data["client_secret"],
-            display_name=data["display_name"],
-            ip_address=data["ip_address"],
-            is_trusted=data["is_trusted"],
-            location_id=data["location_id"],
-            tenant_id=data["tenant_id"],
-        )
-        loc.append(location)
-    return loc
+    YamlStorage(CONFIG_PATH).write(data, {})
+
+
+def export_config() -> str:
+    """Return every configured Location in the config.yaml format.
+
+    Returns:
+        The YAML document as a string, suitable for a backup or as config.yaml.
+
+    """
+    return export_yaml(config_store.get_locations())
+
+
+class ConfigWriter:
+    """Background task that writes changes in the ConfigStore to its storage.
+
+    Calls to schedule() only record which Locations changed.  The writer
+    task waits CONFIG_WRITE_DELAY seconds so a burst of changes is
+    coalesced, then writes a snapshot of the store in a worker thread.
+    Locations are immutable, so the snapshot is just a list of them.
+
+    Attributes:
+        store: ConfigStore
+            The store whose Locations are written
+
+    """
+
+    store: ConfigStore
+
+    def __init__(self, store: ConfigStore) -> None:
+        """Initialize a ConfigWriter for the given store.
+
+        Args:
+            store:
+                The store whose Locations are written
+
+        """
+        self.store = store
+        self._changed: set[str] = set()
+        self._dirty: asyncio.Event = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self._write_lock: asyncio.Lock = asyncio.Lock()
+
+    @property
+    def busy(self) -> bool:
+        """True while changes are waiting to be written or being written."""
+        return bool(self._changed) or self._write_lock.locked()
+
+    def start(self) -> None:
+        """Start the writer task on the running event loop."""
+        if self._task is None:
+            self._dirty = asyncio.Event()
+            self._write_lock = asyncio.Lock()
+            self._task = asyncio.create_task(self._run())
+
+    def schedule(self, *location_ids: str) -> None:
+        """Record changed Locations, writing them now if the task is not running.
+
+        Args:
+            *location_ids:
+                The location_ids that were added, changed or removed.
+
+        """
+        self._changed.update(location_ids)
+        if self._task is None:
+            changed, self._changed = self._changed, set()
+            self.store.storage.write(list(self.store.registry), self._snapshot_changes(changed))
+            self.store.mark_written()
+            return
+        self._dirty.set()
+
+    async def flush(self) -> None:
+        """Write any pending changes immediately."""
+        if self._changed:
+            await self._write()
+
+    async def close(self) -> None:
+        """Stop the writer task after writing any pending changes."""
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+        await self.flush()
+
+    async def _run(self) -> None:
+        while True:
+            await self._dirty.wait()
+            await asyncio.sleep(CONFIG_WRITE_DELAY)
+            self._dirty.clear()
+            await self._write()
+
+    async def _write(self) -> None:
+        logger: logging.Logger = logging.getLogger("uvicorn.error")
+
+        async with self._write_lock:
+            if not self._changed:
+                return
+            changed, self._changed = self._changed, set()
+            snapshot: list[Location] = list(self.store.registry)
+            try:
+                with config_duration.time("write"):
+                    await asyncio.to_thread(self.store.storage.write, snapshot, self._snapshot_changes(changed))
+            except (OSError, ValueError) as e:
+                logger.exception("Unable to write %s", self.store.storage, exc_info=e)
+                self._changed |= changed
+                self._dirty.set()
+                return
+            self.store.mark_written()
+
+    def _snapshot_changes(self, changed: set[str]) -> dict[str, Location | None]:
+        return {location_id: self.store.registry.get_by_id(location_id) for location_id in changed}
+
+
+class ConfigStore:
+    """In memory copy of the configured Locations.
+
+    The store keeps the Locations loaded from its storage in a
+    LocationRegistry and only loads them again when the storage's signature
+    changes (for config.yaml, its inode, size or modification time), so the
+    routes can read the configuration on every request without paying for
+    the YAML parse.  While changes are waiting to be written, the in memory
+    Locations are kept as they are.  Cached Microsoft IP addresses of
+    Locations changed by a reload are dropped.
+
+    IP address changes recorded with record_ip() are appended to the journal
+    when there is one, and only written to the storage by compact().  Each
+    load replays the journal on top of the storage, and entries appended
+    since, by this or another worker process, are replayed on their own
+    without loading the storage again.
+
+    Attributes:
+        storage: Storage
+            The backend the Locations are loaded from and written to
+        journal: IpJournal | None
+            The journal of IP address changes, or None to write them to the storage
+        registry: LocationRegistry
+            The in memory Locations, as last loaded or changed
+        writer: ConfigWriter
+            The task writing changes back to the storage
+
+    """
+
+    storage: Storage
+    journal: IpJournal | None
+    registry: LocationRegistry
+    writer: ConfigWriter
+
+    def __init__(self, storage: Storage, journal: IpJournal | None = None) -> None:
+        """Initialize an empty ConfigStore for the given storage.
+
+        Args:
+            storage:
+                The backend the Locations are loaded from and written to
+            journal:
+                The journal of IP address changes, or None to write them to the storage
+
+        """
+        self.storage = storage
+        self.journal = journal
+        self.registry = LocationRegistry()
+        self._journaled: set[str] = set()
+        self._signature: Hashable | None = None
+        self._journal_position: tuple[int, int] = (0, 0)
+        self._loaded: bool = False
+        self.writer = ConfigWriter(self)
+
+    def get_registry(self) -> LocationRegistry:
+        """Return the registry of Locations, reloading if the storage changed.
+
+        Returns:
+            The in memory LocationRegistry.
+
+        """
+        if not self._loaded or (not self.writer.busy and self.storage.signature() != self._signature):
+            self.reload()
+        elif self.journal is not None and not self.writer.busy:
+            self._replay_journal_tail()
+        return self.registry
+
+    def get_locations(self) -> list[Location]:
+        """Return the current list of Locations, reloading if the storage changed.
+
+        Returns:
+            A new list holding the in memory Location objects.
+
+        """
+        return list(self.get_registry())
+
+    def reload(self) -> None:
+        """Load the Locations from storage again, regardless of whether they changed."""
+        logger: logging.Logger = logging.getLogger("uvicorn.error")
+
+        self._signature = self.storage.signature()
+        self._loaded = True
+        previous: dict[str, Location] = {location.location_id: location for location in self.registry}
+        try:
+            with config_duration.time("load"):
+                self.registry.replace_all(self.storage.load())
+        except ValueError:
+            logger.exception("Unable to load %s, keeping the previous configuration", self.storage)
+            return
+        logger.info("Loaded %d locations from %s", len(self.registry), self.storage)
+
+        if self.journal is not None:
+            self._replay_journal(0)
+
+        # Another worker, or an edit of the storage, may have changed what Microsoft has for these Locations.
+        for location_id, location in previous.items():
+            if self.registry.get_by_id(location_id) != location:
+                ip_cache.invalidate(location_id)
+
+    def add(self, location: Location) -> None:
+        """Add a Location and schedule it to be written.
+
+        Args:
+            location:
+                The Location to add.
+
+        Raises:
+            ValueError: Another Location has the same location_id or display_name.
+
+        """
+        self.get_registry().add(location)
+        self.writer.schedule(location.location_id)
+
+    def update(self, location_id: str, /, **changes: object) -> Location | None:
+        """Change a Location and schedule it to be written.
+
+        Args:
+            location_id:
+                The location_id of the Location to change.
+            **changes:
+                Attribute names and their new values.
+
+        Returns:
+            The changed Location, or None if there is no such Location.
+
+        Raises:
+            ValueError: The change would duplicate another Location's location_id or display_name.
+
+        """
+        location: Location | None = self.get_registry().update(location_id, **changes)
+        if location is not None:
+            self.writer.schedule(location_id, location.location_id)
+        return location
+
+    def remove(self, location_id: str) -> Location | None:
+        """Remove a Location and schedule the removal to be written.
+
+        Args:
+            location_id:
+                The location_id of the Location to remove.
+
+        Returns:
+            The removed Location, or None if there is no such Location.
+
+        """
+        location: Location | None = self.get_registry().remove(location_id)
+        if location is not None:
+            self.writer.schedule(location_id)
+        return location
+
+    async def record_ip(self, location_id: str, ip_address: str, *, source: str) -> Location | None:
+        """Change a Location's IP address, appending the change to the journal.
+
+        Without a journal, or if the journal can't be written, the change is
+        scheduled to be written to the storage like any other.
+
+        Args:
+            location_id:
+                The location_id of the Location to change.
+            ip_address:
+                The new IP address.
+            source:
+                What reported the change, recorded in the journal.
+
+        Returns:
+            The changed Location, or None if there is no such Location.
+
+        """
+        logger: logging.Logger = logging.getLogger("uvicorn.error")
+
+        old: Location | None = self.get_registry().get_by_id(location_id)
+        if old is None or old.ip_address == ip_address:
+            return old
+        location: Location | None = self.registry.update(location_id, ip_address=ip_address)
+        if self.journal is None:
+            self.writer.schedule(location_id)
+            return location
+
+        entry = JournalEntry(time.time(), location_id, old.ip_address, ip_address, source)
+        try:
+            with config_duration.time("journal_append"):
+                await asyncio.to_thread(self.journal.append, entry)
+        except OSError as e:
+            logger.exception("Unable to write %s", self.journal, exc_info=e)
+            self.writer.schedule(location_id)
+            return location
+        # The next read of the journal tail skips this entry, as the change is already in memory.
+        self._journaled.add(location_id)
+        return location
+
+    async def compact(self) -> None:
+        """Write the journaled IP address changes to the storage and drop them from the journal."""
+        if self.journal is None or (not self._journaled and self.journal.size() == 0):
+            return
+
+        # Load the changes other workers appended, so they are written before the journal is cut.
+        await self.writer.flush()
+        offset: int = self.journal.size()
+        self.get_registry()
+
+        journaled, self._journaled = self._journaled, set()
+        self.writer.schedule(*journaled)
+        await self.writer.flush()
+        if self.writer.busy:
+            # The write failed, keep the journal so the changes are not lost.
+            self._journaled |= journaled
+            return
+        with config_duration.time("journal_compact"):
+            await asyncio.to_thread(self.journal.compact, offset)
+        self._signature = self.storage.signature()
+
+    def mark_written(self) -> None:
+        """Record that the storage now matches the store."""
+        self._signature = self.storage.signature()
+
+    def _replay_journal_tail(self) -> None:
+        """Apply the journal entries appended since the last replay.
+
+        If the journal was compacted since, the new journal holds only
+        entries appended after the compaction's offset, which are replayed
+        from its start.  Entries already applied no longer match their old
+        IP address and are skipped.
+        """
+        inode, size = self.journal.position()
+        applied_inode, applied = self._journal_position
+        if (inode, size) == self._journal_position:
+            return
+        changed: list[str] = self._replay_journal(applied if inode == applied_inode and size >= applied else 0)
+
+        # Another worker changed these Locations with Microsoft.
+        for location_id in changed:
+            ip_cache.invalidate(location_id)
+
+    def _replay_journal(self, offset: int) -> list[str]:
+        """Apply the journaled IP address changes after offset on top of the loaded Locations.
+
+        An entry is only applied while the Location still has the IP address
+        it replaced, so a change made directly to the storage wins over older
+        journal entries.
+
+        Returns:
+            The location_ids of the Locations that changed.
+
+        """
+        entries, self._journal_position = self.journal.read_from(offset)
+        changed: list[str] = []
+        for entry in entries:
+            location: Location | None = self.registry.get_by_id(entry.location_id)
+            if location is not None and location.ip_address == entry.old_ip:
+                self.registry.update(entry.location_id, ip_address=entry.new_ip)
+                self._journaled.add(entry.location_id)
+                changed.append(entry.location_id)
+        return changed
+
+
+class JournalCompactor:
+    """Background task that periodically folds the journal into the storage.
+
+    Attributes:
+        store: ConfigStore
+            The store whose journal is compacted
+        interval: float
+            Seconds between compactions
+        max_entries: int
+            Number of journal entries that triggers an early compaction
+
+    """
+
+    store: ConfigStore
+    interval: float
+    max_entries: int
+
+    def __init__(self, store: ConfigStore, *, interval: float, max_entries: int) -> None:
+        """Initialize a JournalCompactor for the given store.
+
+        Args:
+            store:
+                The store whose journal is compacted
+            interval:
+                Seconds between compactions
+            max_entries:
+                Number of journal entries that triggers an early compaction
+
+        """
+        self.store = store
+        self.interval = interval
+        self.max_entries = max_entries
+        self._task: asyncio.Task | None = None
+
+    def start(self) -> None:
+        """Start the compactor task on the running event loop."""
+        if self._task is None and self.store.journal is not None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self) -> None:
+        """Stop the compactor task after a final compaction."""
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+        await self.store.compact()
+
+    async def _run(self) -> None:
+        logger: logging.Logger = logging.getLogger("uvicorn.error")
+        # Check the journal size more often than the interval so a burst of changes is folded in early.
+        check_interval: float = min(self.interval, 5.0)
+        elapsed: float = 0.0
+        while True:
+            await asyncio.sleep(check_interval)
+            elapsed += check_interval
+            # Count the entries in the file, so those appended by every worker count
+            if elapsed < self.interval and await asyncio.to_thread(self.store.journal.count) < self.max_entries:
+                continue
+            elapsed = 0.0
+            try:
+                await self.store.compact()
+            except OSError as e:
+                logger.exception("Unable to compact %s", self.store.journal, exc_info=e)
+
+
+def open_storage() -> Storage:
+    """Return the storage backend selected by STORAGE_BACKEND.
+
+    The "sqlite" backend imports config.yaml the first time it starts.  When
+    several workers share config.yaml, its writes are merged under a file lock.
+
+    Returns:
+        The Storage for the configured Locations.
+
+    Raises:
+        ValueError: STORAGE_BACKEND names an unknown backend.
+
+    """
+    if STORAGE_BACKEND == "yaml":
+        return YamlStorage(CONFIG_PATH, FileLock(CONFIG_PATH.with_name(".config.yml.lock")) if SHARED else None)
+    if STORAGE_BACKEND == "sqlite":
+        return SqliteStorage(SQLITE_PATH, import_from=YamlStorage(CONFIG_PATH))
+    msg = f"Unknown STORAGE_BACKEND: {STORAGE_BACKEND}"
+    raise ValueError(msg)
+
+
+config_store: ConfigStore = ConfigStore(
+    open_storage(),
+    IpJournal(
+        JOURNAL_PATH,
+        FileLock(JOURNAL_PATH.with_name(JOURNAL_PATH.name + ".lock")) if SHARED else None,
+    )
+    if JOURNAL_COMPACT_INTERVAL > 0
+    else None,
+)
+journal_compactor: JournalCompactor = JournalCompactor(
+    config_store,
+    interval=JOURNAL_COMPACT_INTERVAL,
+    max_entries=JOURNAL_COMPACT_ENTRIES,
+)
+
+metrics.callback("ddns_locations", "Configured Locations.", "gauge", lambda: len(config_store.registry))
+metrics.callback(
+    "ddns_journal_entries",
+    "IP address changes in the journal waiting to be folded into the storage.",
+    "gauge",
+    lambda: config_store.journal.count() if config_store.journal is not None else 0,
+)
@@ -0,0 +1,325 @@
+"""Module for damping Named Location updates from flapping WAN links.
+
+This module contains a flap damper that limits how often a Location is
+updated with Microsoft.  Each reported IP address change adds a penalty
+that decays over time, and a Location whose penalty crosses the suppress
+limit is held down until it decays below the reuse limit.  A minimum
+interval between updates can also be set.  While a Location is held
+down, only the latest reported IP address is applied once it is allowed,
+and it is retried until Microsoft has it.
+
+The damper is disabled unless DAMPING_MIN_INTERVAL or DAMPING_PENALTY
+is set.
+
+Typical usage example:
+
+    flap_damper.record_change(location_id, ip_address)
+    delay = flap_damper.hold_time(location_id)
+    flap_damper.hold(location, ip_address, apply)
+    applied = await flap_damper.held_result(location_id)
+
+"""
+
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import math
+import os
+import time
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from collections.abc import Awaitable, Callable
+
+    from location import Location
+
+
+class _DampingState:
+    """Penalty, last update time and held IP address for one Location."""
+
+    def __init__(self) -> None:
+        self.penalty: float = 0.0
+        self.penalty_updated: float = time.monotonic()
+        self.suppressed: bool = False
+        self.last_update: float | None = None
+        self.held_location: Location | None = None
+        self.held_ip_address: str | None = None
+        self.held_future: asyncio.Future[bool] | None = None
+        self.last_ip_address: str | None = None
+        self.applying: bool = False
+        self.task: asyncio.Task | None = None
+
+
+class FlapDamper:
+    """Per Location flap damping and minimum update interval.
+
+    Attributes:
+        min_interval: float
+            Minimum seconds between two updates of the same Location
+        penalty: float
+            Penalty added for every reported IP address change, 0 disables
+        suppress_limit: float
+            Penalty at which a Location is held down
+        reuse_limit: float
+            Penalty below which a held down Location is updated again
+        half_life: float
+            Seconds for the penalty to decay to half
+        retry_delay: float
+            Seconds before a held IP address that failed to apply is tried again
+
+    """
+
+    min_interval: float
+    penalty: float
+    suppress_limit: float
+    reuse_limit: float
+    half_life: float
+    retry_delay: float
+
+    def __init__(
+        self,
+        *,
+        min_interval: float,
+        penalty: float,
+        suppress_limit: float,
+        reuse_limit: float,
+        half_life: float,
+        retry_delay: float,
+    ) -> None:
+        """Initialize a FlapDamper with the given policy.
+
+        Args:
+            min_interval:
+                Minimum seconds between two updates of the same Location
+            penalty:
+                Penalty added for every reported IP address change, 0 disables
+            suppress_limit:
+                Penalty at which a Location is held down
+            reuse_limit:
+                Penalty below which a held down Location is updated again
+            half_life:
+                Seconds for the penalty to decay to half
+            retry_delay:
+                Seconds before a held IP address that failed to apply is tried again
+
+        Raises:
+            ValueError: The limits or half life can't be used with a penalty, or retry_delay is not positive.
+
+        """
+        if penalty > 0 and not (half_life > 0 and 0 < reuse_limit <= suppress_limit):
+            msg = (
+                "Flap damping needs DAMPING_HALF_LIFE > 0 and 0 < DAMPING_REUSE_LIMIT <= DAMPING_SUPPRESS_LIMIT, "
+                f"got {half_life}, {reuse_limit} and {suppress_limit}"
+            )
+            raise ValueError(msg)
+        if retry_delay <= 0:
+            msg = f"DAMPING_RETRY_DELAY must be positive, got {retry_delay}"
+            raise ValueError(msg)
+        self.min_interval = min_interval
+        self.penalty = penalty
+        self.suppress_limit = suppress_limit
+        self.reuse_limit = reuse_limit
+        self.half_life = half_life
+        self.retry_delay = retry_delay
+        self._states: dict[str, _DampingState] = {}
+
+    def record_change(self, location_id: str, ip_address: str) -> None:
+        """Add the change penalty for a Location reporting a new IP address.
+
+        A router repeating the IP address it reported last, or the one held
+        for it, is not penalized again, so retries don't keep it held down.
+
+        Args:
+            location_id:
+                The UUID for the Named Location
+            ip_address:
+                The IP address reported by the router
+
+        """
+        if self.penalty <= 0:
+            return
+        state: _DampingState = self._state(location_id)
+        if ip_address in {state.last_ip_address, state.held_ip_address}:
+            return
+        state.last_ip_address = ip_address
+        state.penalty += self.penalty
+        if state.penalty >= self.suppress_limit:
+            state.suppressed = True
+
+    def record_update(self, location_id: str) -> None:
+        """Record that Microsoft was updated for a Location.
+
+        Args:
+            location_id:
+                The UUID for the Named Location
+
+        """
+        if self.min_interval > 0:
+            self._state(location_id).last_update = time.monotonic()
+
+    def hold_time(self, location_id: str) -> float:
+        """Return how many seconds a Location must wait before being updated.
+
+        Args:
+            location_id:
+                The UUID for the Named Location
+
+        Returns:
+            Seconds to wait, 0 if the Location can be updated now.
+
+        """
+        if location_id not in self._states:
+            return 0.0
+        state: _DampingState = self._state(location_id)
+        now: float = time.monotonic()
+
+        wait: float = 0.0
+        if state.suppressed and state.penalty >= self.reuse_limit:
+            wait = self.half_life * math.log2(state.penalty / self.reuse_limit)
+        else:
+            state.suppressed = False
+        if state.last_update is not None:
+            wait = max(wait, state.last_update + self.min_interval - now)
+        return max(wait, 0.0)
+
+    def hold(
+        self,
+        location: Location,
+        ip_address: str,
+        apply: Callable[[Location, str], Awaitable[bool]],
+    ) -> None:
+        """Hold an IP address until the Location may be updated, then apply it.
+
+        Only the latest held IP address of a Location is applied.  The IP
+        address stays held until apply succeeds, and is tried again after
+        retry_delay seconds whenever it fails.
+
+        Args:
+            location:
+                The Location to update.
+            ip_address:
+                The IP address to apply once allowed.
+            apply:
+                Coroutine function called with the Location and IP address,
+                returning whether Microsoft now has the IP address.
+
+        """
+        state: _DampingState = self._state(location.location_id)
+        if state.held_ip_address != ip_address:
+            _resolve(state.held_future, applied=False)
+            state.held_future = asyncio.get_running_loop().create_future()
+        state.held_location = location
+        state.held_ip_address = ip_address
+        if state.task is None:
+            state.task = asyncio.create_task(self._apply_when_allowed(location.location_id, apply))
+
+    def release(self, location_id: str) -> None:
+        """Drop any IP address held for a Location.
+
+        If the held IP address is being applied, the apply finishes but is
+        not retried.
+
+        Args:
+            location_id:
+                The UUID for the Named Location
+
+        """
+        state: _DampingState | None = self._states.get(location_id)
+        if state is not None and state.task is not None:
+            if not state.applying:
+                state.task.cancel()
+                state.task = None
+            state.held_location = None
+            state.held_ip_address = None
+            _resolve(state.held_future, applied=False)
+            state.held_future = None
+
+    def held_ip(self, location_id: str) -> str | None:
+        """Return the IP address being held for a Location, or None."""
+        state: _DampingState | None = self._states.get(location_id)
+        return state.held_ip_address if state is not None and state.task is not None else None
+
+    def held_result(self, location_id: str) -> asyncio.Future[bool] | None:
+        """Return a future for the IP address held for a Location, or None if nothing is held.
+
+        The future is set to True once Microsoft has the IP address, or to
+        False if the IP address is replaced or dropped before that.
+        """
+        state: _DampingState | None = self._states.get(location_id)
+        return state.held_future if state is not None and state.task is not None else None
+
+    def is_held(self, location_id: str) -> bool:
+        """Return True if an IP address is being held for a Location."""
+        state: _DampingState | None = self._states.get(location_id)
+        return state is not None and state.task is not None
+
+    async def close(self) -> None:
+        """Cancel every pending held update."""
+        for state in self._states.values():
+            if state.task is not None:
+                state.task.cancel()
+                with contextlib.suppress(asyncio.CancelledError):
+                    await state.task
+                state.task = None
+            if state.held_future is not None:
+                state.held_future.cancel()
+                state.held_future = None
+
+    def _state(self, location_id: str) -> _DampingState:
+        state: _DampingState | None = self._states.get(location_id)
+        if state is None:
+            state = _DampingState()
+            self._states[location_id] = state
+            return state
+        now: float = time.monotonic()
+        if self.half_life > 0:
+            state.penalty *= 0.5 ** ((now - state.penalty_updated) / self.half_life)
+        state.penalty_updated = now
+        return state
+
+    async def _apply_when_allowed(self, location_id: str, apply: Callable[[Location, str], Awaitable[bool]]) -> None:
+        state: _DampingState = self._states[location_id]
+        while True:
+            delay: float = self.hold_time(location_id)
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+
+            location, ip_address = state.held_location, state.held_ip_address
+            state.applying = True
+            try:
+                applied: bool = await apply(location, ip_address)
+            finally:
+                state.applying = False
+
+            # Apply the IP address held while this one was applied, if any
+            if state.held_ip_address is None:
+                state.task = None
+                return
+            if state.held_ip_address != ip_address:
+                continue
+
+            if applied:
+                _resolve(state.held_future, applied=True)
+                state.held_location = None
+                state.held_ip_address = None
+                state.held_future = None
+                state.task = None
+                return
+            await asyncio.sleep(self.retry_delay)
+
+
+def _resolve(future: asyncio.Future[bool] | None, *, applied: bool) -> None:
+    if future is not None and not future.done():
+        future.set_result(applied)
+
+
+flap_damper: FlapDamper = FlapDamper(
+    min_interval=float(os.getenv("DAMPING_MIN_INTERVAL", "0")),
+    penalty=float(os.getenv("DAMPING_PENALTY", "0")),
+    suppress_limit=float(os.getenv("DAMPING_SUPPRESS_LIMIT", "2000")),
+    reuse_limit=float(os.getenv("DAMPING_REUSE_LIMIT", "750")),
+    half_life=float(os.getenv("DAMPING_HALF_LIFE", "900")),
+    retry_delay=float(os.getenv("DAMPING_RETRY_DELAY", "30")),
+)
@@ -0,0 +1,237 @@
+"""Module for applying DDNS updates to Microsoft Named Locations.
+
+This module contains the logic behind the DDNS route.  Updates are
+coalesced per Location, so concurrent check-ins for the same Location
+share one Graph read-then-patch, and a check-in with a different IP
+address waits for the running update and is applied after it.  Updates
+to Microsoft are rate limited per Location by the flap damper.  While
+Graph has a tenant backing off, or an app registration's circuit breaker
+is open, its routers get a "911" response so they retry later instead of
+adding to the load.
+
+Typical usage example:
+
+    status_code, content = await ddns_updater.submit(location, myip)
+
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+from typing import TYPE_CHECKING
+
+from fastapi import status
+
+from app_config import config_store
+from damping import flap_damper
+from graph import get_current_location_ip, graph_scheduler, set_named_location_ip
+from ip_cache import ip_cache
+from metrics import metrics
+
+if TYPE_CHECKING:
+    from location import Location
+
+
+class _Flight:
+    """The running update for one Location and the update queued behind it."""
+
+    def __init__(self, location: Location, ip_address: str, damped: bool) -> None:
+        self.location: Location = location
+        self.ip_address: str = ip_address
+        self.damped: bool = damped
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.pending_location: Location | None = None
+        self.pending_ip_address: str | None = None
+        self.pending_damped: bool = True
+        self.pending_future: asyncio.Future | None = None
+        self.task: asyncio.Task | None = None
+
+
+class DdnsUpdater:
+    """Single-flight coalescing of DDNS updates per Location.
+
+    Only one update runs per Location at a time.  A check-in for the IP
+    address being applied shares the running update.  A check-in for a
+    different IP address is queued behind it, and a newer check-in replaces
+    the queued one, so the last reported IP address is applied last.
+    Check-ins that were replaced get the result of the update that
+    replaced them.
+
+    """
+
+    def __init__(self) -> None:
+        """Initialize a DdnsUpdater with no updates running."""
+        self._flights: dict[str, _Flight] = {}
+
+    async def submit(self, location: Location, ip_address: str, *, damped: bool = True) -> tuple[int, str]:
+        """Apply a DDNS check-in, sharing or queueing behind running updates.
+
+        Args:
+            location:
+                The Location the router checked in for.
+            ip_address:
+                The IP address reported by the router.
+            damped:
+                False when applying an IP address the flap damper held back.
+
+        Returns:
+            Tuple of the HTTP status code and the DDNS response body.
+
+        """
+        flight: _Flight | None = self._flights.get(location.location_id)
+
+        if flight is None:
+            flight = _Flight(location, ip_address, damped)
+            self._flights[location.location_id] = flight
+            flight.task = asyncio.create_task(self._run(location.location_id, flight))
+            return await asyncio.shield(flight.future)
+
+        if flight.pending_future is None and flight.ip_address == ip_address:
+            return await asyncio.shield(flight.future)
+
+        if flight.pending_future is None:
+            flight.pending_future = asyncio.get_running_loop().create_future()
+        flight.pending_location = location
+        flight.pending_ip_address = ip_address
+        flight.pending_damped = damped
+        return await asyncio.shield(flight.pending_future)
+
+    async def _run(self, location_id: str, flight: _Flight) -> None:
+        while True:
+            try:
+                result: tuple[int, str] = await update_location_ip(
+                    flight.location,
+                    flight.ip_address,
+                    damped=flight.damped,
+                )
+            except Exception as e:  # noqa: BLE001
+                flight.future.set_exception(e)
+            else:
+                flight.future.set_result(result)
+
+            if flight.pending_future is None:
+                del self._flights[location_id]
+                return
+
+            flight.location = flight.pending_location
+            flight.ip_address = flight.pending_ip_address
+            flight.damped = flight.pending_damped
+            flight.future = flight.pending_future
+            flight.pending_location = None
+            flight.pending_ip_address = None
+            flight.pending_damped = True
+            flight.pending_future = None
+
+
+async def update_location_ip(location: Location, myip: str, *, damped: bool = True) -> tuple[int, str]:  # noqa: C901, PLR0911, PLR0912
+    """Check a reported IP address against Microsoft and update it if needed.
+
+    If the flap damper holds the Location down, the new IP address is stored
+    in the config and applied to Microsoft once the Location may be updated.
+    If Graph is throttling the Location's tenant, or its app registration's
+    circuit breaker is open, the router is answered with "911" so it tries
+    again later.
+
+    Args:
+        location:
+            The Location the router checked in for.
+        myip:
+            The IP address reported by the router.
+        damped:
+            False when applying an IP address the flap damper held back.
+
+    Returns:
+        Tuple of the HTTP status code and the DDNS response body.
+
+    """
+    logger: logging.Logger = logging.getLogger("uvicorn.error")
+
+    # If Microsoft was recently confirmed to already have this IP, respond No Change
+    if ip_cache.is_unchanged(location.location_id, myip):
+        if damped:
+            flap_damper.release(location.location_id)
+        return status.HTTP_200_OK, "nochg " + myip
+
+    # If this IP is already held back by the flap damper, it is in the config and will be applied, respond Good
+    if damped and flap_damper.held_ip(location.location_id) == myip:
+        return status.HTTP_200_OK, "good " + myip
+
+    # While Graph is throttling the tenant or the circuit is open, ask the router to try again later
+    if graph_scheduler.unavailable(location.tenant_id, location.client_id):
+        return status.HTTP_200_OK, "911"
+
+    # Get the current IP address for the Location from Microsoft
+    # An update finishing while it is read invalidates the cache, so the IP read is not cached then
+    since: int = ip_cache.generation
+    current_ip: str | None = await get_current_location_ip(location)
+
+    # Check the new IP received vs the configuration and Microsoft
+    # If current_ip from Microsoft is None, Error Out, or ask for a retry if Graph is unavailable
+    # If it is the same between the receive IP and Microsoft, respond No Change
+    # If the new IP doesn't match Microsoft, update the config and Microsoft with new IP
+    if current_ip is None:
+        if graph_scheduler.unavailable(location.tenant_id, location.client_id):
+            return status.HTTP_200_OK, "911"
+        return status.HTTP_400_BAD_REQUEST, "Invalid Data"
+
+    ip_cache.set(location.location_id, current_ip, since=since)
+
+    if current_ip == myip:
+        if damped:
+            flap_damper.release(location.location_id)
+        return status.HTTP_200_OK, "nochg " + myip
+
+    location = await config_store.record_ip(location.location_id, myip, source="ddns" if damped else "held")
+    if location is None:
+        return status.HTTP_400_BAD_REQUEST, "Invalid Data"
+
+    # If the Location is flapping or was updated too recently, hold the new IP back
+    if damped:
+        flap_damper.record_change(location.location_id, myip)
+        if flap_damper.hold_time(location.location_id) > 0:
+            logger.info("Holding IP: %s for Location: %s", myip, location.display_name)
+            flap_damper.hold(location, myip, _apply_held_ip)
+            return status.HTTP_200_OK, "good " + myip
+
+    resp = await set_named_location_ip(location, myip)
+    if not resp:
+        if graph_scheduler.unavailable(location.tenant_id, location.client_id):
+            logger.warning("Graph is unavailable, will update Location: %s on a later check-in", location.display_name)
+            return status.HTTP_200_OK, "911"
+        logger.error("Updating IP on Microsoft Failed", extra={"location_id": location.location_id, "ip_address": myip})
+        return status.HTTP_500_INTERNAL_SERVER_ERROR, "Internal Server Error"
+
+    flap_damper.record_update(location.location_id)
+    return status.HTTP_200_OK, "good " + myip
+
+
+async def _apply_held_ip(location: Location, ip_address: str) -> bool:
+    """Apply an IP address the flap damper held back, returning whether Microsoft now has it."""
+    logger: logging.Logger = logging.getLogger("uvicorn.error")
+
+    try:
+        status_code, content = await ddns_updater.submit(location, ip_address, damped=False)
+    except Exception:
+        logger.exception("Applying held IP: %s for Location: %s failed", ip_address, location.display_name)
+        return False
+    if status_code == status.HTTP_200_OK and content.startswith(("good", "nochg")):
+        return True
+    logger.warning(
+        "Applying held IP: %s for Location: %s failed with %s, retrying in %.0f seconds",
+        ip_address,
+        location.display_name,
+        content,
+        flap_damper.retry_delay,
+    )
+    return False
+
+
+ddns_updater: DdnsUpdater = DdnsUpdater()
+
+metrics.callback(
+    "ddns_updates_in_flight",
+    "Locations with a DDNS update in progress.",
+    "gauge",
+    lambda: len(ddns_updater._flights),  # noqa: SLF001
+)
@@ -4,42 +4,203 @@ This module contains all the functions for interfacing with the Graph API.
 It includes functions for updating the IP addresses of Named Locations
 previously configured.
 
+Graph clients are pooled per tenant and app registration, so the credential
+and its cached access token, and the HTTP connection pool, are reused
+between calls instead of being built again for every request.  The Graph
+SDK itself is only imported when it is first needed, or in the background
+after startup, so the server starts listening quickly.  The DDNS path can
+instead send its Named Location GET and PATCH as raw JSON over one shared
+HTTP/2 connection pool, skipping the SDK's request pipeline.
+
+Requests to Graph go through a per tenant scheduler, which spaces them out
+with a token bucket and, when Graph throttles the tenant, backs the whole
+tenant off for the Retry-After time or a jittered exponential delay before
+retrying.  A circuit breaker per app registration stops sending requests
+for a while after repeated authentication or server failures, so a
+registration with an expired secret fails fast instead of trying again on
+every check-in.
+
 Typical usage example:
 
     graph: Graph = Graph(azure_settings)
+    graph: Graph = graph_pool.get(location)
 
 
 """
 
 from __future__ import annotations
 
+import asyncio
+import contextlib
+import functools
+import hashlib
 import logging
-from typing import TYPE_CHECKING
+import os
+import random
+import time
+from http import HTTPStatus
+from typing import TYPE_CHECKING, TypeVar
 
-from azure.core.exceptions import ClientAuthenticationError
-from azure.identity.aio import ClientSecretCredential
-from msgraph import GraphServiceClient
-from msgraph.generated.models.i_pv4_cidr_range import IPv4CidrRange
-from msgraph.generated.models.ip_named_location import IpNamedLocation
-from msgraph.generated.models.o_data_errors.o_data_error import ODataError
+import httpx
+from azure.core.exceptions import AzureError, ClientAuthenticationError
 
+from ip_cache import ip_cache
 from location import Location
+from metrics import graph_call, graph_errors, metrics
 
 if TYPE_CHECKING:
+    from collections.abc import Awaitable, Callable, Iterator
     from configparser import SectionProxy
 
+    from azure.core.credentials import AccessToken
+    from azure.identity.aio import ClientSecretCredential
+    from msgraph import GraphServiceClient
+    from msgraph.generated.models.i_pv4_cidr_range import IPv4CidrRange
+    from msgraph.generated.models.ip_named_location import IpNamedLocation
+    from msgraph.generated.models.named_location import NamedLocation
     from msgraph.generated.models.named_location_collection_response import NamedLocationCollectionResponse
+    from msgraph.generated.models.o_data_errors.o_data_error import ODataError
+
+GRAPH_SCOPE: str = "https://graph.microsoft.com/.default"
+
+# Graph endpoint, for a national cloud or a local test server.  Tokens come from AZURE_AUTHORITY_HOST.
+GRAPH_HOST: str = os.getenv("GRAPH_HOST", "https://graph.microsoft.com").rstrip("/")
+
+# Refresh access tokens this many seconds before they expire.
+TOKEN_REFRESH_MARGIN: int = 240
+
+# Wait this many seconds before retrying a failed background token refresh.
+TOKEN_RETRY_DELAY: int = 60
+
+# "sdk" sends the DDNS Named Location GET and PATCH through the Graph SDK, "httpx" sends raw JSON.
+GRAPH_TRANSPORT: str = os.getenv("GRAPH_TRANSPORT", "sdk").lower()
+
+# Connection pool of the raw JSON transport, shared by every tenant.
+GRAPH_MAX_CONNECTIONS: int = int(os.getenv("GRAPH_MAX_CONNECTIONS", "100"))
+GRAPH_MAX_KEEPALIVE: int = int(os.getenv("GRAPH_MAX_KEEPALIVE", "20"))
+GRAPH_KEEPALIVE_EXPIRY: float = float(os.getenv("GRAPH_KEEPALIVE_EXPIRY", "60"))
+GRAPH_TIMEOUT: float = float(os.getenv("GRAPH_TIMEOUT", "30"))
+
+# Only ask Graph for the Named Location fields this application reads.
+NAMED_LOCATION_FIELDS: list[str] = ["id", "displayName", "ipRanges", "isTrusted"]
+
+# Page size used when scanning a tenant's Named Locations.
+NAMED_LOCATION_PAGE_SIZE: int = 100
+
+# Graph accepts at most 20 requests in one JSON batch.
+BATCH_MAX_REQUESTS: int = 20
+
+# Number of times throttled or failed requests in a batch are sent again.
+BATCH_MAX_RETRIES: int = 3
+
+# Requests per second allowed to each tenant, and how many may be sent in a burst.  0 disables the limit.
+GRAPH_RATE_LIMIT: float = float(os.getenv("GRAPH_RATE_LIMIT", "10"))
+GRAPH_BURST: int = int(os.getenv("GRAPH_BURST", "20"))
+
+# Number of times a throttled Graph request is sent again.
+GRAPH_MAX_RETRIES: int = int(os.getenv("GRAPH_MAX_RETRIES", "3"))
+
+# First and largest backoff, in seconds, when Graph throttles without a Retry-After.
+GRAPH_BACKOFF_BASE: float = 1.0
+GRAPH_BACKOFF_MAX: float = float(os.getenv("GRAPH_BACKOFF_MAX", "60"))
+
+# Consecutive authentication or server failures that open an app registration's circuit breaker.
+CIRCUIT_FAILURE_THRESHOLD: int = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5"))
+
+# Seconds an open circuit breaker waits before letting a trial request through.
+CIRCUIT_RESET_TIMEOUT: float = float(os.getenv("CIRCUIT_RESET_TIMEOUT", "60"))
+
+# Graph responses that mean the tenant should back off and retry.
+RETRYABLE_STATUS_CODES: frozenset[int] = frozenset(
+    {HTTPStatus.TOO_MANY_REQUESTS, HTTPStatus.SERVICE_UNAVAILABLE, HTTPStatus.GATEWAY_TIMEOUT},
+)
+
+
+class _LazySdk:
+    """The parts of the Graph SDK used by this module, imported on first use.
+
+    Importing msgraph loads all of its generated request builders, which
+    takes seconds, so it is left out of this module's imports.  The SDK is
+    imported by the first request that needs it, or by
+    GraphClientPool.start_preload() in the background once the server is
+    listening.  The credential class is imported on its own, as the raw
+    JSON transport only needs a token.
+    """
+
+    def __getattr__(self, name: str) -> object:
+        if name == "ClientSecretCredential":
+            from azure.identity.aio import ClientSecretCredential  # noqa: PLC0415
+
+            self.ClientSecretCredential = ClientSecretCredential
+            return ClientSecretCredential
+        self.load()
+        try:
+            return self.__dict__[name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+    @property
+    def odata_errors(self) -> tuple[type[Exception], ...]:
+        """ODataError for except clauses, without importing the SDK.
+
+        Until the SDK is imported nothing can have raised an ODataError, so
+        the tuple is empty and catches nothing.
+        """
+        odata_error: type[Exception] | None = self.__dict__.get("ODataError")
+        return () if odata_error is None else (odata_error,)
+
+    def load(self) -> None:
+        """Import the SDK, if it was not imported yet."""
+        if "ODataError" in self.__dict__:
+            return
+        from azure.identity.aio import ClientSecretCredential  # noqa: PLC0415
+        from kiota_abstractions.base_request_configuration import RequestConfiguration  # noqa: PLC0415
+        from kiota_authentication_azure.azure_identity_authentication_provider import (  # noqa: PLC0415
+            AzureIdentityAuthenticationProvider,
+        )
+        from kiota_http.middleware.options import RetryHandlerOption  # noqa: PLC0415
+        from msgraph import GraphRequestAdapter, GraphServiceClient  # noqa: PLC0415
+        from msgraph.generated.identity.conditional_access.named_locations import (  # noqa: PLC0415
+            named_locations_request_builder,
+        )
+        from msgraph.generated.identity.conditional_access.named_locations.item import (  # noqa: PLC0415
+            named_location_item_request_builder,
+        )
+        from msgraph.generated.models.i_pv4_cidr_range import IPv4CidrRange  # noqa: PLC0415
+        from msgraph.generated.models.ip_named_location import IpNamedLocation  # noqa: PLC0415
+        from msgraph.generated.models.o_data_errors.o_data_error import ODataError  # noqa: PLC0415
+        from msgraph_core import GraphClientFactory  # noqa: PLC0415
+
+        vars(self).update(
+            AzureIdentityAuthenticationProvider=AzureIdentityAuthenticationProvider,
+            ClientSecretCredential=ClientSecretCredential,
+            GraphClientFactory=GraphClientFactory,
+            GraphRequestAdapter=GraphRequestAdapter,
+            GraphServiceClient=GraphServiceClient,
+            IPv4CidrRange=IPv4CidrRange,
+            IpNamedLocation=IpNamedLocation,
+            NamedLocationItemRequestBuilder=named_location_item_request_builder.NamedLocationItemRequestBuilder,
+            NamedLocationsRequestBuilder=named_locations_request_builder.NamedLocationsRequestBuilder,
+            RequestConfiguration=RequestConfiguration,
+            RetryHandlerOption=RetryHandlerOption,
+            ODataError=ODataError,
+        )
+
+
+_sdk: _LazySdk = _LazySdk()
 
 
 class Graph:
     """Graph class used for communicating with Microsoft Graph API.
 
     This class does all the setup and permissions for connecting to
-    the Graph API.
+    the Graph API.  The SDK's HTTP client and GraphServiceClient are built,
+    importing the SDK, the first time a request needs them.
 
     Attributes:
         settings: SectionProxy
         client_credential: ClientSecretCredential
+        http_client: httpx.AsyncClient
         app_client: GraphServiceClient
 
 
@@ -47,7 +208,6 @@ class Graph:
 
     settings: SectionProxy
     client_credential: ClientSecretCredential
-    app_client: GraphServiceClient
 
     def __init__(self, config: SectionProxy) -> None:
         """Initialize a new Graph object given SectionProxy.
@@ -68,8 +228,743 @@ class Graph:
         tenant_id: str = self.settings["tenantId"]
         client_secret: str = self.settings["clientSecret"]
 
-        self.client_credential = ClientSecretCredential(tenant_id, client_id, client_secret)
-        self.app_client = GraphServiceClient(self.client_credential)
+        self.client_credential = _sdk.ClientSecretCredential(tenant_id, client_id, client_secret)
+
+    @functools.cached_property
+    def http_client(self) -> httpx.AsyncClient:
+        """The SDK's HTTP client with its middleware, used by the SDK and $batch requests."""
+        # Retries are left to the tenant scheduler, so the whole tenant backs off together.
+        return _sdk.GraphClientFactory.create_with_default_middleware(
+            host=GRAPH_HOST,
+            options={_sdk.RetryHandlerOption.get_key(): _sdk.RetryHandlerOption(max_retries=0, should_retry=False)},
+        )
+
+    @functools.cached_property
+    def app_client(self) -> GraphServiceClient:
+        """The GraphServiceClient for SDK requests."""
+        auth_provider = _sdk.AzureIdentityAuthenticationProvider(
+            _SharedCredential(self.client_credential),
+            scopes=[GRAPH_SCOPE],
+        )
+        request_adapter = _sdk.GraphRequestAdapter(auth_provider, self.http_client)
+        return _sdk.GraphServiceClient(request_adapter=request_adapter)
+
+    async def close(self) -> None:
+        """Close the HTTP connection pool, if it was built, and the credential."""
+        if "http_client" in vars(self):
+            await self.http_client.aclose()
+        await self.client_credential.close()
+
+
+class _SharedCredential:
+    """Credential handed to kiota that stays open.
+
+    kiota closes its credential after every token request it makes, which
+    would close the pooled credential and its HTTP transport while other
+    requests and the token refresher still use them.  The pooled credential
+    is closed by Graph.close() instead.
+    """
+
+    def __init__(self, credential: ClientSecretCredential) -> None:
+        self._credential = credential
+
+    async def get_token(self, *scopes: str, **kwargs: object) -> AccessToken:
+        return await self._credential.get_token(*scopes, **kwargs)
+
+    async def close(self) -> None:
+        pass
+
+
+class GraphClientPool:
+    """Pool of Graph objects shared between requests.
+
+    Graph objects are keyed by tenant ID, client ID and a hash of the client
+    secret, so each app registration gets one credential, with its cached
+    access token, and one HTTP connection pool.  Once start_refresh() is
+    called, a background task per client refreshes the access token before
+    it expires, keeping token requests off the request path.  Until then,
+    tokens are fetched when a request needs one.
+
+    """
+
+    def __init__(self) -> None:
+        """Initialize an empty GraphClientPool."""
+        self._clients: dict[tuple[str, str, str], Graph] = {}
+        self._refreshers: dict[tuple[str, str, str], asyncio.Task] = {}
+        self._refresh: bool = False
+        self._preloader: asyncio.Task | None = None
+
+    @staticmethod
+    def key(location: Location) -> tuple[str, str, str]:
+        """Return the pool key for the app registration of a Location.
+
+        Args:
+            location:
+                The Location whose credentials are used.
+
+        Returns:
+            Tuple of tenant ID, client ID and the SHA-256 of the client secret.
+
+        """
+        secret_hash: str = hashlib.sha256(str(location.client_secret).encode("utf-8")).hexdigest()
+        return (str(location.tenant_id), str(location.client_id), secret_hash)
+
+    def get(self, location: Location) -> Graph:
+        """Return the pooled Graph object for a Location, creating it if needed.
+
+        Args:
+            location:
+                The Location whose credentials are used.
+
+        Returns:
+            A Graph object shared by every Location of the same app registration.
+
+        """
+        key = self.key(location)
+        graph: Graph | None = self._clients.get(key)
+        if graph is None:
+            azure_settings: dict[str, str] = {
+                "clientId": location.client_id,
+                "tenantId": location.tenant_id,
+                "clientSecret": location.client_secret,
+            }
+            graph = Graph(azure_settings)
+            self._clients[key] = graph
+            if self._refresh:
+                self._refreshers[key] = asyncio.create_task(self._refresh_token(key, graph))
+        return graph
+
+    def warm(self, locations: list[Location]) -> None:
+        """Create clients for every Location, fetching their tokens if the refresh is started.
+
+        Args:
+            locations:
+                The configured Locations, generally from the config file.
+
+        """
+        for location in locations:
+            self.get(location)
+
+    def start_preload(self, locations: list[Location]) -> None:
+        """Import the Graph SDK in a worker thread, then warm the clients for every Location.
+
+        Args:
+            locations:
+                The configured Locations, generally from the config file.
+
+        """
+        if self._preloader is None:
+            self._preloader = asyncio.create_task(self._preload(locations))
+
+    def start_refresh(self) -> None:
+        """Start refreshing the access token of every pooled client, and of clients created later."""
+        self._refresh = True
+        for key, graph in self._clients.items():
+            if key not in self._refreshers:
+                self._refreshers[key] = asyncio.create_task(self._refresh_token(key, graph))
+
+    async def stop_refresh(self) -> None:
+        """Stop the token refresh tasks."""
+        self._refresh = False
+        for task in self._refreshers.values():
+            task.cancel()
+        for task in self._refreshers.values():
+            with contextlib.suppress(asyncio.CancelledError):
+                await task
+        self._refreshers.clear()
+
+    async def close(self) -> None:
+        """Stop the token refresh tasks and close every pooled client."""
+        if self._preloader is not None:
+            self._preloader.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._preloader
+            self._preloader = None
+        await self.stop_refresh()
+        for graph in self._clients.values():
+            await graph.close()
+        self._clients.clear()
+
+    async def _preload(self, locations: list[Location]) -> None:
+        logger: logging.Logger = logging.getLogger("uvicorn.error")
+
+        started: float = time.perf_counter()
+        await asyncio.to_thread(_sdk.load)
+        logger.info("Loaded the Graph SDK in %.2f seconds", time.perf_counter() - started)
+        self.warm(locations)
+
+    async def _refresh_token(self, key: tuple[str, str, str], graph: Graph) -> None:
+        logger: logging.Logger = logging.getLogger("uvicorn.error")
+
+        while True:
+            try:
+                # Ask for a CAE token, as kiota does, so requests find it in the credential's cache.
+                with graph_call(key[0], "token"):
+                    token = await graph.client_credential.get_token(GRAPH_SCOPE, enable_cae=True)
+            except AzureError:
+                logger.warning("Unable to get an access token for tenant_id : %s, client_id : %s", key[0], key[1])
+                delay = TOKEN_RETRY_DELAY
+            else:
+                delay = max(token.expires_on - int(time.time()) - TOKEN_REFRESH_MARGIN, TOKEN_RETRY_DELAY)
+            await asyncio.sleep(delay)
+
+
+graph_pool: GraphClientPool = GraphClientPool()
+
+
+class JsonTransport:
+    """Raw JSON Graph requests on one HTTP/2 connection pool shared by every tenant.
+
+    Used for the Named Location GET and PATCH of the DDNS path when
+    GRAPH_TRANSPORT is "httpx", instead of the Graph SDK's request pipeline.
+    Access tokens still come from the pooled credentials.  Errors are raised
+    as httpx.HTTPStatusError, which the scheduler retries and the circuit
+    breakers count like the SDK's ODataError.
+
+    Attributes:
+        enabled: bool
+            Whether the DDNS path uses this transport
+        limits: httpx.Limits
+            Connection pool limits of the shared client
+        timeout: float
+            Seconds before a request times out
+
+    """
+
+    enabled: bool
+    limits: httpx.Limits
+    timeout: float
+
+    def __init__(self, *, enabled: bool, limits: httpx.Limits, timeout: float) -> None:
+        """Initialize a JsonTransport, creating its client on first use.
+
+        Args:
+            enabled:
+                Whether the DDNS path uses this transport
+            limits:
+                Connection pool limits of the shared client
+            timeout:
+                Seconds before a request times out
+
+        """
+        self.enabled = enabled
+        self.limits = limits
+        self.timeout = timeout
+        self._client: httpx.AsyncClient | None = None
+
+    def client(self) -> httpx.AsyncClient:
+        """Return the shared client, creating it if needed."""
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                base_url=GRAPH_HOST + "/v1.0",
+                http2=True,
+                limits=self.limits,
+                timeout=self.timeout,
+            )
+        return self._client
+
+    async def request(
+        self,
+        graph: Graph,
+        method: str,
+        path: str,
+        *,
+        params: dict[str, str] | None = None,
+        body: dict | None = None,
+    ) -> dict | None:
+        """Send a Graph request with the access token of graph's app registration.
+
+        Args:
+            graph:
+                The pooled Graph object whose credential is used.
+            method:
+                The HTTP method.
+            path:
+                The path below the Graph version, for example "/identity/conditionalAccess/namedLocations".
+            params:
+                Query parameters.
+            body:
+                JSON request body.
+
+        Returns:
+            The JSON response body, or None if it is empty.
+
+        Raises:
+            ClientAuthenticationError: The credential could not get a token.
+            httpx.HTTPStatusError: Graph returned an error.
+            httpx.HTTPError: The request could not be sent.
+
+        """
+        token: AccessToken = await graph.client_credential.get_token(GRAPH_SCOPE, enable_cae=True)
+        response: httpx.Response = await self.client().request(
+            method,
+            path,
+            params=params,
+            json=body,
+            headers={"Authorization": "Bearer " + token.token},
+        )
+        response.raise_for_status()
+        return response.json() if response.content else None
+
+    async def close(self) -> None:
+        """Close the shared client's connections."""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+json_transport: JsonTransport = JsonTransport(
+    enabled=GRAPH_TRANSPORT == "httpx",
+    limits=httpx.Limits(
+        max_connections=GRAPH_MAX_CONNECTIONS,
+        max_keepalive_connections=GRAPH_MAX_KEEPALIVE,
+        keepalive_expiry=GRAPH_KEEPALIVE_EXPIRY,
+    ),
+    timeout=GRAPH_TIMEOUT,
+)
+
+T = TypeVar("T")
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of sending a request while an app registration's circuit breaker is open."""
+
+    def __init__(self, tenant_id: str, client_id: str, retry_in: float) -> None:
+        """Initialize the error for the app registration whose breaker is open."""
+        super().__init__(f"Circuit open for tenant_id : {tenant_id}, client_id : {client_id}, retry in {retry_in:.0f}s")
+        self.tenant_id = tenant_id
+        self.client_id = client_id
+        self.retry_in = retry_in
+
+
+class CircuitBreaker:
+    """Circuit breaker for one app registration's Graph requests.
+
+    The breaker is closed while requests succeed.  After failure_threshold
+    consecutive authentication, connection or server failures it opens, and requests
+    fail fast with CircuitOpenError.  Once reset_timeout seconds have passed
+    it is half open, and a single trial request is let through: if it
+    succeeds the breaker closes, otherwise it opens again.
+
+    Attributes:
+        state: str
+            "closed", "open" or "half_open"
+        failures: int
+            Consecutive failures
+        last_error: str
+            Description of the last failure
+
+    """
+
+    state: str
+    failures: int
+    last_error: str
+
+    def __init__(self, failure_threshold: int, reset_timeout: float) -> None:
+        """Initialize a closed breaker.
+
+        Args:
+            failure_threshold:
+                Consecutive failures that open the breaker
+            reset_timeout:
+                Seconds the breaker stays open before a trial request
+
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.last_error = ""
+        self._opened_at: float = 0.0
+        self._trial: bool = False
+
+    def retry_in(self) -> float:
+        """Return how many seconds until an open breaker lets a trial request through."""
+        if self.state != "open":
+            return 0.0
+        return max(0.0, self._opened_at + self.reset_timeout - time.monotonic())
+
+    def allow(self) -> bool:
+        """Return whether a request may be sent now, starting a trial if one is due."""
+        if self.state == "open" and self.retry_in() == 0:
+            self.state = "half_open"
+        if self.state == "half_open":
+            if self._trial:
+                return False
+            self._trial = True
+        return self.state != "open"
+
+    def record_success(self) -> None:
+        """Close the breaker after a request that reached Graph and was answered."""
+        self.state = "closed"
+        self.failures = 0
+        self._trial = False
+
+    def record_failure(self, error: str) -> bool:
+        """Count an authentication, connection or server failure.
+
+        Returns:
+            True if this failure opened the breaker.
+
+        """
+        self.failures += 1
+        self.last_error = error
+        opened: bool = self.state == "half_open" or (self.state == "closed" and self.failures >= self.failure_threshold)
+        if opened:
+            self.state = "open"
+            self._opened_at = time.monotonic()
+        self._trial = False
+        return opened
+
+    def release(self) -> None:
+        """End a trial request that neither succeeded nor failed, so another may be tried."""
+        self._trial = False
+
+    def status(self) -> dict[str, object]:
+        """Return the breaker state for display."""
+        return {
+            "state": self.state,
+            "failures": self.failures,
+            "retry_in": round(self.retry_in()),
+            "last_error": self.last_error,
+        }
+
+
+class TenantThrottle:
+    """Token bucket and backoff state for one tenant's Graph requests.
+
+    Attributes:
+        rate: float
+            Requests per second the bucket refills with, 0 for no limit
+        burst: int
+            Size of the bucket
+        tokens: float
+            Requests that may be sent now
+        failures: int
+            Throttled responses since the last successful request
+        throttled: int
+            Throttled responses in total
+
+    """
+
+    rate: float
+    burst: int
+    tokens: float
+    failures: int
+    throttled: int
+
+    def __init__(self, rate: float, burst: int) -> None:
+        """Initialize a full bucket without any backoff.
+
+        Args:
+            rate:
+                Requests per second the bucket refills with, 0 for no limit
+            burst:
+                Size of the bucket
+
+        """
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.failures = 0
+        self.throttled = 0
+        self._updated: float = time.monotonic()
+        self._backoff_until: float = 0.0
+
+    def backoff_remaining(self) -> float:
+        """Return how many seconds the tenant is still backing off for."""
+        return max(0.0, self._backoff_until - time.monotonic())
+
+    async def acquire(self, cost: int = 1) -> None:
+        """Wait until the tenant is not backing off and cost requests may be sent."""
+        while True:
+            delay: float = self.backoff_remaining()
+            if delay == 0:
+                if self.rate <= 0:
+                    return
+                now: float = time.monotonic()
+                self.tokens = min(float(self.burst), self.tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                needed: int = min(cost, self.burst)
+                if self.tokens >= needed:
+                    self.tokens -= cost
+                    return
+                delay = (needed - self.tokens) / self.rate
+            await asyncio.sleep(delay)
+
+    def back_off(self, retry_after: float | None) -> float:
+        """Back the tenant off after a throttled response.
+
+        Args:
+            retry_after:
+                Seconds from the Retry-After header, or None if there was none.
+
+        Returns:
+            The seconds the tenant backs off for.
+
+        """
+        self.failures += 1
+        self.throttled += 1
+        delay: float = min(GRAPH_BACKOFF_MAX, GRAPH_BACKOFF_BASE * 2 ** (self.failures - 1))
+        delay = random.uniform(delay / 2, delay)  # noqa: S311
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        self._backoff_until = max(self._backoff_until, time.monotonic() + delay)
+        return delay
+
+    def succeeded(self) -> None:
+        """Record a request that was not throttled."""
+        self.failures = 0
+
+    def state(self) -> dict[str, float]:
+        """Return the bucket and backoff state for display."""
+        return {
+            "tokens": round(max(self.tokens, 0.0), 1),
+            "backoff": round(self.backoff_remaining(), 1),
+            "failures": self.failures,
+            "throttled": self.throttled,
+        }
+
+
+class GraphScheduler:
+    """Sends Graph requests through a TenantThrottle per tenant and a CircuitBreaker per app registration.
+
+    Attributes:
+        rate: float
+            Requests per second allowed to each tenant, 0 for no limit
+        burst: int
+            Requests each tenant may send in a burst
+        max_retries: int
+            Number of times a throttled request is sent again
+        failure_threshold: int
+            Consecutive failures that open an app registration's circuit breaker
+        reset_timeout: float
+            Seconds an open circuit breaker waits before a trial request
+
+    """
+
+    rate: float
+    burst: int
+    max_retries: int
+    failure_threshold: int
+    reset_timeout: float
+
+    def __init__(
+        self,
+        *,
+        rate: float,
+        burst: int,
+        max_retries: int,
+        failure_threshold: int,
+        reset_timeout: float,
+    ) -> None:
+        """Initialize a scheduler without any tenants.
+
+        Args:
+            rate:
+                Requests per second allowed to each tenant, 0 for no limit
+            burst:
+                Requests each tenant may send in a burst
+            max_retries:
+                Number of times a throttled request is sent again
+            failure_threshold:
+                Consecutive failures that open an app registration's circuit breaker
+            reset_timeout:
+                Seconds an open circuit breaker waits before a trial request
+
+        """
+        self.rate = rate
+        self.burst = burst
+        self.max_retries = max_retries
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._tenants: dict[str, TenantThrottle] = {}
+        self._breakers: dict[tuple[str, str], CircuitBreaker] = {}
+
+    def tenant(self, tenant_id: str) -> TenantThrottle:
+        """Return the TenantThrottle for a tenant, creating it if needed."""
+        throttle: TenantThrottle | None = self._tenants.get(tenant_id)
+        if throttle is None:
+            throttle = self._tenants[tenant_id] = TenantThrottle(self.rate, self.burst)
+        return throttle
+
+    def backoff_remaining(self, tenant_id: str) -> float:
+        """Return how many seconds a tenant is still backing off for."""
+        throttle: TenantThrottle | None = self._tenants.get(tenant_id)
+        return throttle.backoff_remaining() if throttle is not None else 0.0
+
+    def breaker(self, tenant_id: str, client_id: str) -> CircuitBreaker:
+        """Return the CircuitBreaker for an app registration, creating it if needed."""
+        breaker: CircuitBreaker | None = self._breakers.get((tenant_id, client_id))
+        if breaker is None:
+            breaker = self._breakers[tenant_id, client_id] = CircuitBreaker(self.failure_threshold, self.reset_timeout)
+        return breaker
+
+    def unavailable(self, tenant_id: str, client_id: str) -> bool:
+        """Return whether requests for an app registration would wait on a backoff or fail fast."""
+        breaker: CircuitBreaker | None = self._breakers.get((tenant_id, client_id))
+        return self.backoff_remaining(tenant_id) > 0 or (breaker is not None and breaker.retry_in() > 0)
+
+    def states(self) -> dict[str, dict[str, float]]:
+        """Return the throttle state of every tenant that has made a request."""
+        return {tenant_id: throttle.state() for tenant_id, throttle in self._tenants.items()}
+
+    def breaker_states(self) -> dict[tuple[str, str], dict[str, object]]:
+        """Return the circuit breaker state of every app registration that has made a request."""
+        return {key: breaker.status() for key, breaker in self._breakers.items()}
+
+    async def call(self, graph: Graph, operation: str, request: Callable[[], Awaitable[T]]) -> T:
+        """Send a Graph request, retrying it while Graph throttles the tenant.
+
+        Authentication failures, connection failures and server errors are
+        counted by the app registration's circuit breaker, and while it is open the request is
+        not sent at all.
+
+        Args:
+            graph:
+                The pooled Graph object of the app registration making the request.
+            operation:
+                The kind of request, for metrics, for example "get" or "patch".
+            request:
+                Function making the request, called again for each retry.
+
+        Returns:
+            The result of request().
+
+        Raises:
+            CircuitOpenError: The app registration's circuit breaker is open.
+            ClientAuthenticationError: The credential could not get a token.
+            AzureError: The credential could not reach the token endpoint.
+            httpx.TransportError: Graph could not be reached.
+            ODataError: Graph returned an error, or still throttled the request after the retries.
+            httpx.HTTPStatusError: The same, for requests sent by the raw JSON transport.
+
+        """
+        with self.guard(graph):
+            return await self._send(graph.settings["tenantId"], operation, request)
+
+    @contextlib.contextmanager
+    def guard(self, graph: Graph) -> Iterator[None]:
+        """Run a block of Graph requests through the app registration's circuit breaker.
+
+        Raises:
+            CircuitOpenError: The circuit breaker is open, the block is not run.
+
+        """
+        tenant_id: str = graph.settings["tenantId"]
+        client_id: str = graph.settings["clientId"]
+        breaker: CircuitBreaker = self.breaker(tenant_id, client_id)
+        if not breaker.allow():
+            raise CircuitOpenError(tenant_id, client_id, breaker.retry_in())
+        try:
+            yield
+        except ClientAuthenticationError as e:
+            _record_failure(breaker, tenant_id, client_id, "Authentication failed: " + str(e.message))
+            raise
+        except (AzureError, httpx.TransportError) as e:
+            _record_failure(breaker, tenant_id, client_id, "Unable to reach Graph: " + str(e))
+            raise
+        except (*_sdk.odata_errors, httpx.HTTPStatusError) as e:
+            status_code: int | None = _error_status(e)
+            if _is_outage(status_code):
+                _record_failure(breaker, tenant_id, client_id, f"Graph returned {status_code}")
+            raise
+        finally:
+            breaker.release()
+        breaker.record_success()
+
+    async def _send(self, tenant_id: str, operation: str, request: Callable[[], Awaitable[T]]) -> T:
+        """Send a Graph request through the tenant's throttle, retrying it while Graph throttles the tenant."""
+        logger: logging.Logger = logging.getLogger("uvicorn.error")
+
+        throttle: TenantThrottle = self.tenant(tenant_id)
+        attempt: int = 0
+        while True:
+            await throttle.acquire()
+            try:
+                with graph_call(tenant_id, operation):
+                    result: T = await request()
+            except (*_sdk.odata_errors, httpx.HTTPStatusError) as e:
+                if _error_status(e) not in RETRYABLE_STATUS_CODES:
+                    raise
+                delay: float = throttle.back_off(_retry_after(_error_headers(e)))
+                if attempt == self.max_retries:
+                    raise
+                attempt += 1
+                logger.warning("Graph throttled tenant_id : %s, retrying in %.1f seconds", tenant_id, delay)
+                continue
+            throttle.succeeded()
+            return result
+
+
+def _error_status(error: ODataError | httpx.HTTPStatusError) -> int | None:
+    """Return the HTTP status of a Graph error from either transport."""
+    return error.response.status_code if isinstance(error, httpx.HTTPStatusError) else error.response_status_code
+
+
+def _error_headers(error: ODataError | httpx.HTTPStatusError) -> dict[str, str] | None:
+    """Return the response headers of a Graph error from either transport."""
+    return dict(error.response.headers) if isinstance(error, httpx.HTTPStatusError) else error.response_headers
+
+
+def _is_outage(status_code: int | None) -> bool:
+    """Return whether a Graph error status counts against the circuit breaker."""
+    return status_code is not None and (
+        status_code in {HTTPStatus.UNAUTHORIZED, HTTPStatus.FORBIDDEN}
+        or status_code >= HTTPStatus.INTERNAL_SERVER_ERROR
+    )
+
+
+def _record_failure(breaker: CircuitBreaker, tenant_id: str, client_id: str, failure: str) -> None:
+    """Count a failure against a circuit breaker, logging when it opens."""
+    if breaker.record_failure(failure):
+        logger: logging.Logger = logging.getLogger("uvicorn.error")
+        logger.warning("Opening circuit for tenant_id : %s, client_id : %s, %s", tenant_id, client_id, failure)
+
+
+def _retry_after(headers: dict[str, str] | None) -> float | None:
+    """Return the seconds in a Retry-After header, or None if there is none."""
+    for name, value in (headers or {}).items():
+        if name.lower() == "retry-after":
+            try:
+                return float(value)
+            except (TypeError, ValueError):
+                return None
+    return None
+
+
+graph_scheduler: GraphScheduler = GraphScheduler(
+    rate=GRAPH_RATE_LIMIT,
+    burst=GRAPH_BURST,
+    max_retries=GRAPH_MAX_RETRIES,
+    failure_threshold=CIRCUIT_FAILURE_THRESHOLD,
+    reset_timeout=CIRCUIT_RESET_TIMEOUT,
+)
+
+metrics.callback(
+    "ddns_graph_backoff_seconds",
+    "Seconds each tenant is still backing off from Graph throttling.",
+    "gauge",
+    lambda: {(tenant_id,): state["backoff"] for tenant_id, state in graph_scheduler.states().items()},
+    ("tenant",),
+)
+metrics.callback(
+    "ddns_graph_throttled_total",
+    "Throttled responses from Graph, by tenant.",
+    "counter",
+    lambda: {(tenant_id,): state["throttled"] for tenant_id, state in graph_scheduler.states().items()},
+    ("tenant",),
+)
+metrics.callback(
+    "ddns_graph_circuit_open",
+    "Whether each app registration's circuit breaker is open (1), half open (0.5) or closed (0).",
+    "gauge",
+    lambda: {
+        key: {"open": 1, "half_open": 0.5}.get(str(state["state"]), 0)
+        for key, state in graph_scheduler.breaker_states().items()
+    },
+    ("tenant", "client"),
+)
 
 
 async def get_current_location_ip(location: Location) -> str | None:
@@ -89,45 +984,31 @@ async def get_current_location_ip(location: Location) -> str | None:
     """
     logger: logging.Logger = logging.getLogger("uvicorn.error")
 
-    azure_settings: dict[str, str] = {
-        "clientId": location.client_id,
-        "tenantId": location.tenant_id,
-        "clientSecret": location.client_secret,
-    }
-
-    graph: Graph = Graph(azure_settings)
+    graph: Graph = graph_pool.get(location)
 
     try:
-        result: (
-            NamedLocationCollectionResponse | None
-        ) = await graph.app_client.identity.conditional_access.named_locations.get()
+        cidr_address: str | None = await _fetch_cidr_address(graph, location.location_id)
+    except CircuitOpenError as e:
+        logger.debug("%s", e)
+        return None
     except ClientAuthenticationError:
         logger.warning("Unable to check current IP for location_id : %s", location.location_id)
         return None
-    except ODataError as odata_error:
+    except _sdk.odata_errors as odata_error:
         logger.warning("Graph returned an ODataError:")
         if odata_error.error:
-            logger.warning(odata_error.error.code, odata_error.error.message)
+            logger.warning("%s: %s", odata_error.error.code, odata_error.error.message)
         return None
-
-    if result is None:
-        logger.warning("Graph could not find a location")
+    except (AzureError, httpx.HTTPError) as e:
+        logger.warning("Graph request failed: %s", e)
         return None
 
-    index: int = -1
-
-    for idx, x in enumerate(result.value):
-        if x.id == location.location_id:
-            index = idx
+    if cidr_address is None:
+        logger.warning("Graph cound not find the location in the response.")
+        return None
 
-    if index != -1:
-        loc: IpNamedLocation = result.value[index]
-        iprange: IPv4CidrRange = loc.ip_ranges[0]
-        logger.info("Microsoft Shows IP: %s for Location: %s", iprange.cidr_address, location.display_name)
-        return iprange.cidr_address.split("/")[0]
-
-    logger.warning("Graph cound not find the location in the response.")
-    return None
+    logger.info("Microsoft Shows IP: %s for Location: %s", cidr_address, location.display_name)
+    return cidr_address.split("/")[0]
 
 
 async def set_named_location_ip(location: Location, new_ip_address: str) -> bool:
@@ -148,38 +1029,177 @@ async def set_named_location_ip(location: Location, new_ip_address: str) -> bool
     """
     logger: logging.Logger = logging.getLogger("uvicorn.error")
 
-    azure_settings: dict[str, str] = {
-        "clientId": location.client_id,
-        "tenantId": location.tenant_id,
-        "clientSecret": location.client_secret,
-    }
-
-    graph: Graph = Graph(azure_settings)
+    graph: Graph = graph_pool.get(location)
 
-    body = IpNamedLocation(
-        odata_type="#microsoft.graph.ipNamedLocation",
-        ip_ranges=[
-            IPv4CidrRange(
-                odata_type="#microsoft.graph.iPv4CidrRange",
-                cidr_address=new_ip_address + "/32",
-            ),
-        ],
-    )
     try:
-        _ = await graph.app_client.identity.conditional_access.named_locations.by_named_location_id(
-            location.location_id,
-        ).patch(body)
+        if json_transport.enabled:
+            path: str = "/identity/conditionalAccess/namedLocations/" + location.location_id
+            body: dict = _ip_named_location_body(new_ip_address)
+            _ = await graph_scheduler.call(
+                graph,
+                "patch",
+                lambda: json_transport.request(graph, "PATCH", path, body=body),
+            )
+        else:
+            item = graph.app_client.identity.conditional_access.named_locations.by_named_location_id(
+                location.location_id,
+            )
+            named_location = _sdk.IpNamedLocation(
+                odata_type="#microsoft.graph.ipNamedLocation",
+                ip_ranges=[
+                    _sdk.IPv4CidrRange(
+                        odata_type="#microsoft.graph.iPv4CidrRange",
+                        cidr_address=new_ip_address + "/32",
+                    ),
+                ],
+            )
+            _ = await graph_scheduler.call(graph, "patch", lambda: item.patch(named_location))
+    except CircuitOpenError as e:
+        logger.debug("%s", e)
+        return False
     except ClientAuthenticationError as e:
         logger.exception("Error is %s, %s", e.error, e.message)
         return False
-    except ODataError as odata_error:
+    except _sdk.odata_errors as odata_error:
         logger.exception("Graph returned an ODataError:")
         if odata_error.error:
-            logger.exception(odata_error.error.code, odata_error.error.message)
+            logger.exception("%s: %s", odata_error.error.code, odata_error.error.message)
+        return False
+    except (AzureError, httpx.HTTPError):
+        logger.exception("Graph request failed")
         return False
+    ip_cache.invalidate(location.location_id)
     return True
 
 
+async def set_named_location_ips(updates: list[tuple[Location, str]]) -> dict[str, bool]:
+    """Update many Named Location IP Addresses using Graph JSON batching.
+
+    Updates are grouped by app registration and sent to Graph's $batch
+    endpoint, up to 20 PATCH requests per batch.  Sub-requests that fail
+    with a throttling or server error are retried on their own, the rest
+    of the batch is not sent again.
+
+    Args:
+        updates:
+            A list of tuples of the Location to update and its new IP address.
+
+    Returns:
+            A dictionary of location_id to True if that update succeeded
+            otherwise False.
+
+    """
+    tenants: dict[tuple[str, str, str], list[tuple[Location, str]]] = {}
+    for location, new_ip_address in updates:
+        tenants.setdefault(graph_pool.key(location), []).append((location, new_ip_address))
+
+    results: dict[str, bool] = {}
+    for tenant_results in await asyncio.gather(*(_batch_tenant_updates(group) for group in tenants.values())):
+        results.update(tenant_results)
+    return results
+
+
+async def _batch_tenant_updates(updates: list[tuple[Location, str]]) -> dict[str, bool]:
+    """Send one tenant's updates in $batch chunks, retrying failed sub-requests."""
+    logger: logging.Logger = logging.getLogger("uvicorn.error")
+
+    graph: Graph = graph_pool.get(updates[0][0])
+    tenant_id: str = updates[0][0].tenant_id
+    throttle: TenantThrottle = graph_scheduler.tenant(tenant_id)
+    results: dict[str, bool] = {}
+
+    for start in range(0, len(updates), BATCH_MAX_REQUESTS):
+        pending: dict[str, dict] = {
+            str(index): {
+                "id": str(index),
+                "method": "PATCH",
+                "url": f"/identity/conditionalAccess/namedLocations/{location.location_id}",
+                "headers": {"Content-Type": "application/json"},
+                "body": _ip_named_location_body(new_ip_address),
+            }
+            for index, (location, new_ip_address) in enumerate(updates[start : start + BATCH_MAX_REQUESTS], start)
+        }
+
+        for attempt in range(BATCH_MAX_RETRIES + 1):
+            # Each request in a batch counts against the tenant's budget.
+            await throttle.acquire(len(pending))
+            try:
+                with graph_scheduler.guard(graph):
+                    with graph_call(tenant_id, "token"):
+                        token = await graph.client_credential.get_token(GRAPH_SCOPE, enable_cae=True)
+                    with graph_call(tenant_id, "batch"):
+                        response = await graph.http_client.post(
+                            "/$batch",
+                            json={"requests": list(pending.values())},
+                            headers={"Authorization": "Bearer " + token.token},
+                        )
+                        response.raise_for_status()
+            except httpx.HTTPStatusError as e:
+                if e.response.status_code in RETRYABLE_STATUS_CODES:
+                    delay: float = throttle.back_off(_retry_after(dict(e.response.headers)))
+                    if attempt < BATCH_MAX_RETRIES:
+                        logger.info("Retrying throttled batch request in %.1f seconds", delay)
+                        continue
+                logger.warning("Graph batch request failed: %s", e)
+                break
+            except (CircuitOpenError, AzureError, httpx.HTTPError) as e:
+                logger.warning("Graph batch request failed: %s", e)
+                break
+
+            throttled, retry_after = _apply_batch_responses(response.json(), updates, pending, results)
+            if not throttled:
+                throttle.succeeded()
+                break
+            delay = throttle.back_off(retry_after)
+            if attempt == BATCH_MAX_RETRIES:
+                break
+            logger.info("Retrying %d throttled or failed batch requests in %.1f seconds", len(pending), delay)
+
+        for request_id in pending:
+            location = updates[int(request_id)][0]
+            logger.error("Updating IP on Microsoft Failed for location_id : %s", location.location_id)
+            graph_errors.inc(tenant_id, "patch")
+            results[location.location_id] = False
+
+    return results
+
+
+def _apply_batch_responses(
+    body: dict,
+    updates: list[tuple[Location, str]],
+    pending: dict[str, dict],
+    results: dict[str, bool],
+) -> tuple[bool, float | None]:
+    """Record the results of a $batch response, leaving throttled or failed requests pending.
+
+    Returns:
+            Whether any request was throttled or failed, and the longest
+            Retry-After sent with them, or None if there was none.
+
+    """
+    logger: logging.Logger = logging.getLogger("uvicorn.error")
+
+    throttled: bool = False
+    retry_after: float | None = None
+    for item in body.get("responses", []):
+        status_code: int = item.get("status", 0)
+        if status_code == HTTPStatus.TOO_MANY_REQUESTS or status_code >= HTTPStatus.INTERNAL_SERVER_ERROR:
+            throttled = True
+            item_retry_after: float | None = _retry_after(item.get("headers"))
+            if item_retry_after is not None:
+                retry_after = max(retry_after or 0.0, item_retry_after)
+            continue
+        location: Location = updates[int(item["id"])][0]
+        results[location.location_id] = HTTPStatus.OK <= status_code < HTTPStatus.MULTIPLE_CHOICES
+        if results[location.location_id]:
+            ip_cache.invalidate(location.location_id)
+        else:
+            graph_errors.inc(location.tenant_id, "patch")
+            logger.error("Graph rejected update of location_id : %s, %s", location.location_id, status_code)
+        del pending[item["id"]]
+    return throttled, retry_after
+
+
 async def get_location(location: Location) -> Location | None:
     """Given a Location, create a new Location object with Microsoft data.
 
@@ -197,52 +1217,215 @@ async def get_location(location: Location) -> Location | None:
     """
     logger: logging.Logger = logging.getLogger("uvicorn.error")
 
-    new_location: Location = Location()
-    new_location.client_id = location.client_id
-    new_location.client_secret = location.client_secret
-    new_location.tenant_id = location.tenant_id
-
-    azure_settings: dict[str, str] = {
-        "clientId": location.client_id,
-        "tenantId": location.tenant_id,
-        "clientSecret": location.client_secret,
-    }
-
-    graph: Graph = Graph(azure_settings)
+    graph: Graph = graph_pool.get(location)
 
     try:
-        result: (
-            NamedLocationCollectionResponse | None
-        ) = await graph.app_client.identity.conditional_access.named_locations.get()
+        loc: IpNamedLocation | None = await _fetch_named_location(graph, location.location_id)
+    except CircuitOpenError as e:
+        logger.debug("%s", e)
+        return None
     except ClientAuthenticationError as e:
         logger.exception("Error is %s, %s", e.error, e.message)
         return None
-    except ODataError as odata_error:
+    except (AzureError, httpx.HTTPError):
+        logger.exception("Unable to reach Graph for tenant_id : %s", location.tenant_id)
+        return None
+    except _sdk.odata_errors as odata_error:
         logger.exception("Graph returned an ODataError:")
         if odata_error.error:
-            logger.exception(odata_error.error.code, odata_error.error.message)
+            logger.exception("%s: %s", odata_error.error.code, odata_error.error.message)
+        return None
+
+    if loc is None:
+        logger.warning("Graph cound not find the location in the response.")
+        return None
+
+    iprange: IPv4CidrRange = loc.ip_ranges[0]
+
+    return Location(
+        client_id=location.client_id,
+        client_secret=location.client_secret,
+        display_name=loc.display_name,
+        ip_address=iprange.cidr_address.split("/")[0],
+        is_trusted=loc.is_trusted,
+        location_id=loc.id,
+        tenant_id=location.tenant_id,
+    )
+
+
+async def get_tenant_locations(location: Location) -> dict[str, Location] | None:
+    """Return every IP Named Location visible to a Location's app registration.
+
+    Lists the tenant's Named Locations once, following paging, so callers
+    that need many Locations from the same tenant only pay for one listing.
+
+    Args:
+        location:
+            A location object whose credentials are used to list the tenant.
+
+    Returns:
+            A dictionary of location_id to Location filled with Microsoft data,
+            or None if there is an error.
+
+    """
+    logger: logging.Logger = logging.getLogger("uvicorn.error")
+
+    graph: Graph = graph_pool.get(location)
+
+    query_parameters = _sdk.NamedLocationsRequestBuilder.NamedLocationsRequestBuilderGetQueryParameters(
+        select=NAMED_LOCATION_FIELDS,
+        top=NAMED_LOCATION_PAGE_SIZE,
+    )
+    named_locations = graph.app_client.identity.conditional_access.named_locations
+    tenant_locations: dict[str, Location] = {}
+
+    try:
+        page: NamedLocationCollectionResponse | None = await graph_scheduler.call(
+            graph,
+            "list",
+            lambda: named_locations.get(_sdk.RequestConfiguration(query_parameters=query_parameters)),
+        )
+        while page is not None:
+            for loc in page.value or []:
+                if isinstance(loc, _sdk.IpNamedLocation) and loc.ip_ranges:
+                    tenant_locations[loc.id] = Location(
+                        client_id=location.client_id,
+                        client_secret=location.client_secret,
+                        display_name=loc.display_name,
+                        ip_address=loc.ip_ranges[0].cidr_address.split("/")[0],
+                        is_trusted=loc.is_trusted,
+                        location_id=loc.id,
+                        tenant_id=location.tenant_id,
+                    )
+            if not page.odata_next_link:
+                break
+            next_page = named_locations.with_url(page.odata_next_link)
+            page = await graph_scheduler.call(graph, "list", next_page.get)
+    except CircuitOpenError as e:
+        logger.debug("%s", e)
+        return None
+    except ClientAuthenticationError as e:
+        logger.warning("Unable to list locations for tenant_id : %s, %s", location.tenant_id, e.message)
+        return None
+    except (AzureError, httpx.HTTPError) as e:
+        logger.warning("Unable to list locations for tenant_id : %s, %s", location.tenant_id, e)
+        return None
+    except _sdk.odata_errors as odata_error:
+        logger.warning("Graph returned an ODataError:")
+        if odata_error.error:
+            logger.warning("%s: %s", odata_error.error.code, odata_error.error.message)
+        return None
+
+    return tenant_locations
+
+
+def _ip_named_location_body(ip_address: str) -> dict:
+    """Return the JSON body of a PATCH setting a Named Location's IP address."""
+    return {
+        "@odata.type": "#microsoft.graph.ipNamedLocation",
+        "ipRanges": [{"@odata.type": "#microsoft.graph.iPv4CidrRange", "cidrAddress": ip_address + "/32"}],
+    }
+
+
+async def _fetch_cidr_address(graph: Graph, location_id: str) -> str | None:
+    """Fetch the first IP range of an IP Named Location, with the transport selected by GRAPH_TRANSPORT.
+
+    Raises:
+        CircuitOpenError: The app registration's circuit breaker is open.
+        ClientAuthenticationError: The credential could not get a token.
+        ODataError: Graph is throttling the tenant, or returned an error.
+        httpx.HTTPError: The same, for the raw JSON transport, or the request could not be sent.
+
+    """
+    if not json_transport.enabled:
+        loc: IpNamedLocation | None = await _fetch_named_location(graph, location_id)
+        return loc.ip_ranges[0].cidr_address if loc is not None else None
+
+    logger: logging.Logger = logging.getLogger("uvicorn.error")
+
+    path: str = "/identity/conditionalAccess/namedLocations/" + location_id
+    # Only ipRanges is read from the response.
+    params: dict[str, str] = {"$select": "ipRanges"}
+    try:
+        body: dict | None = await graph_scheduler.call(
+            graph,
+            "get",
+            lambda: json_transport.request(graph, "GET", path, params=params),
+        )
+    except httpx.HTTPStatusError as e:
+        if e.response.status_code == HTTPStatus.NOT_FOUND:
+            return None
+        # Scanning would only be throttled too.
+        if e.response.status_code in RETRYABLE_STATUS_CODES:
+            raise
+        logger.warning("Graph refused direct lookup of location_id : %s, scanning all locations", location_id)
+        result: NamedLocation | None = await _scan_named_locations(graph, location_id)
+        if isinstance(result, _sdk.IpNamedLocation) and result.ip_ranges:
+            return result.ip_ranges[0].cidr_address
         return None
 
-    if result is None:
-        logger.warning("Graph could not find a location")
+    # Only IP Named Locations have ipRanges.
+    if body is None or not body.get("ipRanges"):
         return None
+    return body["ipRanges"][0].get("cidrAddress")
+
+
+async def _fetch_named_location(graph: Graph, location_id: str) -> IpNamedLocation | None:
+    """Fetch a single IP Named Location by ID, selecting only the fields used.
 
-    index: int = -1
+    If Graph refuses the direct lookup for any reason other than the location
+    not existing, fall back to paging through the tenant's Named Locations.
 
-    for idx, x in enumerate(result.value):
-        if x.id == location.location_id:
-            index = idx
+    Raises:
+        CircuitOpenError: The app registration's circuit breaker is open.
+        ClientAuthenticationError: The credential could not get a token.
+        ODataError: Graph is throttling the tenant, or returned an error for the paged fallback.
 
-    if index != -1:
-        loc: IpNamedLocation = result.value[index]
-        iprange: IPv4CidrRange = loc.ip_ranges[0]
+    """
+    logger: logging.Logger = logging.getLogger("uvicorn.error")
 
-        new_location.display_name = loc.display_name
-        new_location.ip_address = iprange.cidr_address.split("/")[0]
-        new_location.is_trusted = loc.is_trusted
-        new_location.location_id = loc.id
+    query_parameters = _sdk.NamedLocationItemRequestBuilder.NamedLocationItemRequestBuilderGetQueryParameters(
+        select=NAMED_LOCATION_FIELDS,
+    )
+    item = graph.app_client.identity.conditional_access.named_locations.by_named_location_id(location_id)
+    try:
+        result: NamedLocation | None = await graph_scheduler.call(
+            graph,
+            "get",
+            lambda: item.get(_sdk.RequestConfiguration(query_parameters=query_parameters)),
+        )
+    except _sdk.odata_errors as odata_error:
+        if odata_error.response_status_code == HTTPStatus.NOT_FOUND:
+            return None
+        # Scanning would only be throttled too.
+        if odata_error.response_status_code in RETRYABLE_STATUS_CODES:
+            raise
+        logger.warning("Graph refused direct lookup of location_id : %s, scanning all locations", location_id)
+        result = await _scan_named_locations(graph, location_id)
+
+    if isinstance(result, _sdk.IpNamedLocation) and result.ip_ranges:
+        return result
+    return None
 
-        return new_location
 
-    logger.warning("Graph cound not find the location in the response.")
+async def _scan_named_locations(graph: Graph, location_id: str) -> NamedLocation | None:
+    """Page through the tenant's Named Locations, stopping at location_id."""
+    query_parameters = _sdk.NamedLocationsRequestBuilder.NamedLocationsRequestBuilderGetQueryParameters(
+        select=NAMED_LOCATION_FIELDS,
+        top=NAMED_LOCATION_PAGE_SIZE,
+    )
+    named_locations = graph.app_client.identity.conditional_access.named_locations
+    page: NamedLocationCollectionResponse | None = await graph_scheduler.call(
+        graph,
+        "list",
+        lambda: named_locations.get(_sdk.RequestConfiguration(query_parameters=query_parameters)),
+    )
+    while page is not None:
+        for named_location in page.value or []:
+            if named_location.id == location_id:
+                return named_location
+        if not page.odata_next_link:
+            return None
+        next_page = named_locations.with_url(page.odata_next_link)
+        page = await graph_scheduler.call(graph, "list", next_page.get)
     return None
@@ -0,0 +1,168 @@
+"""Module for caching the IP address Microsoft has for each Named Location.
+
+This module contains a small cache of the last IP address confirmed with
+Microsoft for each Location, so DDNS check-ins that report an unchanged
+IP address can be answered without calling the Graph API.
+
+Typical usage example:
+
+    ip_cache.get(location_id)
+    ip_cache.set(location_id, ip_address)
+    ip_cache.invalidate(location_id)
+    since = ip_cache.generation
+    ip_cache.set(location_id, ip_address, since=since)
+
+"""
+
+from __future__ import annotations
+
+import os
+import time
+
+from metrics import metrics
+
+
+class MicrosoftIpCache:
+    """Cache of the last IP address confirmed with Microsoft per Location.
+
+    Entries expire after ttl seconds, after which the next check-in goes
+    to Microsoft again.  A ttl of 0 disables the cache.
+
+    Attributes:
+        ttl: float
+            Seconds an entry stays valid
+        hits: int
+            Number of lookups answered from the cache
+        misses: int
+            Number of lookups that had to go to Microsoft
+        generation: int
+            Incremented by every invalidation
+
+    """
+
+    ttl: float
+    hits: int
+    misses: int
+    generation: int
+
+    def __init__(self, ttl: float) -> None:
+        """Initialize an empty cache.
+
+        Args:
+            ttl:
+                Seconds an entry stays valid
+
+        """
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0
+        self._entries: dict[str, tuple[str, float]] = {}
+        self._invalidated: dict[str, int] = {}
+
+    def get(self, location_id: str) -> str | None:
+        """Return the cached Microsoft IP address for a Location if still valid.
+
+        Args:
+            location_id:
+                The UUID for the Named Location
+
+        Returns:
+            The IP address, or None if there is no valid entry.
+
+        """
+        entry: tuple[str, float] | None = self._entries.get(location_id)
+        if entry is None:
+            return None
+        if entry[1] <= time.monotonic():
+            del self._entries[location_id]
+            return None
+        return entry[0]
+
+    def is_unchanged(self, location_id: str, ip_address: str, *, count_miss: bool = True) -> bool:
+        """Check whether Microsoft is known to already have ip_address.
+
+        Counts a hit if the cached IP address matches, otherwise a miss.
+
+        Args:
+            location_id:
+                The UUID for the Named Location
+            ip_address:
+                The IP address reported by the router
+            count_miss:
+                False when a miss is checked again, and counted, later on
+
+        Returns:
+            True if the cached IP address matches ip_address.
+
+        """
+        if self.get(location_id) == ip_address:
+            self.hits += 1
+            return True
+        if count_miss:
+            self.misses += 1
+        return False
+
+    def set(self, location_id: str, ip_address: str, *, since: int | None = None) -> None:
+        """Record the IP address Microsoft currently has for a Location.
+
+        Args:
+            location_id:
+                The UUID for the Named Location
+            ip_address:
+                The IP address confirmed with Microsoft
+            since:
+                The generation when ip_address was read from Microsoft.  If
+                the Location was invalidated after that, for example by an
+                update, ip_address may be outdated and is not recorded.
+
+        """
+        if since is not None and self._invalidated.get(location_id, 0) > since:
+            return
+        if self.ttl > 0:
+            self._entries[location_id] = (ip_address, time.monotonic() + self.ttl)
+
+    def invalidate(self, location_id: str) -> None:
+        """Forget the cached IP address for a Location.
+
+        Args:
+            location_id:
+                The UUID for the Named Location
+
+        """
+        self._entries.pop(location_id, None)
+        self.generation += 1
+        self._invalidated[location_id] = self.generation
+
+    def stats(self) -> dict[str, float]:
+        """Return the hit and miss counters and the hit ratio."""
+        lookups: int = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
+
+
+ip_cache: MicrosoftIpCache = MicrosoftIpCache(float(os.getenv("IP_CACHE_TTL", "300")))
+
+metrics.callback(
+    "ddns_ip_cache_entries",
+    "Locations with a cached Microsoft IP address.",
+    "gauge",
+    lambda: ip_cache.stats()["entries"],
+)
+metrics.callback("ddns_ip_cache_hits_total", "Check-ins answered from the IP cache.", "counter", lambda: ip_cache.hits)
+metrics.callback(
+    "ddns_ip_cache_misses_total",
+    "Check-ins that had to ask Microsoft.",
+    "counter",
+    lambda: ip_cache.misses,
+)
+metrics.callback(
+    "ddns_ip_cache_hit_ratio",
+    "Fraction of check-ins answered from the IP cache.",
+    "gauge",
+    lambda: ip_cache.stats()["hit_ratio"],
+)
@@ -0,0 +1,219 @@
+"""Module defining the append-only journal of IP address changes.
+
+DDNS check-ins change a Location's IP address far more often than anything
+else changes the configuration.  Rather than rewriting the whole storage
+for each of them, the change is appended to a small journal file, one
+tab separated line per change.  The ConfigStore replays the journal on top
+of the storage when it loads, and a compactor periodically writes the
+Locations back to the storage and starts a new journal.  When several
+worker processes share the journal, appends and compactions also hold a
+file lock.
+
+Typical usage example:
+
+    journal: IpJournal = IpJournal(Path("config/journal.log"))
+    journal.append(JournalEntry(time.time(), location_id, old_ip, new_ip, "ddns"))
+    [JournalEntry] = journal.replay()
+    [JournalEntry], position = journal.read_from(offset)
+    journal.compact(offset)
+
+"""
+
+from __future__ import annotations
+
+import contextlib
+import logging
+import os
+import threading
+from dataclasses import dataclass
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from pathlib import Path
+
+    from workers import FileLock
+
+
+@dataclass(frozen=True, slots=True)
+class JournalEntry:
+    """One IP address change of a Location."""
+
+    timestamp: float
+    location_id: str
+    old_ip: str
+    new_ip: str
+    source: str
+
+    def to_line(self) -> str:
+        """Return the entry as a journal line."""
+        return f"{self.timestamp:.3f}\t{self.location_id}\t{self.old_ip}\t{self.new_ip}\t{self.source}\n"
+
+    @classmethod
+    def from_line(cls, line: str) -> JournalEntry:
+        """Parse a journal line.
+
+        Raises:
+            ValueError: The line is not a complete journal entry.
+
+        """
+        timestamp, location_id, old_ip, new_ip, source = line.rstrip("\n").split("\t")
+        return cls(float(timestamp), location_id, old_ip, new_ip, source)
+
+
+class IpJournal:
+    """Append-only file of IP address changes.
+
+    Every append is flushed and synced before it returns, so a change that
+    was acknowledged survives a crash.  The methods may be called from
+    worker threads.
+
+    Attributes:
+        path: Path
+            The journal file
+        file_lock: FileLock | None
+            Lock held while appending and compacting, when the journal is shared
+
+    """
+
+    path: Path
+    file_lock: FileLock | None
+
+    def __init__(self, path: Path, file_lock: FileLock | None = None) -> None:
+        """Initialize the journal.
+
+        Args:
+            path:
+                The journal file
+            file_lock:
+                Lock held while appending and compacting, when the journal is shared
+
+        """
+        self.path = path
+        self.file_lock = file_lock
+        self._lock: threading.Lock = threading.Lock()
+        # Inode, length in bytes and number of entries when the journal was last counted.
+        self._counted: tuple[int, int, int] = (0, 0, 0)
+
+    def __str__(self) -> str:
+        """Return the path of the journal."""
+        return str(self.path)
+
+    def append(self, entry: JournalEntry) -> None:
+        """Append an entry and sync it to disk."""
+        with self._lock, self._shared(), self.path.open("a", encoding="utf-8") as file_object:
+            file_object.write(entry.to_line())
+            file_object.flush()
+            os.fsync(file_object.fileno())
+
+    def replay(self) -> list[JournalEntry]:
+        """Return every entry in the journal, oldest first.
+
+        A line cut short by a crash is ignored.
+
+        """
+        return self.read_from(0)[0]
+
+    def read_from(self, offset: int) -> tuple[list[JournalEntry], tuple[int, int]]:
+        """Return the entries appended after offset, oldest first.
+
+        A line that is not complete yet, because another process is still
+        appending it, is left for the next read.
+
+        Args:
+            offset:
+                Where the last read of the same journal file ended.
+
+        Returns:
+            Tuple of the entries and the position() at the end of the last complete line.
+
+        """
+        logger: logging.Logger = logging.getLogger("uvicorn.error")
+
+        try:
+            with self.path.open("rb") as file_object:
+                inode: int = os.fstat(file_object.fileno()).st_ino
+                file_object.seek(offset)
+                data: bytes = file_object.read()
+        except FileNotFoundError:
+            return [], (0, 0)
+
+        complete: int = data.rfind(b"\n") + 1
+        entries: list[JournalEntry] = []
+        for line in data[:complete].decode("utf-8").splitlines(keepends=True):
+            try:
+                entries.append(JournalEntry.from_line(line))
+            except ValueError:
+                logger.warning("Ignoring incomplete entry in %s: %r", self.path, line)
+        return entries, (inode, offset + complete)
+
+    def position(self) -> tuple[int, int]:
+        """Return the inode and length in bytes of the journal, which change when it is appended or compacted."""
+        try:
+            stat: os.stat_result = self.path.stat()
+        except FileNotFoundError:
+            return 0, 0
+        return stat.st_ino, stat.st_size
+
+    def count(self) -> int:
+        """Return the number of entries in the journal file, including those appended by other processes.
+
+        Only the entries appended since the last count are read, unless the
+        journal was compacted since.
+        """
+        with self._lock:
+            try:
+                with self.path.open("rb") as file_object:
+                    stat: os.stat_result = os.fstat(file_object.fileno())
+                    inode, size, entries = self._counted
+                    if stat.st_ino != inode or stat.st_size < size:
+                        size, entries = 0, 0
+                    file_object.seek(size)
+                    data: bytes = file_object.read()
+            except FileNotFoundError:
+                self._counted = (0, 0, 0)
+                return 0
+            self._counted = (stat.st_ino, size + len(data), entries + data.count(b"\n"))
+            return self._counted[2]
+
+    def size(self) -> int:
+        """Return the length of the journal in bytes."""
+        with self._lock:
+            try:
+                return self.path.stat().st_size
+            except FileNotFoundError:
+                return 0
+
+    def compact(self, offset: int) -> None:
+        """Drop the entries before offset, which are now in the storage.
+
+        Entries appended after offset are kept in the journal.  The dropped
+        entries replace the previous history in a file next to the journal
+        with a .1 suffix.
+
+        Args:
+            offset:
+                The size() of the journal when the storage was written.
+
+        """
+        with self._lock, self._shared():
+            try:
+                with self.path.open("rb") as file_object:
+                    head: bytes = file_object.read(offset)
+                    tail: bytes = file_object.read()
+            except FileNotFoundError:
+                return
+
+            self._write(self.path.with_name(self.path.name + ".1"), head)
+            temp_path: Path = self.path.with_name(self.path.name + ".tmp")
+            self._write(temp_path, tail)
+            temp_path.replace(self.path)
+
+    def _shared(self) -> contextlib.AbstractContextManager[None]:
+        return self.file_lock if self.file_lock is not None else contextlib.nullcontext()
+
+    @staticmethod
+    def _write(path: Path, data: bytes) -> None:
+        with path.open("wb") as file_object:
+            file_object.write(data)
+            file_object.flush()
+            os.fsync(file_object.fileno())
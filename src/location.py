@@ -2,26 +2,43 @@
 
 This module contains the class definition for the Location objects used
 in the program.  These objects hold the data needed to connect to Microsoft
-Graph API along with the data for each Named Location.  There are also a
-few helper functions defined in this file, but outside of the class.
+Graph API along with the data for each Named Location.  There is also a
+LocationRegistry class, which holds the configured Locations indexed for lookups.
 
 Typical usage example:
 
     loc: Location = Location()
-    get_location_index_by_name(configs=list[Location], name=str)
-    get_location_index_by_id(configs=list[Location], id=str)
+    registry: LocationRegistry = LocationRegistry([loc])
+    registry.get_by_name(name=str)
+    registry.get_by_id(location_id=str)
+    registry.find(tenant_id=str, name_prefix=str)
 
 """
 
 from __future__ import annotations
 
+import bisect
+import dataclasses
+import itertools
+import time
+from dataclasses import dataclass
+from typing import TYPE_CHECKING
 
+if TYPE_CHECKING:
+    from collections.abc import Iterable, Iterator, Mapping
+
+
+@dataclass(frozen=True, slots=True)
 class Location:
     """Location class for storing the required data.
 
     This class does contains all the data for connecting to
     the Graph API, along with the info from the Named Location
 
+    Locations are immutable and use __slots__ to keep the per Location
+    memory small.  Use replace() to get a changed copy, and to_dict() /
+    from_dict() to convert to and from the config file format.
+
     Attributes:
         client_id: str
             The Client ID required to login to Microsoft Graph API
@@ -48,96 +65,299 @@ class Location:
     location_id: str = ""
     tenant_id: str = ""
 
-    def __init__(
-        self,
-        client_id: str = "",
-        client_secret: str = "",
-        display_name: str = "",
-        ip_address: str = "",
-        is_trusted: bool = "",
-        location_id: str = "",
-        tenant_id: str = "",
-    ) -> None:
-        """Initialize a new Location object given the inputs.
-
-        Initializes the new object with the passed in data.
+    @classmethod
+    def from_dict(cls, data: Mapping[str, object]) -> Location:
+        """Create a Location from a dictionary in the config file format.
 
         Args:
-            client_id: str
-                The Client ID required to login to Microsoft Graph API
-            client_secret: str
-                The Client Secret is used for authenticating to Microsoft
-            display_name: str
-                The Named Location display name
-            ip_address: str
-                The IP Address for the Named Location
-            is_trusted: bool
-                Whether Microsoft considers this location as trusted
-            location_id:
-                The UUID for the Named Location
-            tenant_id: str
-                The Tenant ID for authenticating to Microsoft
+            data:
+                A mapping with a value for every Location attribute.
+
+        Returns:
+            A new Location object
 
         """
-        self.client_id = client_id
-        self.client_secret = client_secret
-        self.display_name = display_name
-        self.ip_address = ip_address
-        self.is_trusted = is_trusted
-        self.location_id = location_id
-        self.tenant_id = tenant_id
+        return cls(
+            client_id=data["client_id"],
+            client_secret=data["client_secret"],
+            display_name=data["display_name"],
+            ip_address=data["ip_address"],
+            is_trusted=data["is_trusted"],
+            location_id=data["location_id"],
+            tenant_id=data["tenant_id"],
+        )
+
+    def to_dict(self) -> dict[str, object]:
+        """Return the Location as a dictionary in the config file format."""
+        return {
+            "client_id": self.client_id,
+            "client_secret": self.client_secret,
+            "display_name": self.display_name,
+            "ip_address": self.ip_address,
+            "is_trusted": self.is_trusted,
+            "location_id": self.location_id,
+            "tenant_id": self.tenant_id,
+        }
+
+    def replace(self, **changes: object) -> Location:
+        """Return a copy of the Location with the given attributes changed."""
+        return dataclasses.replace(self, **changes)
 
     def __repr__(self) -> str:
         """Output a readable representation of the object."""
-        output = f"Client ID: {self.client_id}\n"
-        output += f"Client Secret: {self.client_secret}\n"
-        output += f"Display Name: {self.display_name}\n"
-        output += f"IP Address: {self.ip_address}\n"
-        output += f"Is Trusted: {self.is_trusted}\n"
-        output += f"Location ID: {self.location_id}\n"
-        output += f"Tenant ID: {self.tenant_id}\n\n"
-        return output
+        return (
+            f"Client ID: {self.client_id}\n"
+            f"Client Secret: {self.client_secret}\n"
+            f"Display Name: {self.display_name}\n"
+            f"IP Address: {self.ip_address}\n"
+            f"Is Trusted: {self.is_trusted}\n"
+            f"Location ID: {self.location_id}\n"
+            f"Tenant ID: {self.tenant_id}\n\n"
+        )
 
 
-def get_location_index_by_name(configs: list[Location], name: str) -> int | None:
-    """Given a list of Locations, return the index corresponding to name.
+class LocationRegistry:
+    """Indexed collection of Locations.
 
-    Given a list of location objects return the index of the location in the list
-    corresponding to the location with the same name.
+    Locations are kept in insertion order and indexed by location_id and
+    display_name, which must both be unique, and by tenant_id and IP
+    address, so every lookup is a dictionary access.  Display names are
+    also kept sorted for prefix searches.  Each Location has a slot that
+    fixes its place in the order, so it keeps its place when its
+    location_id changes.  Changes go through add(),
+    update() and remove(), which keep the indexes consistent and bump the
+    registry version.
 
-    Args:
-        configs:
-            A list of location objects.
-        name:
-            String representing the display_name of the location being searched for.
-
-    Returns:
-            Integer index corresponding to the entry in the list.
+    Attributes:
+        version: int
+            Incremented on every change to the registry
+        modified: float
+            When the registry last changed, in seconds since the epoch
 
     """
-    for index, config in enumerate(configs):
-        if config.display_name == name:
-            return index
-    return None
 
+    version: int
+    modified: float
 
-def get_location_index_by_id(configs: list[Location], id_number: str) -> int | None:
-    """Given a list of Locations, return the index corresponding to id.
+    def __init__(self, locations: Iterable[Location] = ()) -> None:
+        """Initialize a registry holding the given Locations.
 
-    Given a list of location objects return the index of the location in the list
-    corresponding to the location with the same location_id.
+        Args:
+            locations:
+                The Locations to add.
 
-    Args:
-        configs:
-            A list of location objects.
-        id_number:
-            String representing the location ID of the location being searched for.
+        Raises:
+            ValueError: Two Locations share a location_id or display_name.
 
-    Returns:
-            Integer index corresponding to the entry in the list.
+        """
+        self.version = 0
+        self.modified = time.time()
+        self._by_id: dict[str, Location] = {}
+        self._slots: dict[str, int] = {}
+        self._by_slot: dict[int, Location] = {}
+        self._slot_numbers: Iterator[int] = itertools.count()
+        self._by_name: dict[str, Location] = {}
+        self._names: list[str] = []
+        self._by_tenant: dict[str, dict[str, Location]] = {}
+        self._by_ip: dict[str, dict[str, Location]] = {}
+        self.replace_all(locations)
 
-    """
-    for index, config in enumerate(configs):
-        if config.location_id == id_number:
-            return index
-    return None
+    def __len__(self) -> int:
+        """Return the number of Locations."""
+        return len(self._by_id)
+
+    def __iter__(self) -> Iterator[Location]:
+        """Iterate over the Locations in insertion order."""
+        return iter(list(self._by_slot.values()))
+
+    def get_by_id(self, location_id: str) -> Location | None:
+        """Return the Location with the given location_id, or None."""
+        return self._by_id.get(location_id)
+
+    def get_by_name(self, display_name: str) -> Location | None:
+        """Return the Location with the given display_name, or None."""
+        return self._by_name.get(display_name)
+
+    def get_by_tenant(self, tenant_id: str) -> list[Location]:
+        """Return every Location in the given tenant."""
+        return list(self._by_tenant.get(tenant_id, {}).values())
+
+    def get_by_ip(self, ip_address: str) -> list[Location]:
+        """Return every Location currently configured with the given IP address."""
+        return list(self._by_ip.get(ip_address, {}).values())
+
+    def find(self, *, tenant_id: str = "", name_prefix: str = "") -> list[Location]:
+        """Return every Location matching the given filters, in display_name order.
+
+        The smaller of the tenant's Locations and the display names starting
+        with name_prefix is looked up, then checked against the other filter.
+
+        Args:
+            tenant_id:
+                Only return Locations in this tenant, if set.
+            name_prefix:
+                Only return Locations whose display_name starts with this.
+
+        Returns:
+            The matching Locations.
+
+        """
+        start: int = bisect.bisect_left(self._names, name_prefix)
+        end: int = len(self._names)
+        if name_prefix:
+            end = bisect.bisect_right(self._names, name_prefix + "\U0010ffff", lo=start)
+        tenant: dict[str, Location] | None = self._by_tenant.get(tenant_id, {}) if tenant_id else None
+
+        if tenant is not None and len(tenant) < end - start:
+            return sorted(
+                (location for location in tenant.values() if location.display_name.startswith(name_prefix)),
+                key=lambda location: location.display_name,
+            )
+        locations: list[Location] = [self._by_name[name] for name in self._names[start:end]]
+        if tenant_id:
+            return [location for location in locations if location.tenant_id == tenant_id]
+        return locations
+
+    def add(self, location: Location) -> None:
+        """Add a Location.
+
+        Args:
+            location:
+                The Location to add.
+
+        Raises:
+            ValueError: Another Location has the same location_id or display_name.
+
+        """
+        self._check_unique(location.location_id, location.display_name)
+        self._index(location)
+        bisect.insort(self._names, location.display_name)
+        self._changed()
+
+    def update(self, location_id: str, /, **changes: object) -> Location | None:
+        """Replace a Location with a changed copy, keeping the indexes consistent.
+
+        Either every change is applied or, if one is rejected, none is.
+
+        Args:
+            location_id:
+                The location_id of the Location to change.
+            **changes:
+                Attribute names and their new values.
+
+        Returns:
+            The new Location, or None if there is no such Location.
+
+        Raises:
+            ValueError: The change would duplicate another Location's location_id or display_name.
+
+        """
+        location: Location | None = self._by_id.get(location_id)
+        if location is None:
+            return None
+        self._check_unique(
+            changes.get("location_id", location.location_id),
+            changes.get("display_name", location.display_name),
+            ignore=location,
+        )
+        updated: Location = location.replace(**changes)
+        # Put the Location back in its slot, so it keeps its place in the order.
+        slot: int = self._slots[location_id]
+        self._unindex(location, keep_slot=True)
+        self._index(updated, slot=slot)
+        if updated.display_name != location.display_name:
+            del self._names[bisect.bisect_left(self._names, location.display_name)]
+            bisect.insort(self._names, updated.display_name)
+        self._changed()
+        return updated
+
+    def remove(self, location_id: str) -> Location | None:
+        """Remove a Location.
+
+        Args:
+            location_id:
+                The location_id of the Location to remove.
+
+        Returns:
+            The removed Location, or None if there is no such Location.
+
+        """
+        location: Location | None = self._by_id.get(location_id)
+        if location is None:
+            return None
+        self._unindex(location)
+        del self._names[bisect.bisect_left(self._names, location.display_name)]
+        self._changed()
+        return location
+
+    def replace_all(self, locations: Iterable[Location]) -> None:
+        """Replace every Location at once.
+
+        Args:
+            locations:
+                The new Locations.
+
+        Raises:
+            ValueError: Two Locations share a location_id or display_name, the
+                registry is left unchanged.
+
+        """
+        locations = list(locations)
+        location_ids: set[str] = set()
+        display_names: set[str] = set()
+        for location in locations:
+            if location.location_id in location_ids:
+                msg = f"Duplicate location_id: {location.location_id}"
+                raise ValueError(msg)
+            if location.display_name in display_names:
+                msg = f"Duplicate display_name: {location.display_name}"
+                raise ValueError(msg)
+            location_ids.add(location.location_id)
+            display_names.add(location.display_name)
+
+        self._by_id = {}
+        self._slots = {}
+        self._by_slot = {}
+        self._slot_numbers = itertools.count()
+        self._by_name = {}
+        self._by_tenant = {}
+        self._by_ip = {}
+        for location in locations:
+            self._index(location)
+        self._names = sorted(display_names)
+        self._changed()
+
+    def _changed(self) -> None:
+        self.version += 1
+        self.modified = time.time()
+
+    def _check_unique(self, location_id: str, display_name: str, ignore: Location | None = None) -> None:
+        existing: Location | None = self._by_id.get(location_id)
+        if existing is not None and existing is not ignore:
+            msg = f"Duplicate location_id: {location_id}"
+            raise ValueError(msg)
+        existing = self._by_name.get(display_name)
+        if existing is not None and existing is not ignore:
+            msg = f"Duplicate display_name: {display_name}"
+            raise ValueError(msg)
+
+    def _index(self, location: Location, *, slot: int | None = None) -> None:
+        if slot is None:
+            slot = next(self._slot_numbers)
+        self._by_id[location.location_id] = location
+        self._slots[location.location_id] = slot
+        self._by_slot[slot] = location
+        self._by_name[location.display_name] = location
+        self._by_tenant.setdefault(location.tenant_id, {})[location.location_id] = location
+        self._by_ip.setdefault(location.ip_address, {})[location.location_id] = location
+
+    def _unindex(self, location: Location, *, keep_slot: bool = False) -> None:
+        del self._by_id[location.location_id]
+        slot: int = self._slots.pop(location.location_id)
+        if not keep_slot:
+            del self._by_slot[slot]
+        del self._by_name[location.display_name]
+        for index, key in ((self._by_tenant, location.tenant_id), (self._by_ip, location.ip_address)):
+            del index[key][location.location_id]
+            if not index[key]:
+                del index[key]
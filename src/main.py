@@ -11,6 +11,9 @@ from __future__ import annotations
 
 import asyncio
 import logging
+import signal
+from contextlib import asynccontextmanager
+from typing import TYPE_CHECKING
 
 import uvicorn
 from fastapi import FastAPI
@@ -18,8 +21,73 @@ from fastapi.templating import Jinja2Templates
 from uvicorn.config import LOGGING_CONFIG
 
 import routes
+from app_config import config_store, journal_compactor
+from damping import flap_damper
+from graph import graph_pool, json_transport
+from metrics import MetricsMiddleware
+from reconciler import reconciler
+from snapshot import m365_snapshot
+from update_queue import update_queue
+from workers import FILE_LOCKING, SHARED, WEB_WORKERS, leader
+
+if TYPE_CHECKING:
+    from collections.abc import AsyncIterator
+
+
+@asynccontextmanager
+async def lifespan(_app: FastAPI) -> AsyncIterator[None]:
+    """Load the configuration on startup and reload it on SIGHUP.
+
+    Also starts loading the Graph SDK and warming the pooled Graph clients
+    for every configured Location in the background, starts the config
+    writer, the token refresh and the update queue workers, and stands for
+    leader, which runs the journal compactor and the reconciler.  On
+    shutdown it stops them, folds the journal and pending config changes
+    into the storage and closes the storage and Graph clients.
+
+    Args:
+        _app:
+            The FastAPI application being started.
 
-app = FastAPI()
+    """
+    config_store.reload()
+    config_store.writer.start()
+    graph_pool.start_preload(config_store.get_locations())
+    # Every worker has its own pooled credentials and token cache, so each refreshes its own tokens
+    graph_pool.start_refresh()
+    update_queue.start()
+    leader.start()
+
+    logger: logging.Logger = logging.getLogger("uvicorn.error")
+    loop = asyncio.get_running_loop()
+    sighup_installed: bool = False
+    try:
+        loop.add_signal_handler(signal.SIGHUP, config_store.reload)
+        sighup_installed = True
+    except (AttributeError, NotImplementedError, RuntimeError):
+        logger.warning("Unable to install SIGHUP handler, config reload on signal disabled")
+
+    yield
+
+    if sighup_installed:
+        loop.remove_signal_handler(signal.SIGHUP)
+
+    await update_queue.close()
+    await m365_snapshot.close()
+    await flap_damper.close()
+    await leader.close()
+    await config_store.writer.close()
+    config_store.storage.close()
+    await graph_pool.close()
+    await json_transport.close()
+
+
+# Background jobs run by only one worker process, started in this order and stopped in reverse.
+leader.add_job(journal_compactor.start, journal_compactor.close)
+leader.add_job(reconciler.start, reconciler.close)
+
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(MetricsMiddleware)
 templates = Jinja2Templates(directory="templates")
 
 env_var_loaded = (
@@ -32,26 +100,30 @@ env_var_loaded = (
 app.include_router(routes.my_router)
 
 
-async def main() -> None:
+def main() -> None:
     """Run the program.
 
-    This main function is the base function for running the program.
+    This main function is the base function for running the program.  It
+    starts WEB_WORKERS uvicorn worker processes.
 
     """
     LOGGING_CONFIG["formatters"]["default"]["fmt"] = "%(asctime)s [%(name)s] %(levelprefix)s %(message)s"
     LOGGING_CONFIG["formatters"]["access"]["fmt"] = (
         '%(asctime)s [%(name)s] %(levelprefix)s %(client_addr)s - "%(request_line)s" %(status_code)s'
     )
-    config = uvicorn.Config("main:app", host="0.0.0.0", port=8080, log_level="info")  # noqa: S104
-    server = uvicorn.Server(config)
-
     logger: logging.Logger = logging.getLogger("uvicorn.error")
 
     if env_var_loaded:
         logger.error("Required Environment Variables Not Set")
-    else:
-        await server.serve()
+        return
+
+    workers: int = WEB_WORKERS
+    if SHARED and not FILE_LOCKING:
+        logger.error("File locking is not available, running a single worker")
+        workers = 1
+
+    uvicorn.run("main:app", host="0.0.0.0", port=8080, log_level="info", workers=workers)  # noqa: S104
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    main()
@@ -0,0 +1,348 @@
+"""Module for collecting metrics and exposing them in the Prometheus text format.
+
+This module contains small Counter, Gauge and Histogram classes, the
+registry that renders them for the /metrics route, and the metrics the
+application records: HTTP requests per route, Graph calls per tenant and
+operation, config storage timings and template rendering.  Recording a
+value is a dictionary update, so metrics can be kept in the hot path.
+
+Metrics are updated from the event loop only and are not thread safe.
+
+Typical usage example:
+
+    http_requests.inc("/list", "GET", "200")
+    with graph_call(tenant_id, "patch"):
+        await ...
+    metrics.callback("ip_cache_hits_total", "help", "counter", lambda: ip_cache.hits)
+    metrics.render()
+
+"""
+
+from __future__ import annotations
+
+import bisect
+import contextlib
+import time
+from typing import TYPE_CHECKING, TypeVar
+
+from fastapi.templating import Jinja2Templates
+
+if TYPE_CHECKING:
+    from collections.abc import Callable, Iterator
+
+    from starlette.requests import Request
+    from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+# Histogram buckets, in seconds, for request and call latencies.
+LATENCY_BUCKETS: tuple[float, ...] = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: tuple[str, ...], values: tuple[str, ...], extra: str = "") -> str:
+    pairs: list[str] = [f'{name}="{_escape(value)}"' for name, value in zip(names, values, strict=True)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric:
+    """Base class for a named metric with optional labels.
+
+    Attributes:
+        name: str
+            The metric name
+        documentation: str
+            The HELP text
+        labels: tuple[str, ...]
+            The label names, values are passed in the same order
+
+    """
+
+    kind: str = "untyped"
+    name: str
+    documentation: str
+    labels: tuple[str, ...]
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = ()) -> None:
+        """Initialize a metric without any samples."""
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+
+    def render(self) -> list[str]:
+        """Return the metric in the Prometheus text format, one line per item."""
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}", *self._samples()]
+
+    def _samples(self) -> list[str]:
+        return []
+
+
+class Counter(Metric):
+    """Value per label set that only goes up."""
+
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = ()) -> None:
+        """Initialize a counter without any samples."""
+        super().__init__(name, documentation, labels)
+        self._values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, *label_values: str, amount: float = 1.0) -> None:
+        """Add amount to the value for the given label values."""
+        self._values[label_values] = self._values.get(label_values, 0.0) + amount
+
+    def _samples(self) -> list[str]:
+        return [f"{self.name}{_format_labels(self.labels, key)} {value}" for key, value in self._values.items()]
+
+
+class Gauge(Counter):
+    """Value per label set that can go up and down."""
+
+    kind = "gauge"
+
+    def dec(self, *label_values: str, amount: float = 1.0) -> None:
+        """Subtract amount from the value for the given label values."""
+        self.inc(*label_values, amount=-amount)
+
+    def set(self, *label_values: str, value: float) -> None:
+        """Set the value for the given label values."""
+        self._values[label_values] = value
+
+
+class Histogram(Metric):
+    """Distribution of observed values per label set."""
+
+    kind = "histogram"
+    buckets: tuple[float, ...]
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labels: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = LATENCY_BUCKETS,
+    ) -> None:
+        """Initialize a histogram without any samples."""
+        super().__init__(name, documentation, labels)
+        self.buckets = buckets
+        # Per label set: the count in each bucket (not cumulative, the last is +Inf) and the sum.
+        self._values: dict[tuple[str, ...], tuple[list[int], list[float]]] = {}
+
+    def observe(self, value: float, *label_values: str) -> None:
+        """Record one observation for the given label values."""
+        entry = self._values.get(label_values)
+        if entry is None:
+            entry = self._values[label_values] = ([0] * (len(self.buckets) + 1), [0.0])
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1][0] += value
+
+    @contextlib.contextmanager
+    def time(self, *label_values: str) -> Iterator[None]:
+        """Observe how many seconds the block takes, including when it raises."""
+        start: float = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *label_values)
+
+    def _samples(self) -> list[str]:
+        lines: list[str] = []
+        for key, (counts, total) in self._values.items():
+            cumulative: int = 0
+            for bound, count in zip((*self.buckets, "+Inf"), counts, strict=True):
+                cumulative += count
+                bucket_label: str = 'le="' + str(bound) + '"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, bucket_label)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {total[0]}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {cumulative}")
+        return lines
+
+
+class Callback(Metric):
+    """Metric whose value is read from a function when the metrics are rendered.
+
+    The function returns a single value, or a dictionary of label value
+    tuples to values when the metric has labels.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        kind: str,
+        function: Callable[[], float | dict[tuple[str, ...], float]],
+        labels: tuple[str, ...] = (),
+    ) -> None:
+        """Initialize a metric read from function."""
+        super().__init__(name, documentation, labels)
+        self.kind = kind
+        self.function = function
+
+    def _samples(self) -> list[str]:
+        values = self.function()
+        if not isinstance(values, dict):
+            values = {(): values}
+        return [f"{self.name}{_format_labels(self.labels, key)} {value}" for key, value in values.items()]
+
+
+MetricT = TypeVar("MetricT", bound=Metric)
+
+
+class MetricsRegistry:
+    """Collection of metrics rendered together for the /metrics route."""
+
+    def __init__(self) -> None:
+        """Initialize an empty registry."""
+        self._metrics: dict[str, Metric] = {}
+
+    def counter(self, name: str, documentation: str, labels: tuple[str, ...] = ()) -> Counter:
+        """Create and register a Counter."""
+        return self._register(Counter(name, documentation, labels))
+
+    def gauge(self, name: str, documentation: str, labels: tuple[str, ...] = ()) -> Gauge:
+        """Create and register a Gauge."""
+        return self._register(Gauge(name, documentation, labels))
+
+    def histogram(self, name: str, documentation: str, labels: tuple[str, ...] = ()) -> Histogram:
+        """Create and register a Histogram with the latency buckets."""
+        return self._register(Histogram(name, documentation, labels))
+
+    def callback(
+        self,
+        name: str,
+        documentation: str,
+        kind: str,
+        function: Callable[[], float | dict[tuple[str, ...], float]],
+        labels: tuple[str, ...] = (),
+    ) -> Callback:
+        """Create and register a metric read from function when rendered."""
+        return self._register(Callback(name, documentation, kind, function, labels))
+
+    def render(self) -> str:
+        """Return every metric in the Prometheus text format."""
+        lines: list[str] = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def _register(self, metric: MetricT) -> MetricT:
+        if metric.name in self._metrics:
+            msg = f"Duplicate metric: {metric.name}"
+            raise ValueError(msg)
+        self._metrics[metric.name] = metric
+        return metric
+
+
+metrics: MetricsRegistry = MetricsRegistry()
+
+http_requests: Counter = metrics.counter(
+    "ddns_http_requests_total",
+    "HTTP requests handled, by route, method and status code.",
+    ("route", "method", "status"),
+)
+http_request_duration: Histogram = metrics.histogram(
+    "ddns_http_request_duration_seconds",
+    "Time to handle an HTTP request, including template rendering, by route and method.",
+    ("route", "method"),
+)
+http_requests_in_flight: Gauge = metrics.gauge("ddns_http_requests_in_flight", "HTTP requests being handled.")
+graph_call_duration: Histogram = metrics.histogram(
+    "ddns_graph_call_duration_seconds",
+    "Time taken by calls to Microsoft Graph and token requests, by tenant and operation.",
+    ("tenant", "operation"),
+)
+graph_errors: Counter = metrics.counter(
+    "ddns_graph_errors_total",
+    "Failed calls to Microsoft Graph and token requests, by tenant and operation.",
+    ("tenant", "operation"),
+)
+graph_calls_in_flight: Gauge = metrics.gauge("ddns_graph_calls_in_flight", "Calls to Microsoft Graph in progress.")
+config_duration: Histogram = metrics.histogram(
+    "ddns_config_duration_seconds",
+    "Time taken to load and write the configuration, by operation.",
+    ("operation",),
+)
+template_render_duration: Histogram = metrics.histogram(
+    "ddns_template_render_duration_seconds",
+    "Time taken to render a template, by template name.",
+    ("template",),
+)
+
+
+@contextlib.contextmanager
+def graph_call(tenant_id: str, operation: str) -> Iterator[None]:
+    """Time a Graph call and count it as an error if it raises.
+
+    Args:
+        tenant_id:
+            The tenant the call is made for.
+        operation:
+            The kind of call, for example "get", "list", "patch" or "token".
+
+    """
+    start: float = time.perf_counter()
+    graph_calls_in_flight.inc()
+    try:
+        yield
+    except Exception:
+        graph_errors.inc(tenant_id, operation)
+        raise
+    finally:
+        graph_calls_in_flight.dec()
+        graph_call_duration.observe(time.perf_counter() - start, tenant_id, operation)
+
+
+class MetricsMiddleware:
+    """ASGI middleware counting and timing HTTP requests per route.
+
+    The route is the path template of the matched FastAPI route, for
+    example /edit/{id_number}, so the number of label values stays small.
+    Requests that match no route are recorded as "unmatched".
+    """
+
+    def __init__(self, app: ASGIApp) -> None:
+        """Wrap the given ASGI application."""
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        """Handle a request, recording its status and duration."""
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status_code: int = 500
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        start: float = time.perf_counter()
+        http_requests_in_flight.inc()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            http_requests_in_flight.dec()
+            route = scope.get("route")
+            path: str = getattr(route, "path", "unmatched")
+            http_request_duration.observe(time.perf_counter() - start, path, scope["method"])
+            http_requests.inc(path, scope["method"], str(status_code))
+
+
+class TimedTemplates(Jinja2Templates):
+    """Jinja2Templates that records how long each template takes to render."""
+
+    def TemplateResponse(self, *args: object, **kwargs: object) -> object:  # noqa: N802
+        """Render a template response, timing the rendering."""
+        name = kwargs.get("name", args[1] if len(args) > 1 else "unknown")
+        with template_render_duration.time(str(name)):
+            return super().TemplateResponse(*args, **kwargs)
+
+    def render(self, request: Request, name: str, context: dict[str, object]) -> str:
+        """Render a template to a string, timing the rendering, for streamed responses."""
+        with template_render_duration.time(name):
+            return self.get_template(name).render({**context, "request": request})
@@ -0,0 +1,164 @@
+"""Module for finding drift between the config and Microsoft in the background.
+
+This module contains a scheduler that periodically compares the IP address
+of every configured Location with the IP address Microsoft has for it.
+Each tenant is listed once per pass, with the same bounded concurrency as
+the M365 list page.  The interval between passes is jittered, shortened
+after a pass that found failures or drift, and lengthened while everything
+matches.  Drift can optionally be repaired automatically.
+
+Typical usage example:
+
+    reconciler.start()
+    await reconciler.close()
+
+"""
+
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import logging
+import os
+import random
+
+from damping import flap_damper
+from graph import set_named_location_ips
+from ip_cache import ip_cache
+from utils import get_all_locations
+
+
+class Reconciler:
+    """Background task comparing configured Locations with Microsoft.
+
+    Attributes:
+        interval: float
+            Seconds until the next pass, adapted after every pass
+        min_interval: float
+            Shortest interval, used after repeated failures or drift
+        max_interval: float
+            Longest interval, reached while everything matches
+        jitter: float
+            Fraction of the interval added or removed at random
+        auto_repair: bool
+            Whether drifted Locations are updated with Microsoft
+        last_drift: list[str]
+            location_ids that drifted in the last pass
+        last_failed: list[str]
+            location_ids that could not be checked in the last pass
+
+    """
+
+    interval: float
+    min_interval: float
+    max_interval: float
+    jitter: float
+    auto_repair: bool
+    last_drift: list[str]
+    last_failed: list[str]
+
+    def __init__(
+        self,
+        *,
+        interval: float,
+        min_interval: float,
+        max_interval: float,
+        jitter: float,
+        auto_repair: bool,
+    ) -> None:
+        """Initialize a Reconciler with the given schedule.
+
+        Args:
+            interval:
+                Seconds between passes to start with, 0 disables the reconciler
+            min_interval:
+                Shortest interval, used after repeated failures or drift
+            max_interval:
+                Longest interval, reached while everything matches
+            jitter:
+                Fraction of the interval added or removed at random
+            auto_repair:
+                Whether drifted Locations are updated with Microsoft
+
+        """
+        self.interval = interval
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.jitter = jitter
+        self.auto_repair = auto_repair
+        self.last_drift = []
+        self.last_failed = []
+        self._task: asyncio.Task | None = None
+
+    def start(self) -> None:
+        """Start the reconciler task unless it is disabled."""
+        if self.interval > 0 and self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self) -> None:
+        """Stop the reconciler task."""
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+
+    async def reconcile(self) -> None:
+        """Compare every Location with Microsoft once and adapt the interval."""
+        logger: logging.Logger = logging.getLogger("uvicorn.error")
+
+        # Updates finishing while the tenants are listed invalidate their Locations, so older IPs are not cached
+        since: int = ip_cache.generation
+        bundles = await get_all_locations() or []
+
+        drifted = []
+        failed = []
+        for config_location, m365_location in bundles:
+            if m365_location is None or not m365_location.location_id:
+                failed.append(config_location.location_id)
+                continue
+            ip_cache.set(config_location.location_id, m365_location.ip_address, since=since)
+            if config_location.ip_address != m365_location.ip_address:
+                drifted.append(config_location)
+
+        self.last_drift = [location.location_id for location in drifted]
+        self.last_failed = failed
+
+        if drifted:
+            logger.warning("Found %d Locations that differ from Microsoft: %s", len(drifted), self.last_drift)
+        if failed:
+            logger.warning("Unable to check %d Locations with Microsoft: %s", len(failed), failed)
+
+        if drifted and self.auto_repair:
+            repairs = [
+                (location, location.ip_address) for location in drifted if not flap_damper.is_held(location.location_id)
+            ]
+            results: dict[str, bool] = await set_named_location_ips(repairs)
+            repaired: list[str] = [location_id for location_id, success in results.items() if success]
+            logger.info("Repaired %d Locations: %s", len(repaired), repaired)
+
+        if drifted or failed:
+            self.interval = max(self.min_interval, self.interval / 2)
+        else:
+            self.interval = min(self.max_interval, self.interval * 1.5)
+
+    async def _run(self) -> None:
+        logger: logging.Logger = logging.getLogger("uvicorn.error")
+
+        while True:
+            delay: float = self.interval * (1 + random.uniform(-self.jitter, self.jitter))  # noqa: S311
+            await asyncio.sleep(delay)
+            try:
+                await self.reconcile()
+            except Exception:
+                logger.exception("Reconciling Locations with Microsoft failed")
+                self.interval = max(self.min_interval, self.interval / 2)
+
+
+reconciler: Reconciler = Reconciler(
+    interval=float(os.getenv("RECONCILE_INTERVAL", "900")),
+    min_interval=float(os.getenv("RECONCILE_MIN_INTERVAL", "60")),
+    max_interval=float(os.getenv("RECONCILE_MAX_INTERVAL", "3600")),
+    jitter=float(os.getenv("RECONCILE_JITTER", "0.1")),
+    auto_repair=os.getenv("RECONCILE_AUTO_REPAIR", "false").lower() in {"1", "true", "yes"},
+)
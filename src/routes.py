@@ -3,20 +3,36 @@
 This module contains all the functions for the routes of the main application.
 """
 
+import asyncio
+import ipaddress
 import logging
 import os
+from collections.abc import AsyncIterator
 from typing import Annotated
 
 from fastapi import APIRouter, Form, Request, Response, status
-from fastapi.responses import RedirectResponse
-from fastapi.templating import Jinja2Templates
-
-from app_config import read_config, write_config
-from graph import get_current_location_ip, set_named_location_ip
-from location import Location, get_location_index_by_id, get_location_index_by_name
-from utils import check_authentication, get_all_locations
-
-templates = Jinja2Templates(directory="templates")
+from fastapi.responses import RedirectResponse, StreamingResponse
+
+from app_config import config_store, export_config
+from ddns import ddns_updater
+from graph import graph_pool, graph_scheduler, set_named_location_ip, set_named_location_ips
+from ip_cache import ip_cache
+from location import Location, LocationRegistry
+from metrics import TimedTemplates, metrics
+from snapshot import m365_snapshot
+from update_queue import update_queue
+from utils import (
+    bundle_locations,
+    cache_headers,
+    check_authentication,
+    etag_prefix,
+    has_drift,
+    list_page_size,
+    not_modified,
+    paginate,
+)
+
+templates = TimedTemplates(directory="templates")
 
 ddns_username: str | None = os.getenv("DDNS_USERNAME")
 ddns_password: str | None = os.getenv("DDNS_PASSWORD")
@@ -54,33 +70,26 @@ async def catch_all(request: Request, hostname: str = "", myip: str = "") -> Res
         logger.info("Invalid Authentication")
         return response
 
-    # Read the configuration from file and store as a list of Locations
-    config: list[Location] = read_config()
-
-    # Get the index to the location with the same name.
-    index: int | None = get_location_index_by_name(config, hostname)
-
-    # Get the current IP address for the Location from Microsoft
-    current_ip: str | None = await get_current_location_ip(config[index])
+    # Get the location with the same name from the in memory configuration.
+    location: Location | None = config_store.get_registry().get_by_name(hostname)
 
-    # Check the new IP received vs the configuration and Microsoft
-    # If current_ip from Microsoft is None, Error Out
-    # If it is the same between the receive IP and Microsoft, respond No Change
-    # If the new IP doesn't match Microsoft, update the config and Microsoft with new IP
-    if current_ip is None:
+    if location is None:
+        logger.info("Unable to find Location by Name")
         return Response(status_code=status.HTTP_400_BAD_REQUEST, content="Invalid Data")
 
-    if current_ip == myip:
-        return Response(status_code=status.HTTP_200_OK, content="nochg " + myip)
+    # In async mode, check the IP address, queue the update and answer the router at once
+    # Else apply the update, sharing or queueing behind any update running for the same Location
+    if update_queue.enabled:
+        try:
+            ipaddress.IPv4Address(myip)
+        except ValueError:
+            logger.info("Invalid IP Address", extra={"ip_address": myip})
+            return Response(status_code=status.HTTP_400_BAD_REQUEST, content="Invalid Data")
+        status_code, content = await update_queue.submit(location, myip)
+    else:
+        status_code, content = await ddns_updater.submit(location, myip)
 
-    config[index].ip_address = myip
-    write_config(config)
-    resp = await set_named_location_ip(config[index], myip)
-    if not resp:
-        logger.error("Updating IP on Microsoft Failed", extra={"host": request.client.host, "url": request.url})
-        return Response(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, content="Internal Server Error")
-
-    return Response(status_code=status.HTTP_200_OK, content="good " + myip)
+    return Response(status_code=status_code, content=content)
 
 
 @my_router.get("/admin")
@@ -109,20 +118,53 @@ async def admin_get(request: Request) -> Response:
         return response
 
     # Send the template HTML file as response.
-    return templates.TemplateResponse(request=request, name="admin.html", context={})
+    context: dict[str, object] = {
+        "ip_cache": ip_cache.stats(),
+        "throttle": graph_scheduler.states(),
+        "breakers": graph_scheduler.breaker_states(),
+    }
+    return templates.TemplateResponse(request=request, name="admin.html", context=context)
 
 
 @my_router.get("/list-m365")
-async def list_get_m365(request: Request) -> Response:
+async def list_get_m365(
+    request: Request,
+    *,
+    page: int = 1,
+    size: int = list_page_size,
+    tenant: str = "",
+    name: str = "",
+    drift: bool = False,
+    refresh: bool = False,
+    stream: bool = False,
+) -> Response:
     """Return a table of Locations in an html response, including Microsoft.
 
-    This function returns a response with a HTML page with a table of
-    Locations from the current config file, and also checks Microsoft's
-    current data for each location.
+    This function returns a response with a HTML page with a page of the
+    Locations from the current config file, and also Microsoft's data for
+    each location from the snapshot, with how old that data is.  When
+    streamed, the page is sent at once and the Microsoft columns of the
+    tenants that have to wait for Microsoft are filled in as each answers.
+    If neither the config nor the snapshot changed since the browser's
+    copy, and nothing has to wait for Microsoft, it returns 304.
 
     Args:
         request:
             The incomming HTTP Request
+        page:
+            HTTP Query parameter with the page number, starting from 1.
+        size:
+            HTTP Query parameter with the number of Locations per page.
+        tenant:
+            HTTP Query parameter to only show Locations in this tenant.
+        name:
+            HTTP Query parameter to only show Locations whose Display Name starts with it.
+        drift:
+            HTTP Query parameter to only show Locations that differ from Microsoft or where it is unavailable.
+        refresh:
+            HTTP Query parameter to wait for fresh data from Microsoft.
+        stream:
+            HTTP Query parameter to stream the page instead of waiting for every tenant.
 
     Returns:
             Response object to send back to the caller.
@@ -137,27 +179,113 @@ async def list_get_m365(request: Request) -> Response:
         logger.info("Invalid Authentication", extra={"host": request.client.host})
         return response
 
-    # Get updated locations from Microsoft and Config and receive a List of Tuples
-    config = await get_all_locations()
-
     # If the config is empty, error out
-    # Else return a template passing the config as context
-    if config is None:
+    registry: LocationRegistry = config_store.get_registry()
+    if len(registry) == 0:
         return Response(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, content="No Configuration File")
 
-    return templates.TemplateResponse(request=request, name="list_locations_m365.html", context={"configs": config})
+    locations: list[Location] = _find_locations(registry, tenant, name)
+    filters: dict[str, str] = {key: value for key, value in (("tenant", tenant), ("name", name)) if value}
+    if drift:
+        filters["drift"] = "true"
+
+    # If nothing has to wait for Microsoft and neither the config nor Microsoft's data changed, answer 304
+    if not refresh and not m365_snapshot.prepare(locations):
+        response = not_modified(request, *_m365_version(registry))
+        if response is not None:
+            return response
+
+    # Drift can only be known once Microsoft's data for every filtered Location is in, so it is never streamed
+    if drift:
+        tenant_results, age = await m365_snapshot.get(locations, force=refresh)
+        bundles = [bundle for bundle in bundle_locations(locations, tenant_results) or [] if has_drift(bundle)]
+        config, pager = paginate(bundles, page, size)
+    else:
+        locations, pager = paginate(locations, page, size)
+        if stream:
+            return StreamingResponse(
+                _stream_list_m365(request, locations, pager, filters, force=refresh),
+                media_type="text/html",
+            )
+        # Get the locations from Microsoft, refreshed if stale, and pair them with the Config in a List of Tuples
+        tenant_results, age = await m365_snapshot.get(locations, force=refresh)
+        config = bundle_locations(locations, tenant_results) or []
+
+    context: dict[str, object] = {
+        "configs": config,
+        "age": round(age),
+        "refreshing": m365_snapshot.refreshing,
+        "loading": set(),
+        "pager": pager,
+        "filters": filters,
+    }
+    return templates.TemplateResponse(
+        request=request,
+        name="list_locations_m365.html",
+        context=context,
+        headers=cache_headers(*_m365_version(registry)),
+    )
+
+
+async def _stream_list_m365(
+    request: Request,
+    locations: list[Location],
+    pager: dict[str, int],
+    filters: dict[str, str],
+    *,
+    force: bool,
+) -> AsyncIterator[str]:
+    """Yield the Location list with Microsoft's data, then the rows of each tenant that had to wait as it answers."""
+    locations_by_tenant: dict[tuple[str, str, str], list[Location]] = {}
+    for location in locations:
+        locations_by_tenant.setdefault(graph_pool.key(location), []).append(location)
+
+    waiting: set[tuple[str, str, str]] = m365_snapshot.prepare(locations, force=force)
+    ready: set[tuple[str, str, str]] = locations_by_tenant.keys() - waiting
+    context: dict[str, object] = {
+        "configs": bundle_locations(locations, {key: m365_snapshot.cached(key) for key in ready}) or [],
+        "age": round(m365_snapshot.age(ready)),
+        "refreshing": m365_snapshot.refreshing,
+        "loading": {location.location_id for key in waiting for location in locations_by_tenant[key]},
+        "pager": pager,
+        "filters": filters,
+    }
+    yield templates.render(request, "list_locations_m365.html", context)
+
+    for index, listed in enumerate(asyncio.as_completed([m365_snapshot.wait(key) for key in waiting])):
+        key, tenant_locations = await listed
+        context = {
+            "configs": bundle_locations(locations_by_tenant[key], {key: tenant_locations}),
+            "last": index == len(waiting) - 1,
+        }
+        yield templates.render(request, "list_locations_m365_rows.html", context)
 
 
 @my_router.get("/list")
-async def list_get(request: Request) -> Response:
+async def list_get(
+    request: Request,
+    page: int = 1,
+    size: int = list_page_size,
+    tenant: str = "",
+    name: str = "",
+) -> Response:
     """Return a table of Locations in an html response.
 
-    This function returns a response with a HTML page with a table of
-    Locations from the current config file.
+    This function returns a response with a HTML page with a page of the
+    Locations from the current config file.  If the config has not changed
+    since the browser's copy, it returns 304 without rendering the page.
 
     Args:
         request:
             The incomming HTTP Request
+        page:
+            HTTP Query parameter with the page number, starting from 1.
+        size:
+            HTTP Query parameter with the number of Locations per page.
+        tenant:
+            HTTP Query parameter to only show Locations in this tenant.
+        name:
+            HTTP Query parameter to only show Locations whose Display Name starts with it.
 
     Returns:
             Response object to send back to the caller.
@@ -172,15 +300,119 @@ async def list_get(request: Request) -> Response:
         logger.info("Invalid Authentication", extra={"host": request.client.host})
         return response
 
-    # Read the config which returns a list of Locations
-    configs = read_config()
+    # Get the in memory config, and answer 304 if it did not change since the browser's copy
+    registry: LocationRegistry = config_store.get_registry()
+    etag: str = f'"{etag_prefix}-{registry.version}"'
+    response = not_modified(request, etag, registry.modified)
+    if response is not None:
+        return response
+
+    configs, pager = paginate(_find_locations(registry, tenant, name), page, size)
+    filters: dict[str, str] = {key: value for key, value in (("tenant", tenant), ("name", name)) if value}
 
-    # If the config is empty, error out
-    # Else return a template passing the config as context
-    if configs is None:
-        return Response(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, content="Internal Server Error")
+    context: dict[str, object] = {"configs": configs, "pager": pager, "filters": filters}
+    return templates.TemplateResponse(
+        request=request,
+        name="list_locations.html",
+        context=context,
+        headers=cache_headers(etag, registry.modified),
+    )
+
+
+def _find_locations(registry: LocationRegistry, tenant: str, name: str) -> list[Location]:
+    """Return the Locations matching the filters, in config order if there are none."""
+    if tenant or name:
+        return registry.find(tenant_id=tenant, name_prefix=name)
+    return list(registry)
+
+
+def _m365_version(registry: LocationRegistry) -> tuple[str, float]:
+    """Return the ETag and last modification time of the Location list with Microsoft's data."""
+    state: str = "r" if m365_snapshot.refreshing else "s"
+    etag: str = f'"{etag_prefix}-{registry.version}-{m365_snapshot.version}-{state}"'
+    return etag, max(registry.modified, m365_snapshot.modified)
+
+
+@my_router.get("/update-status")
+async def update_status_get(request: Request) -> Response:
+    """Return a table of the DDNS updates queued for Microsoft in an html response.
+
+    This function returns a response with a HTML page showing, for each
+    Location that checked in while async mode is on, whether its last
+    reported IP address is pending, held, applied or failed.
+
+    Args:
+        request:
+            The incomming HTTP Request
+
+    Returns:
+            Response object to send back to the caller.
+
+    """
+    logger: logging.Logger = logging.getLogger("uvicorn.error")
+
+    authorized, response = await check_authentication(request, admin_username, admin_password)
+    if not authorized:
+        logger.info("Invalid Authentication", extra={"host": request.client.host})
+        return response
+
+    context: dict[str, object] = {
+        "enabled": update_queue.enabled,
+        "counts": update_queue.counts(),
+        "updates": update_queue.states(),
+    }
+    return templates.TemplateResponse(request=request, name="update_status.html", context=context)
+
+
+@my_router.get("/export")
+async def export_get(request: Request) -> Response:
+    """Return every configured Location as a config.yaml download.
+
+    This works with any storage backend, so it can be used to back up a
+    SQLite database or to move back to config.yaml.
+
+    Args:
+        request:
+            The incomming HTTP Request
+
+    Returns:
+            Response object to send back to the caller.
+
+    """
+    logger: logging.Logger = logging.getLogger("uvicorn.error")
+
+    authorized, response = await check_authentication(request, admin_username, admin_password)
+    if not authorized:
+        logger.info("Invalid Authentication", extra={"host": request.client.host})
+        return response
+
+    return Response(
+        content=export_config(),
+        media_type="application/yaml",
+        headers={"Content-Disposition": 'attachment; filename="config.yml"'},
+    )
+
+
+@my_router.get("/metrics")
+async def metrics_get(request: Request) -> Response:
+    """Return the application metrics in the Prometheus text format.
+
+    Args:
+        request:
+            The incomming HTTP Request
 
-    return templates.TemplateResponse(request=request, name="list_locations.html", context={"configs": configs})
+    Returns:
+            Response object to send back to the caller.
+
+    """
+    logger: logging.Logger = logging.getLogger("uvicorn.error")
+
+    authorized, response = await check_authentication(request, admin_username, admin_password)
+    if not authorized:
+        logger.info("Invalid Authentication", extra={"host": request.client.host})
+        return response
+
+    return Response(content=metrics.render(), media_type="text/plain; version=0.0.4")
 
 
 @my_router.get("/add")
@@ -253,8 +485,6 @@ async def add_location_post(
         logger.info("Invalid Authentication", extra={"host": request.client.host})
         return response
 
-    config: list[Location] = read_config()
-
     loc = Location(
         location_id=location_id,
         display_name=display_name,
@@ -264,8 +494,11 @@ async def add_location_post(
         client_secret=client_secret,
         tenant_id=tenant_id,
     )
-    config.append(loc)
-    write_config(config)
+    try:
+        config_store.add(loc)
+    except ValueError:
+        logger.info("Location ID or Display Name already in use")
+        return Response(status_code=status.HTTP_400_BAD_REQUEST, content="Invalid Data")
 
     return RedirectResponse(url="/admin", status_code=302)
 
@@ -294,19 +527,17 @@ async def edit_location_get(request: Request, id_number: str) -> Response:
         logger.info("Invalid Authentication", extra={"host": request.client.host})
         return response
 
-    configs: list[Location] = read_config()
-
-    index: int | None = get_location_index_by_id(configs, id_number)
+    location: Location | None = config_store.get_registry().get_by_id(id_number)
 
-    if index is None:
+    if location is None:
         return Response(status_code=status.HTTP_400_BAD_REQUEST, content="Invalid Data")
 
-    action: str = "/edit/" + configs[index].location_id
+    action: str = "/edit/" + location.location_id
 
     return templates.TemplateResponse(
         request=request,
         name="edit_location.html",
-        context={"config": configs[index], "action": action},
+        context={"config": location, "action": action},
     )
 
 
@@ -358,30 +589,36 @@ async def edit_location_post(
         logger.info("Invalid Authentication", extra={"host": request.client.host})
         return response
 
-    configs: list[Location] = read_config()
-
-    index: int | None = get_location_index_by_id(configs, id_number)
+    location: Location | None = config_store.get_registry().get_by_id(id_number)
 
-    if index is None:
+    if location is None:
         logger.info("Unable to find Location by ID")
         return Response(status_code=status.HTTP_400_BAD_REQUEST, content="Invalid Data")
 
     logger.info(
         "Received an update request",
-        extra={"location": configs[index].location_id, "old_data": configs[index]},
+        extra={"location": location.location_id, "old_data": location},
     )
 
-    configs[index].location_id = location_id
-    configs[index].display_name = display_name
-    configs[index].ip_address = ip_address
-    configs[index].is_trusted = is_trusted
-    configs[index].client_id = client_id
-    configs[index].client_secret = client_secret
-    configs[index].tenant_id = tenant_id
+    try:
+        location = config_store.update(
+            id_number,
+            location_id=location_id,
+            display_name=display_name,
+            ip_address=ip_address,
+            is_trusted=is_trusted,
+            client_id=client_id,
+            client_secret=client_secret,
+            tenant_id=tenant_id,
+        )
+    except ValueError:
+        logger.info("Location ID or Display Name already in use")
+        return Response(status_code=status.HTTP_400_BAD_REQUEST, content="Invalid Data")
 
-    logger.info("Storing new data", extra={"new_data": configs[index]})
+    logger.info("Storing new data", extra={"new_data": location})
 
-    write_config(configs)
+    ip_cache.invalidate(id_number)
+    ip_cache.invalidate(location_id)
 
     return RedirectResponse(url="/list-m365", status_code=302)
 
@@ -410,25 +647,24 @@ async def update_location_get(request: Request, id_number: str = id) -> Response
         logger.info("Invalid Authentication", extra={"host": request.client.host})
         return response
 
-    configs: list[Location] = read_config()
+    location: Location | None = config_store.get_registry().get_by_id(id_number)
 
-    index: int | None = get_location_index_by_id(configs, id_number)
-
-    if index is None:
+    if location is None:
         logger.info("Unable to find Location by ID")
         return Response(status_code=status.HTTP_400_BAD_REQUEST, content="Invalid Data")
 
     logger.info(
         "Received an update request",
-        extra={"location": configs[index].location_id, "old_data": configs[index]},
+        extra={"location": location.location_id, "old_data": location},
     )
 
-    resp = await set_named_location_ip(configs[index], configs[index].ip_address)
+    resp = await set_named_location_ip(location, location.ip_address)
+    m365_snapshot.invalidate()
 
     if not resp:
         logger.error(
             "Updating IP on Microsoft Failed",
-            extra={"location_id": configs[index].location_id, "ip_address": configs[index].ip_address},
+            extra={"location_id": location.location_id, "ip_address": location.ip_address},
         )
 
         return Response(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, content="Internal Server Error")
@@ -436,6 +672,41 @@ async def update_location_get(request: Request, id_number: str = id) -> Response
     return RedirectResponse(url="/list-m365", status_code=302)
 
 
+@my_router.get("/update-all")
+async def update_all_locations_get(request: Request) -> Response:
+    """Update Microsoft Graph API with the IP addresses of every Location.
+
+    This function pushes the configured IP address of every Location to
+    Microsoft, batching the updates per tenant.
+
+    Args:
+        request:
+            The incomming HTTP Request
+
+    Returns:
+            Response object to send back to the caller.
+
+    """
+    logger: logging.Logger = logging.getLogger("uvicorn.error")
+
+    authorized, response = await check_authentication(request, admin_username, admin_password)
+    if not authorized:
+        logger.info("Invalid Authentication", extra={"host": request.client.host})
+        return response
+
+    configs: list[Location] = config_store.get_locations()
+
+    results: dict[str, bool] = await set_named_location_ips([(loc, loc.ip_address) for loc in configs])
+    m365_snapshot.invalidate()
+
+    failed: list[str] = [location_id for location_id, success in results.items() if not success]
+    if failed:
+        logger.error("Updating IP on Microsoft Failed", extra={"location_ids": failed})
+        return Response(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, content="Internal Server Error")
+
+    return RedirectResponse(url="/list-m365", status_code=302)
+
+
 @my_router.get("/delete/{id_number}")
 async def delete_location_get(request: Request, id_number: str) -> Response:
     """Return a Location form filled in with current data of Location id.
@@ -461,19 +732,17 @@ async def delete_location_get(request: Request, id_number: str) -> Response:
         logger.info("Invalid Authentication", extra={"host": request.client.host})
         return response
 
-    configs: list[Location] = read_config()
-
-    index: int | None = get_location_index_by_id(configs, id_number)
+    location: Location | None = config_store.get_registry().get_by_id(id_number)
 
-    if index is None:
+    if location is None:
         return Response(status_code=status.HTTP_400_BAD_REQUEST, content="Invalid Data")
 
-    action: str = "/delete/" + configs[index].location_id
+    action: str = "/delete/" + location.location_id
 
     return templates.TemplateResponse(
         request=request,
         name="delete_location.html",
-        context={"config": configs[index], "action": action},
+        context={"config": location, "action": action},
     )
 
 
@@ -508,26 +777,24 @@ async def delete_location_post(
         logger.info("Invalid Authentication", extra={"host": request.client.host})
         return response
 
-    configs: list[Location] = read_config()
-
-    index: int | None = get_location_index_by_id(configs, id_number)
+    location: Location | None = config_store.get_registry().get_by_id(id_number)
 
-    if index is None:
+    if location is None:
         logger.info("Unable to find Location by ID")
         return Response(status_code=status.HTTP_400_BAD_REQUEST, content="Invalid Data")
 
     if deletion_confirmed:
-        logger.info("Received an delete request 2nd confirmation, Location_ID: %s", configs[index].location_id)
-        logger.info("Deleting Location: %s", configs[index])
-        del configs[index]
-        write_config(configs)
+        logger.info("Received an delete request 2nd confirmation, Location_ID: %s", location.location_id)
+        logger.info("Deleting Location: %s", location)
+        ip_cache.invalidate(location.location_id)
+        config_store.remove(location.location_id)
         return RedirectResponse(url="/list", status_code=302)
 
-    logger.info("Received an delete request 1st confirmation, Location_ID: %s", configs[index].location_id)
-    action: str = "/delete/" + configs[index].location_id
+    logger.info("Received an delete request 1st confirmation, Location_ID: %s", location.location_id)
+    action: str = "/delete/" + location.location_id
 
     return templates.TemplateResponse(
         request=request,
         name="delete_location_confirm.html",
-        context={"config": configs[index], "action": action},
+        context={"config": location, "action": action},
     )
@@ -0,0 +1,269 @@
+"""Module for caching Microsoft's view of the Named Locations for the admin pages.
+
+This module contains a snapshot of every tenant's Named Locations, so the
+/list-m365 page can be served at once instead of listing every tenant on
+each load.  The snapshot is paired with the current config when a page is
+rendered, so edits to the config show up immediately, and the page shows
+how old Microsoft's data is.  Once the snapshot is older than its ttl the
+next page load starts a refresh in the background and is still served the
+stale data.  Concurrent refreshes are shared, so any number of admins
+reloading the page cause one listing per tenant.
+
+Pages can also be streamed, showing the tenants in the snapshot at once
+and each tenant that has to wait for Microsoft as soon as it is listed.
+
+Typical usage example:
+
+    tenant_results, age = await m365_snapshot.get(config)
+    tenant_results, age = await m365_snapshot.get(config, force=True)
+    for key in m365_snapshot.prepare(config, force=True):
+        key, tenant_locations = await m365_snapshot.wait(key)
+    m365_snapshot.invalidate()
+    await m365_snapshot.close()
+
+"""
+
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import logging
+import os
+import time
+from typing import TYPE_CHECKING
+
+from app_config import config_store
+from graph import graph_pool
+from metrics import metrics
+from utils import iter_locations_by_tenant
+
+if TYPE_CHECKING:
+    from collections.abc import Iterable
+
+    from location import Location
+
+
+class MicrosoftSnapshot:
+    """Stale-while-revalidate cache of the Named Locations of every tenant.
+
+    Each tenant's Named Locations are kept with the time they were listed.
+    A tenant that fails to list keeps its previous Named Locations, and is
+    only marked unavailable if it was never listed.  A ttl of 0 disables
+    the cache, so every page load waits for a refresh, which is still
+    shared between concurrent page loads.
+
+    Attributes:
+        ttl: float
+            Seconds before the snapshot is refreshed in the background
+        refreshes: int
+            Number of refreshes started
+        version: int
+            Incremented whenever the snapshot changes
+        modified: float
+            When the snapshot last changed, in seconds since the epoch
+
+    """
+
+    ttl: float
+    refreshes: int
+    version: int
+    modified: float
+
+    def __init__(self, ttl: float) -> None:
+        """Initialize an empty snapshot.
+
+        Args:
+            ttl:
+                Seconds before the snapshot is refreshed in the background
+
+        """
+        self.ttl = ttl
+        self.refreshes = 0
+        self.version = 0
+        self.modified = time.time()
+        self._tenants: dict[tuple[str, str, str], tuple[dict[str, Location] | None, float]] = {}
+        self._generation: int = 0
+        self._pending: dict[tuple[str, str, str], asyncio.Future[None]] = {}
+        self._tasks: set[asyncio.Task] = set()
+
+    @property
+    def refreshing(self) -> bool:
+        """Whether a refresh is running."""
+        return bool(self._tasks)
+
+    async def get(
+        self,
+        config: list[Location],
+        *,
+        force: bool = False,
+    ) -> tuple[dict[tuple[str, str, str], dict[str, Location] | None], float]:
+        """Return the Named Locations of every tenant used by config.
+
+        Waits for the tenants returned by prepare, and returns the others
+        from the snapshot at once.
+
+        Args:
+            config:
+                The Locations whose tenants are returned.
+            force:
+                Whether to wait for fresh data from Microsoft.
+
+        Returns:
+            Tuple of the Named Locations by graph_pool key, as returned by
+            get_locations_by_tenant, and the age in seconds of the oldest
+            tenant's data.
+
+        """
+        await asyncio.gather(*(self.wait(key) for key in self.prepare(config, force=force)))
+        keys: set[tuple[str, str, str]] = {graph_pool.key(location) for location in config}
+        return {key: self.cached(key) for key in keys}, self.age(keys)
+
+    def prepare(self, config: list[Location], *, force: bool = False) -> set[tuple[str, str, str]]:
+        """Start a refresh if one is needed, returning the tenants that have to wait for it.
+
+        Every tenant has to wait if force is set or the cache is disabled,
+        and tenants that were never listed always have to.  Otherwise a
+        stale snapshot is refreshed in the background and nothing waits.
+
+        Args:
+            config:
+                The Locations whose tenants are about to be shown.
+            force:
+                Whether to wait for fresh data from Microsoft.
+
+        Returns:
+            The graph_pool keys of the tenants to pass to wait.
+
+        """
+        keys: set[tuple[str, str, str]] = {graph_pool.key(location) for location in config}
+
+        waiting: set[tuple[str, str, str]] = keys if force or self.ttl <= 0 else keys - self._tenants.keys()
+        if waiting:
+            # Join the running refresh if it lists every tenant waited for
+            if not waiting <= self._pending.keys():
+                self._start_refresh()
+        elif not self._tasks and self.age(keys) >= self.ttl:
+            self._start_refresh()
+        return waiting
+
+    async def wait(self, key: tuple[str, str, str]) -> tuple[tuple[str, str, str], dict[str, Location] | None]:
+        """Wait until the running refresh has listed a tenant.
+
+        Args:
+            key:
+                The graph_pool key of the tenant.
+
+        Returns:
+            Tuple of key and the tenant's Named Locations, as returned by cached.
+
+        """
+        future: asyncio.Future[None] | None = self._pending.get(key)
+        if future is not None:
+            await asyncio.shield(future)
+        return key, self.cached(key)
+
+    def cached(self, key: tuple[str, str, str]) -> dict[str, Location] | None:
+        """Return a tenant's Named Locations from the snapshot, or None if it is unavailable."""
+        entry: tuple[dict[str, Location] | None, float] | None = self._tenants.get(key)
+        return None if entry is None else entry[0]
+
+    def age(self, keys: Iterable[tuple[str, str, str]]) -> float:
+        """Return the age in seconds of the oldest of the tenants' data in the snapshot."""
+        now: float = time.monotonic()
+        return max((now - self._tenants[key][1] for key in keys if key in self._tenants), default=0.0)
+
+    def invalidate(self) -> None:
+        """Drop the snapshot, so the next page load waits for fresh data.
+
+        Used after the admin pages change Microsoft, so they show the change.
+        A refresh that is already running may have listed a tenant before
+        the change, so its results are discarded.
+        """
+        self._tenants.clear()
+        self._generation += 1
+        self._pending = {}
+        self._changed()
+
+    def stats(self) -> dict[str, float]:
+        """Return the number of tenants, the age of the oldest and the refreshes started."""
+        return {
+            "tenants": len(self._tenants),
+            "age": self.age(self._tenants.keys()),
+            "refreshes": self.refreshes,
+        }
+
+    async def close(self) -> None:
+        """Cancel the running refreshes."""
+        tasks: list[asyncio.Task] = list(self._tasks)
+        for task in tasks:
+            task.cancel()
+        for task in tasks:
+            with contextlib.suppress(asyncio.CancelledError):
+                await task
+
+    def _start_refresh(self) -> None:
+        config: list[Location] = config_store.get_locations()
+        loop = asyncio.get_running_loop()
+        futures: dict[tuple[str, str, str], asyncio.Future[None]] = {
+            graph_pool.key(location): loop.create_future() for location in config
+        }
+        self._pending.update(futures)
+        self.refreshes += 1
+        task: asyncio.Task = asyncio.create_task(self._refresh(config, futures, self._generation))
+        self._tasks.add(task)
+        task.add_done_callback(self._refreshed)
+
+    async def _refresh(
+        self,
+        config: list[Location],
+        futures: dict[tuple[str, str, str], asyncio.Future[None]],
+        generation: int,
+    ) -> None:
+        try:
+            async for key, tenant_locations in iter_locations_by_tenant(config):
+                # A tenant that failed keeps its older data, and nothing is kept once invalidated
+                if generation == self._generation and (tenant_locations is not None or key not in self._tenants):
+                    self._tenants[key] = (tenant_locations, time.monotonic())
+                    self._changed()
+                self._resolve(key, futures[key])
+
+            # Forget tenants that are no longer in the config
+            if generation == self._generation:
+                for key in self._tenants.keys() - futures.keys():
+                    del self._tenants[key]
+                    self._changed()
+        finally:
+            for key, future in futures.items():
+                self._resolve(key, future)
+
+    def _changed(self) -> None:
+        self.version += 1
+        self.modified = time.time()
+
+    def _resolve(self, key: tuple[str, str, str], future: asyncio.Future[None]) -> None:
+        if not future.done():
+            future.set_result(None)
+        if self._pending.get(key) is future:
+            del self._pending[key]
+
+    def _refreshed(self, task: asyncio.Task) -> None:
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger: logging.Logger = logging.getLogger("uvicorn.error")
+            logger.error("Refreshing the Microsoft snapshot failed", exc_info=task.exception())
+
+
+m365_snapshot: MicrosoftSnapshot = MicrosoftSnapshot(float(os.getenv("M365_SNAPSHOT_TTL", "60")))
+
+metrics.callback(
+    "ddns_m365_snapshot_age_seconds",
+    "Age of the oldest tenant's Named Locations cached for the admin pages.",
+    "gauge",
+    lambda: m365_snapshot.stats()["age"],
+)
+metrics.callback(
+    "ddns_m365_snapshot_refreshes_total",
+    "Refreshes of the Named Locations cached for the admin pages.",
+    "counter",
+    lambda: m365_snapshot.refreshes,
+)
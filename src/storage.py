@@ -0,0 +1,332 @@
+"""Module defining the storage backends for the configured Locations.
+
+This module contains the Storage interface used by the ConfigStore, and
+two backends.  YamlStorage keeps the Locations in config.yaml, rewriting
+the whole file atomically on every write, or when it is shared by several
+worker processes, merging the changes into the file under a file lock
+first.  SqliteStorage keeps them in a
+SQLite database in WAL mode, updating only the rows that changed by
+their location_id primary key.
+
+Typical usage example:
+
+    storage: Storage = YamlStorage(Path("config/config.yml"))
+    storage: Storage = SqliteStorage(Path("config/locations.db"), import_from=yaml_storage)
+    [Locations] = storage.load()
+    storage.write([Locations], {location_id: Location})
+
+"""
+
+from __future__ import annotations
+
+import contextlib
+import logging
+import os
+import sqlite3
+import tempfile
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+import yaml
+
+from location import Location
+
+if TYPE_CHECKING:
+    from collections.abc import Hashable
+
+    from workers import FileLock
+
+try:
+    from yaml import CSafeDumper as SafeDumper
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeDumper, SafeLoader
+
+
+class Storage(ABC):
+    """Interface for persisting the configured Locations."""
+
+    @abstractmethod
+    def load(self) -> list[Location]:
+        """Return every stored Location in order."""
+
+    @abstractmethod
+    def signature(self) -> Hashable | None:
+        """Return a value that changes whenever the stored Locations change."""
+
+    @abstractmethod
+    def write(self, locations: list[Location], changed: dict[str, Location | None]) -> None:
+        """Persist the Locations.
+
+        Called from a worker thread.
+
+        Args:
+            locations:
+                Every Location, in order.
+            changed:
+                location_ids changed since the last write, mapped to the
+                Location now stored under that ID or None if it was removed.
+
+        """
+
+    def close(self) -> None:  # noqa: B027
+        """Release any resources held by the backend."""
+
+
+class YamlStorage(Storage):
+    """Locations stored in a YAML file, rewritten atomically on every write.
+
+    With a lock, the file is shared with other processes.  Each write then
+    reads the file again under the lock and only replaces the Locations
+    that changed, so changes written by another process are kept.
+
+    Attributes:
+        path: Path
+            The YAML file
+        lock: FileLock | None
+            Lock held while the file is read and written, when it is shared
+
+    """
+
+    path: Path
+    lock: FileLock | None
+
+    def __init__(self, path: Path, lock: FileLock | None = None) -> None:
+        """Initialize YamlStorage for the given file.
+
+        Args:
+            path:
+                The YAML file
+            lock:
+                Lock held while the file is read and written, when it is shared
+
+        """
+        self.path = path
+        self.lock = lock
+
+    def __str__(self) -> str:
+        """Return the path of the YAML file."""
+        return str(self.path)
+
+    def load(self) -> list[Location]:
+        """Read the YAML file, returning no Locations if it does not exist."""
+        try:
+            with self.path.open() as file_object:
+                data: any = yaml.load(file_object, Loader=SafeLoader)
+        except FileNotFoundError:
+            return []
+        return [Location.from_dict(location) for location in data or []]
+
+    def signature(self) -> tuple[int, int, int] | None:
+        """Return the inode, modification time and size of the YAML file."""
+        try:
+            stat = self.path.stat()
+        except FileNotFoundError:
+            return None
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    def write(self, locations: list[Location], changed: dict[str, Location | None]) -> None:
+        """Rewrite the YAML file with every Location.
+
+        The file is written to a temporary file in the same directory, synced
+        to disk and renamed over the YAML file, so readers never see a
+        partially written file.
+
+        Args:
+            locations:
+                Every Location, in order.
+            changed:
+                location_ids changed since the last write, only used when the file is shared.
+
+        """
+        if self.lock is None:
+            self._replace(locations)
+            return
+
+        with self.lock:
+            merged: dict[str, Location] = {location.location_id: location for location in self.load()}
+            for location_id, location in changed.items():
+                if location is None:
+                    merged.pop(location_id, None)
+                else:
+                    merged[location_id] = location
+            self._replace(list(merged.values()))
+
+    def _replace(self, locations: list[Location]) -> None:
+        file_descriptor, temp_name = tempfile.mkstemp(dir=self.path.parent, prefix=".config-", suffix=".tmp")
+        temp_path = Path(temp_name)
+        try:
+            with os.fdopen(file_descriptor, "w") as file_object:
+                file_object.write(export_yaml(locations))
+                file_object.flush()
+                os.fsync(file_object.fileno())
+            with contextlib.suppress(FileNotFoundError):
+                temp_path.chmod(self.path.stat().st_mode)
+            temp_path.replace(self.path)
+        except BaseException:
+            temp_path.unlink(missing_ok=True)
+            raise
+
+        directory_descriptor = os.open(self.path.parent, os.O_RDONLY)
+        try:
+            os.fsync(directory_descriptor)
+        finally:
+            os.close(directory_descriptor)
+
+
+class SqliteStorage(Storage):
+    """Locations stored in a SQLite database in WAL mode.
+
+    Writes only touch the rows of Locations that changed, found by their
+    location_id primary key.  Lookups are served by the LocationRegistry
+    loaded from the whole table, so no other index is kept.  On first start,
+    an empty database imports the Locations of another backend, generally
+    the existing config.yaml.
+
+    Attributes:
+        path: Path
+            The SQLite database file
+
+    """
+
+    path: Path
+
+    def __init__(self, path: Path, import_from: Storage | None = None) -> None:
+        """Open the database, creating and populating it if needed.
+
+        Args:
+            path:
+                The SQLite database file
+            import_from:
+                Backend whose Locations are imported into a new database.
+
+        """
+        logger: logging.Logger = logging.getLogger("uvicorn.error")
+
+        self.path = path
+        # The store is created before the event loop starts and writes from a worker thread,
+        # so neither connection is tied to the thread that opened it.
+        self._reader: sqlite3.Connection = self._connect()
+        self._writer: sqlite3.Connection = self._connect()
+
+        with self._writer:
+            self._writer.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS locations (
+                    location_id TEXT PRIMARY KEY,
+                    display_name TEXT,
+                    ip_address TEXT,
+                    is_trusted INTEGER,
+                    client_id TEXT,
+                    client_secret TEXT,
+                    tenant_id TEXT
+                );
+                DROP INDEX IF EXISTS locations_display_name;
+                DROP INDEX IF EXISTS locations_tenant_id;
+                CREATE TABLE IF NOT EXISTS metadata (key TEXT PRIMARY KEY, value TEXT);
+                """,
+            )
+            imported = self._writer.execute("SELECT value FROM metadata WHERE key = 'imported'").fetchone()
+            if imported is None:
+                locations: list[Location] = import_from.load() if import_from is not None else []
+                self._upsert(locations)
+                self._writer.execute(
+                    "INSERT OR IGNORE INTO metadata (key, value) VALUES ('imported', ?)",
+                    (str(import_from),),
+                )
+                logger.info("Imported %d locations from %s into %s", len(locations), import_from, self.path)
+
+    def __str__(self) -> str:
+        """Return the path of the database."""
+        return str(self.path)
+
+    def load(self) -> list[Location]:
+        """Read every Location from the database in insertion order."""
+        rows = self._reader.execute(
+            "SELECT client_id, client_secret, display_name, ip_address, is_trusted, location_id, tenant_id "
+            "FROM locations ORDER BY rowid",
+        ).fetchall()
+        return [
+            Location(
+                client_id=client_id,
+                client_secret=client_secret,
+                display_name=display_name,
+                ip_address=ip_address,
+                is_trusted=bool(is_trusted),
+                location_id=location_id,
+                tenant_id=tenant_id,
+            )
+            for client_id, client_secret, display_name, ip_address, is_trusted, location_id, tenant_id in rows
+        ]
+
+    def signature(self) -> int:
+        """Return SQLite's data_version, which changes when another connection commits."""
+        return self._reader.execute("PRAGMA data_version").fetchone()[0]
+
+    def write(self, locations: list[Location], changed: dict[str, Location | None]) -> None:  # noqa: ARG002
+        """Update the rows of the changed Locations in one transaction.
+
+        Args:
+            locations:
+                Not used, only the changed rows are written.
+            changed:
+                location_ids changed since the last write, mapped to the
+                Location now stored under that ID or None if it was removed.
+
+        """
+        with self._writer:
+            self._writer.executemany(
+                "DELETE FROM locations WHERE location_id = ?",
+                [(location_id,) for location_id, location in changed.items() if location is None],
+            )
+            self._upsert([location for location in changed.values() if location is not None])
+
+    def close(self) -> None:
+        """Close the database connections."""
+        self._reader.close()
+        self._writer.close()
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.path, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.execute("PRAGMA busy_timeout=5000")
+        return connection
+
+    def _upsert(self, locations: list[Location]) -> None:
+        self._writer.executemany(
+            "INSERT INTO locations "
+            "(location_id, display_name, ip_address, is_trusted, client_id, client_secret, tenant_id) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (location_id) DO UPDATE SET "
+            "display_name = excluded.display_name, ip_address = excluded.ip_address, "
+            "is_trusted = excluded.is_trusted, client_id = excluded.client_id, "
+            "client_secret = excluded.client_secret, tenant_id = excluded.tenant_id",
+            [
+                (
+                    location.location_id,
+                    location.display_name,
+                    location.ip_address,
+                    location.is_trusted,
+                    location.client_id,
+                    location.client_secret,
+                    location.tenant_id,
+                )
+                for location in locations
+            ],
+        )
+
+
+def export_yaml(locations: list[Location]) -> str:
+    """Return the Locations in the config.yaml format.
+
+    Args:
+        locations:
+            The Locations to export.
+
+    Returns:
+        The YAML document as a string.
+
+    """
+    return yaml.dump([location.to_dict() for location in locations], Dumper=SafeDumper)
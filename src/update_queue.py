@@ -0,0 +1,317 @@
+"""Module for applying DDNS updates to Microsoft in the background.
+
+This module contains an optional queue for DDNS check-ins.  When it is
+enabled the DDNS route validates a check-in, records the new IP address in
+the config and answers the router with "good" at once, and a pool of
+worker tasks applies the change to Microsoft.  Changes that fail because
+Graph is unavailable or returned an error are retried with a growing
+delay.  The state of the last check-in for each Location is kept for the
+update status page.
+
+The queue is disabled unless DDNS_ASYNC is set.
+
+Typical usage example:
+
+    update_queue.start()
+    status_code, content = await update_queue.submit(location, myip)
+    await update_queue.close()
+
+"""
+
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import functools
+import logging
+import os
+import time
+from typing import TYPE_CHECKING
+
+from fastapi import status
+
+from app_config import config_store
+from damping import flap_damper
+from ddns import ddns_updater
+from graph import graph_scheduler
+from ip_cache import ip_cache
+from metrics import metrics
+
+if TYPE_CHECKING:
+    from location import Location
+
+# States an update can be in, in the order they are shown.
+UPDATE_STATES: tuple[str, ...] = ("pending", "applying", "held", "applied", "failed")
+
+
+class _Update:
+    """The latest check-in for one Location and how far it has been applied."""
+
+    def __init__(self, location: Location, ip_address: str) -> None:
+        self.location: Location = location
+        self.ip_address: str = ip_address
+        self.state: str = "pending"
+        self.attempts: int = 0
+        self.error: str = ""
+        self.updated: float = time.time()
+        self.queued: bool = False
+        self.running: bool = False
+        self.retry: asyncio.TimerHandle | None = None
+
+
+class UpdateQueue:
+    """Queue of DDNS updates applied to Microsoft by worker tasks.
+
+    Each Location is queued at most once, and a newer check-in replaces the
+    IP address waiting to be applied, so only the last reported IP address
+    is sent to Microsoft.  Updates go through the DDNS updater, so they are
+    still coalesced, flap damped and throttled like synchronous check-ins.
+
+    Attributes:
+        enabled: bool
+            Whether the DDNS route uses the queue
+        workers: int
+            Number of worker tasks applying updates
+        max_attempts: int
+            Attempts before an update is marked as failed
+        retry_delay: float
+            Seconds before the first retry, doubled for every further retry
+        max_retry_delay: float
+            Longest delay in seconds between retries
+
+    """
+
+    enabled: bool
+    workers: int
+    max_attempts: int
+    retry_delay: float
+    max_retry_delay: float
+
+    def __init__(
+        self,
+        *,
+        enabled: bool,
+        workers: int,
+        max_attempts: int,
+        retry_delay: float,
+        max_retry_delay: float,
+    ) -> None:
+        """Initialize an empty UpdateQueue.
+
+        Args:
+            enabled:
+                Whether the DDNS route uses the queue
+            workers:
+                Number of worker tasks applying updates
+            max_attempts:
+                Attempts before an update is marked as failed
+            retry_delay:
+                Seconds before the first retry, doubled for every further retry
+            max_retry_delay:
+                Longest delay in seconds between retries
+
+        """
+        self.enabled = enabled
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self._updates: dict[str, _Update] = {}
+        self._queue: asyncio.Queue[str] = asyncio.Queue()
+        self._tasks: list[asyncio.Task] = []
+
+    @property
+    def depth(self) -> int:
+        """Number of updates waiting for a worker."""
+        return self._queue.qsize()
+
+    def start(self) -> None:
+        """Start the worker tasks unless the queue is disabled."""
+        if self.enabled and not self._tasks:
+            self._tasks = [asyncio.create_task(self._work()) for _ in range(max(1, self.workers))]
+
+    async def close(self) -> None:
+        """Stop the worker tasks and cancel scheduled retries.
+
+        Updates that were not applied yet are already in the config, so the
+        reconciler or the router's next check-in applies them later.
+        """
+        for update in self._updates.values():
+            if update.retry is not None:
+                update.retry.cancel()
+                update.retry = None
+        for task in self._tasks:
+            task.cancel()
+        for task in self._tasks:
+            with contextlib.suppress(asyncio.CancelledError):
+                await task
+        self._tasks = []
+
+    async def submit(self, location: Location, ip_address: str) -> tuple[int, str]:
+        """Record a DDNS check-in and queue it to be applied to Microsoft.
+
+        Args:
+            location:
+                The Location the router checked in for.
+            ip_address:
+                The IP address reported by the router, already validated.
+
+        Returns:
+            Tuple of the HTTP status code and the DDNS response body.
+
+        """
+        update: _Update | None = self._updates.get(location.location_id)
+
+        # If nothing else is waiting, and Microsoft was recently confirmed to already have this IP, respond No Change
+        # A miss is counted when the update is applied, which checks the cache again
+        if (update is None or update.state in {"applied", "failed"}) and ip_cache.is_unchanged(
+            location.location_id,
+            ip_address,
+            count_miss=False,
+        ):
+            return status.HTTP_200_OK, "nochg " + ip_address
+
+        recorded: Location | None = await config_store.record_ip(location.location_id, ip_address, source="ddns")
+        if recorded is None:
+            return status.HTTP_400_BAD_REQUEST, "Invalid Data"
+
+        if update is None:
+            update = self._updates[location.location_id] = _Update(recorded, ip_address)
+        elif update.ip_address != ip_address or update.state in {"applied", "failed"}:
+            update.attempts = 0
+            update.error = ""
+        update.location = recorded
+        update.ip_address = ip_address
+        update.updated = time.time()
+        if not update.running:
+            update.state = "pending"
+        if update.retry is not None:
+            update.retry.cancel()
+            update.retry = None
+        self._enqueue(location.location_id, update)
+        return status.HTTP_200_OK, "good " + ip_address
+
+    def states(self) -> dict[str, dict[str, object]]:
+        """Return the state of the last check-in for every Location, by location_id."""
+        return {
+            location_id: {
+                "display_name": update.location.display_name,
+                "ip_address": update.ip_address,
+                "state": update.state,
+                "attempts": update.attempts,
+                "error": update.error,
+                "updated": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(update.updated)),
+            }
+            for location_id, update in self._updates.items()
+        }
+
+    def counts(self) -> dict[str, int]:
+        """Return how many Locations are in each state."""
+        counts: dict[str, int] = dict.fromkeys(UPDATE_STATES, 0)
+        for update in self._updates.values():
+            counts[update.state] += 1
+        return counts
+
+    def _enqueue(self, location_id: str, update: _Update) -> None:
+        update.retry = None
+        if not update.queued and not update.running:
+            update.queued = True
+            self._queue.put_nowait(location_id)
+
+    async def _work(self) -> None:
+        while True:
+            location_id: str = await self._queue.get()
+            try:
+                await self._apply(location_id)
+            finally:
+                self._queue.task_done()
+
+    async def _apply(self, location_id: str) -> None:
+        logger: logging.Logger = logging.getLogger("uvicorn.error")
+
+        update: _Update = self._updates[location_id]
+        location: Location = update.location
+        ip_address: str = update.ip_address
+        update.queued = False
+        update.running = True
+        update.state = "applying"
+        update.attempts += 1
+        try:
+            status_code, content = await ddns_updater.submit(location, ip_address)
+        except Exception as e:
+            logger.exception("Applying IP: %s for Location: %s failed", ip_address, location.display_name)
+            status_code, content = status.HTTP_500_INTERNAL_SERVER_ERROR, str(e)
+        finally:
+            update.running = False
+        update.updated = time.time()
+
+        # A newer IP address was reported while this one was applied, apply that one next
+        if update.ip_address != ip_address:
+            update.state = "pending"
+            self._enqueue(location_id, update)
+            return
+
+        if status_code == status.HTTP_200_OK and content != "911":
+            update.error = ""
+            # A held IP address is applied by the flap damper once the Location may be updated again
+            held: asyncio.Future[bool] | None = flap_damper.held_result(location_id)
+            if held is not None and flap_damper.held_ip(location_id) == ip_address:
+                update.state = "held"
+                held.add_done_callback(functools.partial(self._held_done, update, ip_address))
+            else:
+                update.state = "applied"
+            return
+
+        update.error = "Microsoft is unavailable" if content == "911" else content
+        if status_code == status.HTTP_400_BAD_REQUEST or update.attempts >= self.max_attempts:
+            update.state = "failed"
+            logger.error(
+                "Giving up on IP: %s for Location: %s after %d attempts",
+                ip_address,
+                location.display_name,
+                update.attempts,
+            )
+            return
+
+        update.state = "pending"
+        delay: float = max(
+            min(self.max_retry_delay, self.retry_delay * 2 ** (update.attempts - 1)),
+            graph_scheduler.backoff_remaining(location.tenant_id),
+        )
+        logger.info("Retrying IP: %s for Location: %s in %.0f seconds", ip_address, location.display_name, delay)
+        update.retry = asyncio.get_running_loop().call_later(delay, self._enqueue, location_id, update)
+
+    @staticmethod
+    def _held_done(update: _Update, ip_address: str, held: asyncio.Future[bool]) -> None:
+        # Ignore the result if a newer check-in replaced this update
+        if held.cancelled() or update.state != "held" or update.ip_address != ip_address:
+            return
+        update.updated = time.time()
+        if held.result():
+            update.state = "applied"
+        else:
+            update.state = "failed"
+            update.error = "The held IP address was dropped before it was applied"
+
+
+update_queue: UpdateQueue = UpdateQueue(
+    enabled=os.getenv("DDNS_ASYNC", "false").lower() in {"1", "true", "yes"},
+    workers=int(os.getenv("DDNS_WORKERS", "4")),
+    max_attempts=int(os.getenv("DDNS_MAX_ATTEMPTS", "5")),
+    retry_delay=float(os.getenv("DDNS_RETRY_DELAY", "5")),
+    max_retry_delay=float(os.getenv("DDNS_MAX_RETRY_DELAY", "300")),
+)
+
+metrics.callback(
+    "ddns_update_queue_depth",
+    "DDNS updates waiting for a worker.",
+    "gauge",
+    lambda: update_queue.depth,
+)
+metrics.callback(
+    "ddns_update_queue_locations",
+    "Locations by the state of their last queued DDNS update.",
+    "gauge",
+    lambda: {(state,): count for state, count in update_queue.counts().items()},
+    ("state",),
+)
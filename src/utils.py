@@ -3,14 +3,41 @@
 This module contains the miscellanous functions used in the app.
 """
 
+import asyncio
 import base64
+import email.utils
+import logging
+import math
+import os
+import uuid
+from collections.abc import AsyncIterator
+from typing import TypeVar
 
+import httpx
+from azure.core.exceptions import AzureError
 from fastapi import Request, Response, status
 
-from app_config import read_config
-from graph import get_location
+from app_config import config_store
+from graph import get_tenant_locations, graph_pool
 from location import Location
 
+# Maximum number of tenants queried at once by get_all_locations.
+graph_max_concurrency: int = int(os.getenv("GRAPH_MAX_CONCURRENCY", "4"))
+
+# Seconds to wait for one tenant's Named Locations before marking it unavailable.
+graph_tenant_timeout: float = float(os.getenv("GRAPH_TENANT_TIMEOUT", "10"))
+
+# Locations shown on each page of /list and /list-m365 unless the size query parameter is given.
+list_page_size: int = int(os.getenv("LIST_PAGE_SIZE", "100"))
+
+# Largest page size accepted from the size query parameter.
+list_max_page_size: int = int(os.getenv("LIST_MAX_PAGE_SIZE", "1000"))
+
+# Part of every ETag, so versions counted by different processes never match.
+etag_prefix: str = uuid.uuid4().hex[:12]
+
+T = TypeVar("T")
+
 bad_auth: Response = Response(
     status_code=status.HTTP_401_UNAUTHORIZED,
     content="Incorrect username or password",
@@ -18,61 +45,198 @@ bad_auth: Response = Response(
 )
 
 
-async def get_all_locations() -> list[tuple[Location, Location]] | None:
+async def get_all_locations() -> list[tuple[Location, Location | None]] | None:
     """Return a list of tuples of (2) Locations.
 
-    This function reads in a list of Locations from the configuration
-    file.  It then creates a matching Location for each from the config
+    This function reads in a list of Locations from the in memory
+    configuration.  It then creates a matching Location for each from the config
     file.  It returns a list of tuples of Locations.  The two locations
     in the tuple are (1) from config file, (2) from Microsoft Graph
 
+    Locations are grouped by app registration so each tenant is listed
+    once, and tenants are queried concurrently.  If a tenant fails or times
+    out, the second Location of its rows is None to mark it unavailable.
+
     Returns:
-            list[tuple[Location, Location]] or None on error
+            list[tuple[Location, Location | None]] or None on error
 
     """
-    config: list[Location] = read_config()
+    config: list[Location] = config_store.get_locations()
 
     if len(config) == 0:
         return None
 
-    bundled_locations: list[tuple[Location, Location]] = []
+    return bundle_locations(config, await get_locations_by_tenant(config))
+
 
+async def get_locations_by_tenant(config: list[Location]) -> dict[tuple[str, str, str], dict[str, Location] | None]:
+    """Return the Named Locations of every tenant used by config.
+
+    Args:
+        config:
+            The Locations whose tenants are listed.
+
+    Returns:
+            A dictionary of graph_pool key to the tenant's Named Locations by
+            location_id, or None if the tenant failed or timed out.
+
+    """
+    return {key: tenant_locations async for key, tenant_locations in iter_locations_by_tenant(config)}
+
+
+async def iter_locations_by_tenant(
+    config: list[Location],
+) -> AsyncIterator[tuple[tuple[str, str, str], dict[str, Location] | None]]:
+    """Yield the Named Locations of every tenant used by config as each tenant answers.
+
+    Each app registration is listed once, and tenants are queried
+    concurrently, at most graph_max_concurrency at a time.
+
+    Args:
+        config:
+            The Locations whose tenants are listed.
+
+    Yields:
+            Tuples of graph_pool key and the tenant's Named Locations by
+            location_id, or None if the tenant failed or timed out.
+
+    """
+    tenants: dict[tuple[str, str, str], Location] = {}
     for location in config:
-        m365_location = await get_location(location)
-        if m365_location is not None:
-            bundle = (location, m365_location)
-            bundled_locations.append(bundle)
+        tenants.setdefault(graph_pool.key(location), location)
+
+    semaphore = asyncio.Semaphore(graph_max_concurrency)
+
+    async def list_tenant(key: tuple[str, str, str]) -> tuple[tuple[str, str, str], dict[str, Location] | None]:
+        return key, await _get_tenant_locations(tenants[key], semaphore)
+
+    for listed in asyncio.as_completed([list_tenant(key) for key in tenants]):
+        yield await listed
+
+
+def bundle_locations(
+    config: list[Location],
+    tenant_results: dict[tuple[str, str, str], dict[str, Location] | None],
+) -> list[tuple[Location, Location | None]] | None:
+    """Pair each Location in config with its Named Location from Microsoft.
+
+    Args:
+        config:
+            The Locations from the config file.
+        tenant_results:
+            The Named Locations of each tenant, as returned by get_locations_by_tenant.
+            Tenants that are missing or None are marked unavailable.
+
+    Returns:
+            list[tuple[Location, Location | None]] or None if config is empty
+
+    """
+    bundled_locations: list[tuple[Location, Location | None]] = []
+
+    for location in config:
+        m365_locations = tenant_results.get(graph_pool.key(location))
+        if m365_locations is None:
+            bundle = (location, None)
         else:
-            bundle = (location, Location())
-            bundled_locations.append(bundle)
+            bundle = (location, m365_locations.get(location.location_id, Location()))
+        bundled_locations.append(bundle)
 
     if len(bundled_locations) > 0:
         return bundled_locations
     return None
 
 
-def get_location_from_config(config: list[Location], hostname: str) -> Location | None:
-    """Return the Location from the list of Locations where hostname matches display_name.
+async def _get_tenant_locations(location: Location, semaphore: asyncio.Semaphore) -> dict[str, Location] | None:
+    """List a tenant's Named Locations, bounded by semaphore and the tenant timeout, or None if it fails."""
+    logger: logging.Logger = logging.getLogger("uvicorn.error")
+
+    async with semaphore:
+        try:
+            return await asyncio.wait_for(get_tenant_locations(location), graph_tenant_timeout)
+        except TimeoutError:
+            logger.warning("Timed out listing locations for tenant_id : %s", location.tenant_id)
+            return None
+        except (AzureError, httpx.HTTPError):
+            logger.exception("Unable to list locations for tenant_id : %s", location.tenant_id)
+            return None
+
 
-    Given a list of Locations the function will return the location object
-    of the Location that matches its display_name to hostname
+def paginate(items: list[T], page: int, size: int) -> tuple[list[T], dict[str, int]]:
+    """Return one page of items.
 
     Args:
-        config:
-            A list of Locations, generally from the config file.
-        hostname:
-            The hostname that is being serached for.
+        items:
+            Everything that can be shown.
+        page:
+            The page number, starting from 1, moved into range if needed.
+        size:
+            Items per page, between 1 and list_max_page_size.
+
+    Returns:
+            Tuple of the items on the page and a dictionary of the page number,
+            the number of pages, the page size and the number of items.
+
+    """
+    size = min(max(size, 1), list_max_page_size)
+    pages: int = max(1, math.ceil(len(items) / size))
+    page = min(max(page, 1), pages)
+    pager: dict[str, int] = {"page": page, "pages": pages, "size": size, "total": len(items)}
+    return items[(page - 1) * size : page * size], pager
+
+
+def has_drift(bundle: tuple[Location, Location | None]) -> bool:
+    """Return whether Microsoft is unavailable or differs from the config for a bundle from bundle_locations."""
+    location, m365_location = bundle
+    return (
+        m365_location is None
+        or location.ip_address != m365_location.ip_address
+        or location.is_trusted != m365_location.is_trusted
+    )
+
+
+def not_modified(request: Request, etag: str, last_modified: float) -> Response | None:
+    """Check a conditional GET against the current version of a page.
+
+    If-None-Match is checked first, and If-Modified-Since only if the
+    request has no If-None-Match, as in RFC 9110.
+
+    Args:
+        request:
+            The incomming HTTP Request
+        etag:
+            The quoted ETag of the page as it would be rendered now
+        last_modified:
+            When the data shown on the page last changed, in seconds since the epoch
 
     Returns:
-            Location where hostname == location.display_name
+            A 304 Not Modified response, or None if the page has to be rendered.
 
     """
-    for loc in config:
-        if loc.display_name == hostname:
-            return loc
+    if_none_match: str | None = request.headers.get("If-None-Match")
+    if if_none_match is not None:
+        tags: set[str] = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+        matched: bool = etag in tags or "*" in tags
+    else:
+        try:
+            since = email.utils.parsedate_to_datetime(request.headers.get("If-Modified-Since", ""))
+        except (TypeError, ValueError):
+            return None
+        matched = int(last_modified) <= since.timestamp()
+
+    if matched:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=cache_headers(etag, last_modified))
     return None
 
 
+def cache_headers(etag: str, last_modified: float) -> dict[str, str]:
+    """Return the ETag and Last-Modified headers, asking browsers to check them on every load."""
+    return {
+        "ETag": etag,
+        "Last-Modified": email.utils.formatdate(last_modified, usegmt=True),
+        "Cache-Control": "private, no-cache",
+    }
+
+
 async def check_authentication(request: Request, username: str, password: str) -> tuple[bool, Response | None]:
     """Check if request has the appropriate username and password.
 
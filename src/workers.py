@@ -0,0 +1,221 @@
+"""Module for running the application in several worker processes.
+
+When WEB_WORKERS is more than 1, uvicorn starts that many processes, each
+with its own copy of the configuration.  They share the config directory,
+so writes to config.yml and the journal are serialized with file locks,
+and each process reloads the configuration when another one changes it.
+Background jobs that act on the shared data, such as the reconciler and
+the journal compactor, only run in the process elected leader.  If the
+leader exits, another process takes over.  Each process refreshes the
+tokens of its own Graph clients.
+
+Typical usage example:
+
+    with FileLock(Path("config/.config.yml.lock")):
+        ...
+    leader.add_job(reconciler.start, reconciler.close)
+    leader.start()
+    await leader.close()
+
+"""
+
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import logging
+import os
+import threading
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+if TYPE_CHECKING:
+    from collections.abc import Awaitable, Callable
+    from types import TracebackType
+
+# Whether flock() is available to coordinate worker processes.
+FILE_LOCKING: bool = fcntl is not None
+
+# Number of uvicorn worker processes.
+WEB_WORKERS: int = int(os.getenv("WEB_WORKERS", "1"))
+
+# Whether several processes share the config directory.
+SHARED: bool = WEB_WORKERS > 1
+
+# Seconds between attempts of a follower to become the leader.
+LEADER_POLL_INTERVAL: float = float(os.getenv("LEADER_POLL_INTERVAL", "5"))
+
+LEADER_LOCK_PATH: Path = Path("config/.leader.lock")
+
+
+class FileLock:
+    """Exclusive lock shared by the threads of a process and by other processes.
+
+    The lock is held with flock() on a lock file, so it is released by the
+    operating system if the process dies.  It is not reentrant.
+
+    Attributes:
+        path: Path
+            The lock file
+
+    """
+
+    path: Path
+
+    def __init__(self, path: Path) -> None:
+        """Initialize a FileLock on the given lock file.
+
+        Args:
+            path:
+                The lock file, created if it does not exist.
+
+        """
+        self.path = path
+        self._lock: threading.Lock = threading.Lock()
+        self._file_descriptor: int | None = None
+
+    def __enter__(self) -> None:
+        """Wait for the lock."""
+        self._lock.acquire()
+        try:
+            file_descriptor: int = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        except BaseException:
+            self._lock.release()
+            raise
+        if fcntl is not None:
+            fcntl.flock(file_descriptor, fcntl.LOCK_EX)
+        self._file_descriptor = file_descriptor
+
+    def __exit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc_value: BaseException | None,
+        traceback: TracebackType | None,
+    ) -> None:
+        """Release the lock."""
+        file_descriptor, self._file_descriptor = self._file_descriptor, None
+        try:
+            if fcntl is not None:
+                fcntl.flock(file_descriptor, fcntl.LOCK_UN)
+            os.close(file_descriptor)
+        finally:
+            self._lock.release()
+
+
+class LeaderElection:
+    """Elects one worker process to run the background jobs.
+
+    The leader holds a non-blocking flock() on a lock file for as long as
+    it runs.  Followers try to take the lock every poll_interval seconds,
+    so when the leader exits one of them starts the jobs.  With a single
+    worker the election is skipped and the process leads at once.
+
+    Attributes:
+        path: Path
+            The lock file held by the leader
+        enabled: bool
+            Whether an election is held
+        poll_interval: float
+            Seconds between attempts of a follower to become the leader
+        leading: bool
+            Whether this process runs the background jobs
+
+    """
+
+    path: Path
+    enabled: bool
+    poll_interval: float
+    leading: bool
+
+    def __init__(self, path: Path, *, enabled: bool, poll_interval: float) -> None:
+        """Initialize a LeaderElection without any jobs.
+
+        Args:
+            path:
+                The lock file held by the leader
+            enabled:
+                Whether an election is held
+            poll_interval:
+                Seconds between attempts of a follower to become the leader
+
+        """
+        self.path = path
+        self.enabled = enabled and FILE_LOCKING
+        self.poll_interval = poll_interval
+        self.leading = False
+        self._jobs: list[tuple[Callable[[], object], Callable[[], Awaitable[object]]]] = []
+        self._file_descriptor: int | None = None
+        self._task: asyncio.Task | None = None
+
+    def add_job(self, start: Callable[[], object], close: Callable[[], Awaitable[object]]) -> None:
+        """Register a background job run by the leader.
+
+        Args:
+            start:
+                Called when this process becomes the leader.
+            close:
+                Awaited on shutdown if this process is the leader, in the reverse order of start.
+
+        """
+        self._jobs.append((start, close))
+
+    def start(self) -> None:
+        """Lead at once, or start trying to become the leader."""
+        if not self.enabled:
+            self._lead()
+        elif self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self) -> None:
+        """Stop trying to become the leader, or stop the jobs and step down."""
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+        if not self.leading:
+            return
+        for _, close in reversed(self._jobs):
+            await close()
+        self.leading = False
+        if self._file_descriptor is not None:
+            os.close(self._file_descriptor)
+            self._file_descriptor = None
+
+    def _try_acquire(self) -> bool:
+        file_descriptor: int = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(file_descriptor, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(file_descriptor)
+            return False
+        self._file_descriptor = file_descriptor
+        return True
+
+    def _lead(self) -> None:
+        self.leading = True
+        for start, _ in self._jobs:
+            start()
+
+    async def _run(self) -> None:
+        logger: logging.Logger = logging.getLogger("uvicorn.error")
+
+        while True:
+            try:
+                acquired: bool = self._try_acquire()
+            except OSError as e:
+                logger.exception("Unable to open %s", self.path, exc_info=e)
+                acquired = False
+            if acquired:
+                logger.info("Worker %d is the leader, starting background jobs", os.getpid())
+                self._lead()
+                return
+            await asyncio.sleep(self.poll_interval)
+
+
+leader: LeaderElection = LeaderElection(LEADER_LOCK_PATH, enabled=SHARED, poll_interval=LEADER_POLL_INTERVAL)